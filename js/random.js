@@ -60,10 +60,16 @@ const randomBattle = () => {
     });
 }
 
+// node js/random.js [バトル数]
+// pokeai.bench.simpipe_benchでnode内で完結するバトルのスループットの目安として用いる
+const n_battles = process.argv.length > 2 ? Number(process.argv[2]) : 100000;
+
 (async () => {
-    for (let i = 0; i < 100000; i++) {
+    for (let i = 0; i < n_battles; i++) {
         const battle_result = await randomBattle();
         console.log(JSON.stringify(battle_result));
     }
+    // 引き分けで打ち切ったバトルのストリームが残っていても終了する
+    process.exit(0);
 })();
 
@@ -1,23 +1,378 @@
 // 標準入出力によるプロセス間通信によりシミュレータを公開
-// chunk単位をjsonシリアライズして1行で送受信
+// 1プロセスで複数のバトルを同時に進行させる(多重化)
+// 通信方式(pokeai/sim/transport.py参照)
+// 既定: chunk単位を [バトルID, chunk] の配列としてjsonシリアライズして1行で送受信
+// --framed: 長さ付きバイナリフレームで送受信
+// --split: updateを各プレイヤー向け(p1, p2)に分割して送る。秘密情報(|split|)の処理をpython側で行う必要がなくなる。
+//   jsonの場合は [バトルID, chunk, side] 、framedの場合はヘッダのsideにp1, p2が入る
+// BattleStreamのコマンドに加え、以下のコマンドを受け付ける(探索を行うAI用)
+// >fork {"battleId": 複製先ID, "seed": [4整数]またはnull}  進行中のバトルを複製先IDで複製する
+// >snapshot  バトルの状態をシリアライズし、chunkの種類snapshotで返す(バトルが存在しない場合はnull)
+// >restore {"snapshot": スナップショット, "seed": [4整数]またはnull}  新しいバトルIDで復元する
+// 複製・復元したバトルは、それまでのログをupdateとして送った後、行動選択の要求(request)を送りなおす
+// >rollout {"side": "p1", "actions": ["move 1", ...], "n": 回数, "maxTurns": ターン数またはnull, "seed": [4整数]またはnull}
+//   各行動についてバトルを複製してランダムなプレイアウトをn回行い、chunkの種類rolloutで結果を返す
+//   {"move 1": {"value": 平均価値, "n": 回数, "wins": 勝ち数, "losses": 負け数}, ...}
+// >simplebattle {"p1": {"name", "team", "policy": {"type": "random", "switchProb": 0.2}}, "p2": ..., "seed", "policySeed"}
+//   行動選択もシミュレータ内で行ってバトル全体を進め、endのみを返す(単純な方策同士のバトル用)
 
 const bs = require('../Pokemon-Showdown/.sim-dist/battle-stream');
 const BattleStream = bs.BattleStream;
+const Battle = require('../Pokemon-Showdown/.sim-dist/battle').Battle;
+const PRNG = require('../Pokemon-Showdown/.sim-dist/prng').PRNG;
 
-// keepAlive: 複数回バトルを行えるようにする(デフォルトではバトルが終了するとストリームが閉じられる)
-const stream = new BattleStream({ debug: false, keepAlive: true });
+const framed = process.argv.includes('--framed');
+const split = process.argv.includes('--split');
 
-const reader = require('readline').createInterface({
-    input: process.stdin,
-    output: process.stdout
-});
-reader.on('line', function (line) {
-    stream.write(JSON.parse(line));
-});
+// フレームのヘッダ: 本体のバイト数(uint32) + バトルID(uint32) + chunkの種類(uint8) + side(uint8)
+const FRAME_HEADER_SIZE = 10;
+const CHUNK_TYPES = { 'input': 0, 'update': 1, 'sideupdate': 2, 'end': 3, 'snapshot': 4, 'rollout': 5 };
+const SIDES = { '': 0, 'p1': 1, 'p2': 2 };
 
-(async () => {
+// バトルID => BattleStream
+// バトルが終了するとストリームが閉じられ、mapから削除される
+const streams = new Map();
+
+const writeFrame = (battleId, chunkType, side, body) => {
+    const bodyBuf = Buffer.from(body, 'utf-8');
+    const header = Buffer.alloc(FRAME_HEADER_SIZE);
+    header.writeUInt32LE(bodyBuf.length, 0);
+    header.writeUInt32LE(battleId, 4);
+    header.writeUInt8(CHUNK_TYPES[chunkType], 8);
+    header.writeUInt8(SIDES[side], 9);
+    process.stdout.write(Buffer.concat([header, bodyBuf]));
+};
+
+const writeJson = (battleId, chunkType, side, body) => {
+    let obj;
+    if (chunkType === 'update' && side) {
+        obj = [battleId, `update\n${body}`, side];
+    } else if (side) {
+        obj = [battleId, `${chunkType}\n${side}\n${body}`];
+    } else {
+        obj = [battleId, `${chunkType}\n${body}`];
+    }
+    process.stdout.write(JSON.stringify(obj) + '\n');
+};
+
+const emit = framed ? writeFrame : writeJson;
+
+// updateのうち各プレイヤーの秘密情報を処理し、p1向けとp2向けを1回の走査で作る
+// Pokemon-Showdown/sim/battle.ts の extractUpdateForSide と同じ結果になる
+// |split|p1
+// p1向けの秘密情報の行
+// それ以外向けの行(空行の場合は出力しない)
+const splitUpdate = (data) => {
+    if (data.indexOf('|split|') < 0) {
+        return [data, data];
+    }
+    const lines = data.split('\n');
+    const p1Lines = [];
+    const p2Lines = [];
+    for (let i = 0; i < lines.length; i++) {
+        const line = lines[i];
+        if (!line.startsWith('|split|')) {
+            p1Lines.push(line);
+            p2Lines.push(line);
+            continue;
+        }
+        const owner = line.slice(7);
+        const secret = i + 1 < lines.length ? lines[i + 1] : '';
+        const shared = i + 2 < lines.length ? lines[i + 2] : '';
+        if (owner === 'p1') {
+            p1Lines.push(secret);
+        } else if (shared) {
+            p1Lines.push(shared);
+        }
+        if (owner === 'p2') {
+            p2Lines.push(secret);
+        } else if (shared) {
+            p2Lines.push(shared);
+        }
+        i += 2;
+    }
+    return [p1Lines.join('\n'), p2Lines.join('\n')];
+};
+
+const writeChunk = (battleId, chunk) => {
+    // chunkの種類(とsideupdateの場合はside)を分離
+    const typeEnd = chunk.indexOf('\n');
+    const chunkType = chunk.slice(0, typeEnd);
+    let body = chunk.slice(typeEnd + 1);
+    let side = '';
+    if (chunkType === 'sideupdate') {
+        const sideEnd = body.indexOf('\n');
+        side = body.slice(0, sideEnd);
+        body = body.slice(sideEnd + 1);
+    } else if (chunkType === 'update' && split) {
+        const [p1Body, p2Body] = splitUpdate(body);
+        emit(battleId, chunkType, 'p1', p1Body);
+        emit(battleId, chunkType, 'p2', p2Body);
+        return;
+    }
+    emit(battleId, chunkType, side, body);
+};
+
+// バトルの出力を読み続け、IDをつけてpythonに送る
+const pump = async (battleId, stream) => {
     let chunk;
     while (chunk = await stream.read()) {
-        process.stdout.write(JSON.stringify(chunk) + '\n');
+        writeChunk(battleId, chunk);
+    }
+    streams.delete(battleId);
+};
+
+// 複製・復元したBattleを新しいストリームとして登録し、進行を再開する
+const resumeBattle = (battleId, battleJSON, seed) => {
+    let battle;
+    try {
+        battle = Battle.fromJSON(battleJSON);
+    } catch (e) {
+        writeChunk(battleId, `end\n${JSON.stringify({ error: `cannot restore battle: ${e.message}` })}`);
+        return;
+    }
+    if (seed) {
+        battle.prng = new PRNG(seed);
+    }
+    const stream = new BattleStream({ debug: false });
+    // BattleStreamがBattleを生成する際のsendと同じ
+    battle.restart((type, data) => {
+        if (Array.isArray(data)) {
+            data = data.join('\n');
+        }
+        stream.push(`${type}\n${data}`);
+        if (type === 'end' && !stream.keepAlive) {
+            stream.push(null);
+        }
+    });
+    stream.battle = battle;
+    streams.set(battleId, stream);
+    // プレイヤーが状態を再構築できるよう、それまでのログを送る
+    writeChunk(battleId, `update\n${battle.log.join('\n')}`);
+    pump(battleId, stream);
+    // 選択済みの行動は破棄して要求を送りなおす
+    battle.makeRequest(battle.requestState);
+};
+
+// シミュレータ内の方策: requestからランダムに行動を選ぶ(pokeai/ai/random_policy.pyと同様)
+const RANDOM_SWITCH_PROB = 0.2;
+const TURN_LIMIT = 100;  // pythonのforcetieと同じ
+
+const randomChoice = (request, prng, switchProb = RANDOM_SWITCH_PROB) => {
+    const switches = [];
+    request.side.pokemon.forEach((pokemon, i) => {
+        if (!pokemon.active && !pokemon.condition.endsWith(' fnt')) {
+            switches.push(`switch ${i + 1}`);
+        }
+    });
+    if (request.forceSwitch) {
+        return switches.length > 0 ? switches[prng.next(switches.length)] : 'pass';
+    }
+    const active = request.active[0];
+    const moves = [];
+    active.moves.forEach((move, i) => {
+        if (!move.disabled) {
+            moves.push(`move ${i + 1}`);
+        }
+    });
+    // python側(ActionMapper)と同じく、trappedのみ交換不可とする(maybeTrappedは無視)
+    // 実際には交換できず選択が拒否された場合は、playUntilが'default'で選びなおす
+    if (active.trapped) {
+        switches.length = 0;
+    }
+    if (switches.length > 0 && (moves.length === 0 || prng.next() < switchProb)) {
+        return switches[prng.next(switches.length)];
     }
-})();
+    // 選べる技がない場合はわるあがき
+    return moves.length > 0 ? moves[prng.next(moves.length)] : 'move 1';
+};
+
+// 残りHPの割合の平均
+const hpRatio = (side) => {
+    let sum = 0;
+    for (const pokemon of side.pokemon) {
+        sum += pokemon.fainted ? 0 : pokemon.hp / pokemon.maxhp;
+    }
+    return sum / side.pokemon.length;
+};
+
+// バトルが終了するかターン数の上限に達するまで、chooser(side, sideIndex)が返す行動で進める
+const playUntil = (battle, turnLimit, chooser) => {
+    while (!battle.ended && battle.turn < turnLimit) {
+        let chose = false;
+        battle.sides.forEach((side, i) => {
+            if (battle.ended || !side.activeRequest || side.activeRequest.wait || side.isChoiceDone()) {
+                return;
+            }
+            if (!battle.choose(side.id, chooser(side, i))) {
+                battle.choose(side.id, 'default');
+            }
+            chose = true;
+        });
+        if (!chose) {
+            break;
+        }
+    }
+};
+
+// バトルの状態から1回のプレイアウトを行い、sideから見た価値(勝ち:1 負け:-1)を返す
+const playout = (battleJSON, sideIndex, action, maxTurns, prng) => {
+    const battle = Battle.fromJSON(battleJSON);
+    battle.prng = new PRNG([0, 0, 0, 0].map(() => prng.next(0x10000)));
+    battle.restart(() => {});
+    // 複製元で相手が選択済みの行動は見えないよう、要求を作り直す
+    battle.makeRequest(battle.requestState);
+    const turnLimit = Math.min(TURN_LIMIT, maxTurns ? battle.turn + maxTurns : TURN_LIMIT);
+    let first = true;
+    playUntil(battle, turnLimit, (side, i) => {
+        if (first && i === sideIndex) {
+            first = false;
+            return action;
+        }
+        return randomChoice(side.activeRequest, prng);
+    });
+    const side = battle.sides[sideIndex];
+    if (battle.ended) {
+        if (!battle.winner) {
+            return 0;
+        }
+        return battle.winner === side.name ? 1 : -1;
+    }
+    return hpRatio(side) - hpRatio(side.foe);
+};
+
+const rollout = (battle, arg) => {
+    const battleJSON = battle.toJSON();
+    const sideIndex = arg.side === 'p1' ? 0 : 1;
+    const prng = new PRNG(arg.seed || undefined);
+    const result = {};
+    for (const action of arg.actions) {
+        let value = 0;
+        let wins = 0;
+        let losses = 0;
+        for (let i = 0; i < arg.n; i++) {
+            const v = playout(battleJSON, sideIndex, action, arg.maxTurns, prng);
+            value += v;
+            if (v === 1) {
+                wins++;
+            } else if (v === -1) {
+                losses++;
+            }
+        }
+        result[action] = { value: arg.n > 0 ? value / arg.n : 0, n: arg.n, wins: wins, losses: losses };
+    }
+    return result;
+};
+
+// 単純な方策同士のバトル全体を行い、endの内容を返す
+// ターン数の上限に達した場合は引き分け(pythonのforcetieと同じ)
+const simpleBattle = (arg) => {
+    const battle = new Battle({ formatid: 'gen2customgame', seed: arg.seed || undefined, send: () => {} });
+    const sideIds = ['p1', 'p2'];
+    const policies = [];
+    for (const sideId of sideIds) {
+        const spec = arg[sideId];
+        if (spec.policy.type !== 'random') {
+            throw new Error(`unknown simple policy ${spec.policy.type}`);
+        }
+        policies.push(spec.policy);
+        battle.setPlayer(sideId, { name: spec.name, team: spec.team });
+    }
+    const prng = new PRNG(arg.policySeed || undefined);
+    playUntil(battle, TURN_LIMIT,
+        (side, i) => randomChoice(side.activeRequest, prng, policies[i].switchProb));
+    let winner = '';
+    battle.sides.forEach((side, i) => {
+        if (battle.winner && battle.winner === side.name) {
+            winner = sideIds[i];
+        }
+    });
+    return { winner: winner, turns: battle.turn, seed: battle.prngSeed };
+};
+
+// 拡張コマンドを処理する。処理した場合true
+const onCommand = (battleId, chunk) => {
+    const spaceIndex = chunk.indexOf(' ');
+    const command = spaceIndex >= 0 ? chunk.slice(0, spaceIndex) : chunk;
+    const arg = spaceIndex >= 0 ? JSON.parse(chunk.slice(spaceIndex + 1)) : null;
+    const stream = streams.get(battleId);
+    switch (command) {
+    case '>fork':
+        if (!stream || !stream.battle) {
+            writeChunk(arg.battleId, `end\n${JSON.stringify({ error: `battle ${battleId} does not exist` })}`);
+        } else {
+            resumeBattle(arg.battleId, stream.battle.toJSON(), arg.seed);
+        }
+        return true;
+    case '>snapshot':
+        emit(battleId, 'snapshot', '', stream && stream.battle ? JSON.stringify(stream.battle.toJSON()) : 'null');
+        return true;
+    case '>restore':
+        resumeBattle(battleId, arg.snapshot, arg.seed);
+        return true;
+    case '>simplebattle':
+        try {
+            writeChunk(battleId, `end\n${JSON.stringify(simpleBattle(arg))}`);
+        } catch (e) {
+            writeChunk(battleId, `end\n${JSON.stringify({ error: `simple battle failed: ${e.message}` })}`);
+        }
+        return true;
+    case '>rollout':
+        emit(battleId, 'rollout', '', JSON.stringify(stream && stream.battle ? rollout(stream.battle, arg) : {}));
+        return true;
+    }
+    return false;
+};
+
+const getStream = (battleId, chunk) => {
+    let stream = streams.get(battleId);
+    if (!stream) {
+        if (!chunk.startsWith('>start')) {
+            // 終了済みバトルへの書き込みは無視
+            return null;
+        }
+        // keepAliveなし: endメッセージの後ストリームが閉じられる
+        stream = new BattleStream({ debug: false });
+        streams.set(battleId, stream);
+        pump(battleId, stream);
+    }
+    return stream;
+};
+
+const onInput = (battleId, chunk) => {
+    if (onCommand(battleId, chunk)) {
+        return;
+    }
+    const stream = getStream(battleId, chunk);
+    if (stream) {
+        stream.write(chunk);
+    }
+};
+
+if (framed) {
+    let pending = Buffer.alloc(0);
+    process.stdin.on('data', (data) => {
+        pending = pending.length > 0 ? Buffer.concat([pending, data]) : data;
+        let offset = 0;
+        while (pending.length - offset >= FRAME_HEADER_SIZE) {
+            const bodyLength = pending.readUInt32LE(offset);
+            const frameEnd = offset + FRAME_HEADER_SIZE + bodyLength;
+            if (pending.length < frameEnd) {
+                break;
+            }
+            const battleId = pending.readUInt32LE(offset + 4);
+            onInput(battleId, pending.toString('utf-8', offset + FRAME_HEADER_SIZE, frameEnd));
+            offset = frameEnd;
+        }
+        pending = pending.slice(offset);
+    });
+} else {
+    const reader = require('readline').createInterface({
+        input: process.stdin,
+        output: process.stdout
+    });
+    reader.on('line', function (line) {
+        const [battleId, chunk] = JSON.parse(line);
+        onInput(battleId, chunk);
+    });
+}
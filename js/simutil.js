@@ -1,5 +1,7 @@
 // シミュレータの付属機能を呼び出しpythonと仲介するユーティリティ
 // jsonシリアライズして送受信
+// リクエスト: {id, method, params} 応答: {id, result, error}
+// 複数のリクエストを続けて送ってよい。応答はidで対応付ける(順序は保証しない)。
 
 const sim = require('../Pokemon-Showdown/.sim-dist');
 const Dex = sim.Dex;
@@ -59,5 +61,6 @@ reader.on('line', async function (line) {
     } else {
         error = { 'message': `No method named ${request['method']}` };
     }
-    process.stdout.write(JSON.stringify({ result, error }) + '\n');
+    const id = request['id'] === undefined ? null : request['id'];
+    process.stdout.write(JSON.stringify({ id, result, error }) + '\n');
 });
@@ -0,0 +1,26 @@
+/*
+  技の基本情報の列挙
+  タイプ、威力、分類を特徴量(pokeai.ai.dex.Dexの技テーブル)に利用する
+  all_moves.jsonを先に生成しておくこと
+  node ./js/tools/enumerate_movedex.js > data/dataset/movedex.json
+*/
+
+const sim = require('../../Pokemon-Showdown/.sim-dist');
+const mdex = new sim.Dex.ModdedDex('gen2');
+const moves = require('../../data/dataset/all_moves.json');
+
+const dex = {};
+moves.forEach(move_id => {
+    const move = mdex.getMove(move_id);
+    dex[move_id] = {
+        id: move.id,
+        name: move.name,
+        type: move.type,
+        basePower: move.basePower,
+        category: move.category,
+        accuracy: move.accuracy,
+        pp: move.pp,
+        priority: move.priority,
+    };
+});
+process.stdout.write(JSON.stringify(dex, null, 2));
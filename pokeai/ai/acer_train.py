@@ -6,6 +6,9 @@ A3Cによる行動学習のプロトタイプ
 
 出力
 - エージェントの保存
+
+--actors Kを指定すると、A3C/ACERの本来の使い方と同様に、K個のactorプロセスが共有メモリ上のモデルパラメータ・optimizerの状態を
+非同期に更新する(Hogwild)。各actorは自分のSimを持ち、独立にバトルを行う。
 """
 
 import os
@@ -14,6 +17,8 @@ import os
 os.environ['OMP_NUM_THREADS'] = '1'  # NOQA
 
 import argparse
+import multiprocessing as mp
+import queue
 import random
 import numpy as np
 from bson import ObjectId
@@ -39,6 +44,60 @@ def acer_train(sim, target_policy, target_party, fitness_policies, fitness_parti
     return {'p1': 1.0, 'p2': 0.0, '': 0.5}[battle_result['winner']]
 
 
+def share_agent_params(agent):
+    """
+    エージェントのモデルパラメータとoptimizerの状態を共有メモリ上に移動する
+    この後forkしたプロセスのエージェントはパラメータを共有する
+    :param agent: chainerrlのA3C, ACERなど、shared_attributesを持つエージェント
+    :return:
+    """
+    # chainer, chainerrlのimportは時間がかかるため、必要になるまで遅らせる
+    import chainer
+    from chainerrl.misc import async_
+    for attr in agent.shared_attributes:
+        obj = getattr(agent, attr)
+        if isinstance(obj, chainer.Link):
+            async_.share_params_as_shared_arrays(obj)
+        elif isinstance(obj, chainer.Optimizer):
+            async_.share_states_as_shared_arrays(obj)
+        else:
+            raise ValueError(f"cannot share attribute {attr} of agent")
+
+
+def _actor_main(actor_idx, seed, target_policy, target_party, fitness_policies, fitness_parties,
+                n_battles, battle_counter, result_queue):
+    """
+    actorプロセスのエントリポイント
+    共有カウンタがn_battlesに達するまでバトルを行い、結果をresult_queueに送る
+    """
+    # fork前の乱数状態を引き継ぐと全actorが同じ行動をサンプリングしてしまう
+    random.seed(seed)
+    np.random.seed(seed % (2 ** 32))
+    target_policy.agent.process_idx = actor_idx
+    sim = Sim()
+    while True:
+        with battle_counter.get_lock():
+            if battle_counter.value >= n_battles:
+                break
+            battle_counter.value += 1
+        result_queue.put(acer_train(sim, target_policy, target_party, fitness_policies, fitness_parties))
+    sim.close()
+
+
+def _get_result(result_queue, actors) -> float:
+    """
+    actorから1バトルの結果を受け取る
+    actorが異常終了した場合は待ち続けずに例外を送出する
+    """
+    while True:
+        try:
+            return result_queue.get(timeout=10.0)
+        except queue.Empty:
+            for actor in actors:
+                if actor.exitcode not in (None, 0):
+                    raise RuntimeError(f"actor process {actor.name} exited with code {actor.exitcode}")
+
+
 def main():
     import logging
     logging.basicConfig(level=logging.WARNING)
@@ -50,28 +109,32 @@ def main():
     parser.add_argument("--battles", type=int, default=100)
     parser.add_argument("--step_agent_tags", help="途中のエージェントを保存するタグ")
     parser.add_argument("--save_step", help="途中のエージェントを保存する頻度（バトル数）", type=int, default=0)
+    parser.add_argument("--incremental_feature", action="store_true", help="特徴量をメッセージごとに差分更新する")
+    parser.add_argument("--actors", type=int, default=1, help="並列にバトルを行うactorプロセス数")
     args = parser.parse_args()
     if args.save_step:
         assert args.step_agent_tags
     fitness_parties = []
     fitness_policies = []
     # agent_tagsのいずれかのタグを含むエージェントを列挙
-    for agent_doc in col_agent.find({"tags": {"$in": args.agent_tags.split(",")}}):
+    for agent_doc in col_agent().find({"tags": {"$in": args.agent_tags.split(",")}}):
         party, policy = load_agent(agent_doc)
         fitness_parties.append(party)
         fitness_policies.append(policy)
-    target_party_doc = col_party.find_one({'_id': ObjectId(args.party_id)})
+    target_party_doc = col_party().find_one({'_id': ObjectId(args.party_id)})
     target_party = target_party_doc['party']
 
-    feature_extractor = FeatureExtractor()
+    feature_extractor = FeatureExtractor(incremental=args.incremental_feature)
     target_policy = RLPolicy(feature_extractor, yaml_load(args.agent_params))
     target_policy.train = True
-    sim = Sim()
     results = []
 
     def save(policy_to_save, tags, battle_results):
+        if args.actors > 1:
+            # 保存されるのはプロセスローカルのmodelなので、共有パラメータの最新値をコピーしておく
+            policy_to_save.agent.sync_parameters()
         trained_agent_id = ObjectId()
-        col_agent.insert_one({
+        col_agent().insert_one({
             '_id': trained_agent_id,
             'party_id': target_party_doc['_id'],
             'policy_packed': pack_obj(policy_to_save),
@@ -81,8 +144,30 @@ def main():
         })
         return trained_agent_id
 
+    if args.actors > 1:
+        share_agent_params(target_policy.agent)
+        ctx = mp.get_context('fork')  # 共有メモリ上のパラメータ・対戦相手の方策をそのまま引き継ぐ
+        battle_counter = ctx.Value('i', 0)
+        result_queue = ctx.Queue()
+        actors = [ctx.Process(target=_actor_main,
+                              args=(actor_idx, random.getrandbits(64), target_policy, target_party, fitness_policies,
+                                    fitness_parties, args.battles, battle_counter, result_queue),
+                              name=f"actor{actor_idx}")
+                  for actor_idx in range(args.actors)]
+        for actor in actors:
+            actor.start()
+
+        def play_battle():
+            return _get_result(result_queue, actors)
+    else:
+        actors = []
+        sim = Sim()
+
+        def play_battle():
+            return acer_train(sim, target_policy, target_party, fitness_policies, fitness_parties)
+
     for battle_idx in tqdm(range(args.battles)):
-        results.append(acer_train(sim, target_policy, target_party, fitness_policies, fitness_parties))
+        results.append(play_battle())
 
         if args.save_step and battle_idx > 0 and len(results) % args.save_step == 0:
             target_policy.train = False
@@ -90,6 +175,8 @@ def main():
             target_policy.train = True
         if battle_idx % 100 == 100 - 1:
             print(f"mean win rate in recent 100 battles: {np.mean(results[-100:])}")
+    for actor in actors:
+        actor.join()
     target_policy.train = False
     final_agent_id = save(target_policy, args.dst_agent_tags.split(','), results)
     target_policy.train = True
@@ -0,0 +1,102 @@
+"""
+requestから取れる行動を求める処理のうち、バトル中に変化しない部分を事前計算したもの
+"""
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from pokeai.ai.dex import get_dex
+from pokeai.sim.party_generator import Party
+
+SWITCH_KEYS = [f'switch {i + 1}' for i in range(6)]  # 1-origin index
+MOVE_KEYS = [f'move {i + 1}' for i in range(4)]  # 1-origin index
+
+
+class ActionMapper:
+    """
+    バトルごとに生成し、requestのポケモンとパーティ構築上のインデックスの対応を保持する
+    BattleStreamProcessor.start_battleで生成され、BattleStatus.action_mapperに入る
+    """
+    side: str
+    side_party: Party
+    _ident2party_idx: Dict[str, int]  # 'p1: Kangaskhan' => パーティ構築上のインデックス
+    _vec: np.ndarray  # 合法手のベクトル(呼び出しごとに再利用)
+
+    def __init__(self, side: str, side_party: Party):
+        self.side = side
+        self.side_party = side_party
+        dex = get_dex()
+        self._ident2party_idx = {}
+        for i, party_poke in enumerate(side_party):
+            # "kangaskhan"=>"Kangaskhan"
+            # FIXME: 種族名が得られるが、ニックネームついてると違うかも？
+            pokemon_name = dex.get_pokedex_by_id(party_poke['species'])['name']
+            self._ident2party_idx[f'{side}: {pokemon_name}'] = i
+        self._vec = np.zeros((len(side_party) * 6,), dtype=np.float32)
+
+    def _party_idx(self, ident: str) -> int:
+        party_idx = self._ident2party_idx.get(ident)
+        if party_idx is None:
+            # 事前計算と表記が異なる場合、種族名から求める
+            pokemon_id = get_dex().get_pokedex_by_name(ident[4:])['id']  # "p1: Kangaskhan" => "kangaskhan"
+            for i, party_poke in enumerate(self.side_party):
+                if party_poke['species'] == pokemon_id:
+                    party_idx = i
+            assert party_idx is not None, f"{ident} is not in the party"
+            self._ident2party_idx[ident] = party_idx
+        return party_idx
+
+    def possible_actions(self, request: dict) -> Tuple[List[int], List[str], np.ndarray]:
+        """
+        取れる行動の番号およびそれを表す文字列を返す(common.get_possible_actions参照)
+        :param request: シミュレータからのrequestオブジェクト
+        :return: 行動の番号, 行動を表す文字列, 合法手のベクトル(次の呼び出しで書き換わるため、保持する場合はコピーすること)
+        """
+        force_switch = bool(request.get("forceSwitch"))
+        active_poke_idx = None
+        choice_idxs = []
+        choice_keys = []
+        if not force_switch:
+            active = request['active']
+            trapped = active[0].get('trapped')  # 交換不可状態
+        else:
+            active = None
+            trapped = False
+
+        # ゴッドバードなど複数ターン継続する技では、
+        # [{"moves":[{"move":"Sky Attack","id":"skyattack"}],"trapped":true}],
+        # のようにmoveが１要素だけになり、active.trapped:trueとなる
+        # moveの番号自体ずれる(固定された技を強制選択となり"move 1"を返すこととなる)ので、番号と技の対応に注意
+
+        # request['side']['pokemon']:
+        # {\"ident\":\"p1: Kangaskhan\",\"details\":\"Kangaskhan, L50, F\",\"condition\":\"211/211\",\"active\":true, ...
+        # 今出ているポケモンが先頭になっている（ゲーム内の交換画面と同様）ことに注意。
+        # モデルの出力行動番号はパーティ構築上の順序に変換する必要がある
+        side_pokemon = request['side']['pokemon']
+        for i, backpokemon in enumerate(side_pokemon):  # 手持ちの全ポケモン
+            party_idx = self._party_idx(backpokemon['ident'])
+            if backpokemon['active']:
+                # 場に出ている
+                active_poke_idx = party_idx
+                continue
+            if backpokemon['condition'].endswith(' fnt'):
+                # 瀕死状態
+                continue
+            if not trapped:
+                # モデル上ではパーティ構築上のインデックス、行動の文字列では今出ているポケモンを先頭としたインデックス
+                choice_idxs.append(party_idx * 6 + (5 if force_switch else 4))
+                choice_keys.append(SWITCH_KEYS[i])
+        assert active_poke_idx is not None
+        if not force_switch:
+            for i, move in enumerate(active[0]['moves']):
+                if not move.get('disabled'):
+                    choice_idxs.append(active_poke_idx * 6 + i)
+                    choice_keys.append(MOVE_KEYS[i])
+        assert len(choice_idxs) > 0
+        vec = self._vec
+        if vec.shape[0] != len(side_pokemon) * 6:
+            vec = np.zeros((len(side_pokemon) * 6,), dtype=np.float32)
+        else:
+            vec.fill(0.0)
+        vec[choice_idxs] = 1.0
+        return choice_idxs, choice_keys, vec
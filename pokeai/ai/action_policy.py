@@ -1,6 +1,9 @@
 """
 行動選択AIのベースクラス
+AsyncSimで使う場合、choice_turn_start, choice_force_switch, game_endはcoroutine(async def)として実装してもよい
 """
+from typing import Optional
+
 from pokeai.ai.battle_status import BattleStatus
 
 
@@ -10,6 +13,15 @@ class ActionPolicy:
     def __init__(self):
         self.train = False
 
+    def init_battle_status(self, battle_status: BattleStatus):
+        """
+        バトル開始時、最初のメッセージを処理する前に呼び出される
+        特徴量のバッファなど、バトル中に差分更新する情報をBattleStatusに持たせる場合に実装する
+        :param battle_status:
+        :return:
+        """
+        pass
+
     def choice_turn_start(self, battle_status: BattleStatus, request: dict) -> str:
         """
         ターン開始時の行動選択
@@ -35,3 +47,27 @@ class ActionPolicy:
         :return:
         """
         pass
+
+    def fingerprint(self) -> Optional[str]:
+        """
+        方策の内容を表す文字列(バトル結果のキャッシュのキーに用いる)
+        同じ状態・同じBattleStatus.rngに対し常に同じ行動を選ぶ方策のみ返すこと
+        :return: 決定的でない方策(学習中など)はNone
+        """
+        return None
+
+    def simple_spec(self) -> Optional[dict]:
+        """
+        シミュレータ内で実行できる単純な方策であれば、その内容を返す(js/simpipe.jsの>simplebattle参照)
+        両プレイヤーがこれを返すバトルはシミュレータ内で行動選択まで行い、choice_*は呼び出されない(game_endは呼び出される)。
+        :return: {'type': 'random', 'switchProb': 0.2} など。シミュレータ内で実行できない方策はNone
+        """
+        return None
+
+    def game_abort(self):
+        """
+        シミュレータの異常によりゲームが中断されたときに呼び出される
+        同じパーティでゲームが最初からやり直される
+        :return:
+        """
+        pass
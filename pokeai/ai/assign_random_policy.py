@@ -16,7 +16,7 @@ def main():
     args = parser.parse_args()
     tags = args.tags.split(",") if args.tags else []
     agent_docs = []
-    for party_doc in col_party.find({'tags': args.party_tag}):  # tagsのうち、いずれかが一致すれば良い
+    for party_doc in col_party().find({'tags': args.party_tag}):  # tagsのうち、いずれかが一致すれば良い
         policy = RandomPolicy()
         agent_docs.append({
             '_id': ObjectId(),
@@ -24,7 +24,7 @@ def main():
             'policy_packed': pack_obj(policy),
             'tags': tags
         })
-    col_agent.insert_many(agent_docs)
+    col_agent().insert_many(agent_docs)
 
 
 if __name__ == '__main__':
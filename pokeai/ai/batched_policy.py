@@ -0,0 +1,165 @@
+"""
+RLPolicyの行動選択を、同時に進行している複数のバトルでまとめて計算する方策
+AsyncSim(AsyncSimPool)で多数のバトルを並行させる評価用。
+モデルが小さく、1回のforwardの固定費用が支配的なため、同じモデルを用いる全バトルの観測をまとめて1回のforwardで計算する。
+1つの方策が同時に多数のバトルを行う場合(GAの適応度評価で、対戦相手が全候補と同時に対戦するなど)に効果がある。
+"""
+import asyncio
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from pokeai.ai.action_policy import ActionPolicy
+from pokeai.ai.battle_status import BattleStatus
+from pokeai.ai.common import get_possible_actions
+from pokeai.ai.rl_policy import RLPolicy, choose_action
+
+
+class InferenceServer:
+    """
+    同じモデルに対する観測をまとめて計算する
+    モデルごとの待ち行列に観測を入れ、max_batch個たまるか、最初の観測からmax_wait_usマイクロ秒経過した時点で
+    方策モデル(pi)のforwardを1回行い、各バトルに行動を返す。
+    モデルは方策のfingerprint(パラメータのハッシュ)で識別するため、同じエージェントを別々にロードした方策もまとめて計算する。
+    同じイベントループ上でのみ使うこと。
+    """
+    max_batch: int
+    max_wait_us: int
+    n_forward: int  # forwardの回数
+    n_inferred: int  # 行動を計算した観測の数
+
+    def __init__(self, max_batch: int = 64, max_wait_us: int = 500):
+        """
+        :param max_batch: 1回のforwardで計算する観測の最大数
+        :param max_wait_us: 観測がmax_batch個たまらない場合に、最初の観測から待つ最大時間(マイクロ秒)
+        """
+        self.max_batch = max_batch
+        self.max_wait_us = max_wait_us
+        self.n_forward = 0
+        self.n_inferred = 0
+        # モデルのキー => (観測, 行動選択の乱数, 結果を返すfuture, 計測)のリスト
+        self._pending: Dict[str, List[Tuple[np.ndarray, object, asyncio.Future, Optional["SimStats"]]]] = {}
+        self._flush_handles: Dict[str, asyncio.TimerHandle] = {}
+
+    def wrap(self, policy: RLPolicy) -> "BatchedRLPolicy":
+        """
+        方策をこのサーバで行動を計算する方策に変換する
+        :param policy: 学習済みの方策
+        :return:
+        """
+        return BatchedRLPolicy(policy, self)
+
+    def mean_batch_size(self) -> float:
+        return self.n_inferred / self.n_forward if self.n_forward > 0 else 0.0
+
+    def infer(self, key: str, policy: RLPolicy, feat: np.ndarray, rng,
+              stats: Optional["SimStats"]) -> asyncio.Future:
+        """
+        観測を待ち行列に入れる
+        :param key: モデルのキー。同じキーの方策は同じモデルであること。
+        :param policy: 方策
+        :param feat: 特徴量
+        :param rng: 行動のサンプリングに用いる乱数(BattleStatus.rng)
+        :param stats: バトルの計測
+        :return: 行動の番号を返すfuture
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = self._pending.setdefault(key, [])
+        pending.append((feat, rng, future, stats))
+        if len(pending) >= self.max_batch:
+            self._flush(key, policy)
+        elif key not in self._flush_handles:
+            self._flush_handles[key] = loop.call_later(self.max_wait_us / 1e6, self._flush, key, policy)
+        return future
+
+    def _flush(self, key: str, policy: RLPolicy):
+        flush_handle = self._flush_handles.pop(key, None)
+        if flush_handle is not None:
+            flush_handle.cancel()
+        pending = self._pending.pop(key, [])
+        if len(pending) == 0:
+            return
+        time_start = time.perf_counter()
+        try:
+            probs = self._forward(policy, np.stack([feat for feat, _, _, _ in pending]))
+        except Exception as ex:
+            for _, _, future, _ in pending:
+                if not future.done():
+                    future.set_exception(ex)
+            return
+        elapsed = time.perf_counter() - time_start
+        deterministic = getattr(policy.agent, 'act_deterministically', False)
+        for (_, rng, future, stats), action_probs in zip(pending, probs):
+            if stats is not None:
+                # バッチの計算時間を観測数で按分する
+                stats.add_time('model', elapsed / len(pending))
+            if not future.done():
+                # RLPolicyと同じ方法で選ぶため、バッチにしない場合と同じ行動となる
+                future.set_result(choose_action(action_probs, rng, deterministic))
+
+    def _forward(self, policy: RLPolicy, feats: np.ndarray) -> np.ndarray:
+        """
+        方策モデルのforwardをまとめて行う
+        :param policy: 方策
+        :param feats: (N, 特徴次元数)
+        :return: (N, 行動数) 各行動の確率
+        """
+        import chainer
+        self.n_forward += 1
+        self.n_inferred += feats.shape[0]
+        with chainer.using_config('train', False), chainer.no_backprop_mode():
+            action_distrib = policy.agent.model.pi(feats)
+            return chainer.backends.cuda.to_cpu(action_distrib.all_prob.array)
+
+
+class BatchedRLPolicy(ActionPolicy):
+    """
+    RLPolicyをラップし、choice_*をcoroutineとする
+    行動はInferenceServerで、同じモデルを用いる他のバトルの観測とまとめて計算する。
+    学習には対応しない(評価用)。
+    """
+    policy: RLPolicy
+    server: InferenceServer
+
+    def __init__(self, policy: RLPolicy, server: InferenceServer):
+        """
+        :param policy: 学習済みの方策
+        :param server: 行動を計算するサーバ
+        """
+        super().__init__()
+        assert not policy.train, "BatchedRLPolicy does not support training"
+        self.policy = policy
+        self.server = server
+        self._key = policy.fingerprint()
+
+    def init_battle_status(self, battle_status: BattleStatus):
+        self.policy.init_battle_status(battle_status)
+
+    async def choice_turn_start(self, battle_status: BattleStatus, request: dict) -> str:
+        return await self._choice(battle_status, request)
+
+    async def choice_force_switch(self, battle_status: BattleStatus, request: dict) -> str:
+        return await self._choice(battle_status, request)
+
+    async def _choice(self, battle_status: BattleStatus, request: dict) -> str:
+        choice_idxs, choice_keys, choice_vec = get_possible_actions(battle_status, request)
+        if len(choice_idxs) == 1:
+            return choice_keys[0]
+        feat = self.policy.feature_extractor.transform(battle_status, choice_vec)
+        action = await self.server.infer(self._key, self.policy, feat, battle_status.rng, battle_status.stats)
+        for idx, key in zip(choice_idxs, choice_keys):
+            if idx == action:
+                return key
+        raise ValueError(f"action number {action} is not valid choice.")
+
+    def game_end(self, reward: float):
+        self.policy.game_end(reward)
+
+    def game_abort(self):
+        self.policy.game_abort()
+
+    def fingerprint(self) -> Optional[str]:
+        # 行動はRLPolicyと同じくBattleStatus.rngから選ぶため、結果のキャッシュを共有できる
+        return self._key
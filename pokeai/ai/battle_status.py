@@ -1,13 +1,21 @@
 """
 バトルの状態を表すオブジェクト
 あるプレイヤーから見た状態を管理する
+探索やデータセット生成で大量に保持するため、__slots__のクラスとし、ランク補正はint8配列、状態変化・場の状態はビットマスクで持つ。
+複製はcopy()で行う。
 """
+import array
+import copy
 import json
+import random
 import re
-from typing import Dict, Set, Optional, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 from pokeai.sim.party_generator import Party
 
+_HP_CONDITION_RE = re.compile('^(\\d+)/(\\d+)(?: (psn|tox|par|brn|slp|frz|fnt)|)?$')
+_DETAILS_RE = re.compile('^([A-Za-z-]+|Porygon2|Mr\\. Mime|Farfetch\'d), L(\\d+)(?:, (M|F|N))?$')
+
 
 def parse_hp_condition(hp_condition: str) -> Tuple[int, int, str]:
     """
@@ -19,29 +27,177 @@ def parse_hp_condition(hp_condition: str) -> Tuple[int, int, str]:
         # 瀕死の時は0という表示になっている
         # 便宜上最大HP100として返している
         return 0, 100, 'fnt'
-    m = re.match('^(\\d+)/(\\d+)(?: (psn|tox|par|brn|slp|frz|fnt)|)?$', hp_condition)
+    m = _HP_CONDITION_RE.match(hp_condition)
     assert m is not None, f"HP_CONDITION '{hp_condition}' cannot be parsed."
     # m[3]は状態異常がないときNoneとなる
     return int(m[1]), int(m[2]), m[3] or ''
 
 
-def _parse_details(details: str) -> Tuple[str, int, str]:
+def parse_details(details: str) -> Tuple[str, int, str]:
     """
     ポケモンの情報をパース
     :param details: 種族名・レベル・性別情報　例:'Ninetales, L50, M'
     :return:
     """
     # 例外的な種族名 'Nidoran-F', 'Porygon2', 'Mr. Mime', "Farfetch'd"
-    m = re.match('^([A-Za-z-]+|Porygon2|Mr\\. Mime|Farfetch\'d), L(\\d+)(?:, (M|F|N))?$', details)
+    m = _DETAILS_RE.match(details)
     assert m is not None, f"DETAILS '{details}' cannot be parsed."
     # 性別不明だとm[3]はNone
     return m[1], int(m[2]), m[3] or 'N'
 
 
+RANK_NAMES = ('atk', 'def', 'spa', 'spd', 'spe', 'accuracy', 'evasion')
+_RANK2IDX = {name: i for i, name in enumerate(RANK_NAMES)}
+
+
+class Ranks:
+    """
+    ランク補正(int8の配列)
+    Dict[str, int]と同様に ranks['atk'] で参照・代入できる
+    """
+    __slots__ = ('_values',)
+    _values: array.array
+
+    def __init__(self, values: Optional[array.array] = None):
+        self._values = values if values is not None else array.array('b', bytes(len(RANK_NAMES)))
+
+    def __getitem__(self, stat: str) -> int:
+        return self._values[_RANK2IDX[stat]]
+
+    def __setitem__(self, stat: str, value: int):
+        self._values[_RANK2IDX[stat]] = value
+
+    def __contains__(self, stat: str) -> bool:
+        return stat in _RANK2IDX
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(RANK_NAMES)
+
+    def __len__(self) -> int:
+        return len(RANK_NAMES)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, Ranks):
+            return self._values == other._values
+        return dict(self.items()) == other
+
+    def keys(self) -> Tuple[str, ...]:
+        return RANK_NAMES
+
+    def values(self) -> List[int]:
+        return self._values.tolist()
+
+    def items(self) -> Iterator[Tuple[str, int]]:
+        return zip(RANK_NAMES, self._values)
+
+    def clear(self):
+        # 全て0にする
+        for i in range(len(self._values)):
+            self._values[i] = 0
+
+    def copy(self) -> "Ranks":
+        return Ranks(self._values[:])
+
+    def to_dict(self) -> Dict[str, int]:
+        return dict(self.items())
+
+    def __getstate__(self):
+        return self._values.tobytes()
+
+    def __setstate__(self, state):
+        self._values = array.array('b', state)
+
+    def __repr__(self):
+        return f"Ranks({self.to_dict()!r})"
+
+
+# FlagSetの要素名 <=> ビット位置。プロセス内で初出順に割り当てる(pickle時は名前で保存するため、プロセス間で異なってよい)
+_FLAG_BITS = {}  # type: Dict[str, int]
+_FLAG_NAMES = []  # type: List[str]
+
+
+def _flag_bit(name: str) -> int:
+    bit = _FLAG_BITS.get(name)
+    if bit is None:
+        bit = 1 << len(_FLAG_NAMES)
+        _FLAG_BITS[name] = bit
+        _FLAG_NAMES.append(name)
+    return bit
+
+
+class FlagSet:
+    """
+    状態変化・場の状態の集合(ビットマスク)
+    Set[str]と同様に add, discard, remove, in で操作できる
+    """
+    __slots__ = ('mask',)
+    mask: int
+
+    def __init__(self, names: Iterable[str] = ()):
+        self.mask = 0
+        for name in names:
+            self.mask |= _flag_bit(name)
+
+    def add(self, name: str):
+        self.mask |= _flag_bit(name)
+
+    def discard(self, name: str):
+        self.mask &= ~_flag_bit(name)
+
+    def remove(self, name: str):
+        bit = _flag_bit(name)
+        if not self.mask & bit:
+            raise KeyError(name)
+        self.mask &= ~bit
+
+    def clear(self):
+        self.mask = 0
+
+    def __contains__(self, name: str) -> bool:
+        bit = _FLAG_BITS.get(name)
+        return bit is not None and bool(self.mask & bit)
+
+    def __iter__(self) -> Iterator[str]:
+        mask = self.mask
+        i = 0
+        while mask:
+            if mask & 1:
+                yield _FLAG_NAMES[i]
+            mask >>= 1
+            i += 1
+
+    def __len__(self) -> int:
+        return bin(self.mask).count('1')
+
+    def __bool__(self) -> bool:
+        return self.mask != 0
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, FlagSet):
+            return self.mask == other.mask
+        return set(self) == other
+
+    def copy(self) -> "FlagSet":
+        flag_set = FlagSet.__new__(FlagSet)
+        flag_set.mask = self.mask
+        return flag_set
+
+    def __getstate__(self):
+        return list(self)
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    def __repr__(self):
+        return f"FlagSet({list(self)!r})"
+
+
 class ActivePokeStatus:
     """
     場に出ているポケモンの状態
     """
+    __slots__ = ('pokemon', 'species', 'level', 'gender', 'hp_current', 'hp_max', 'status', 'ranks',
+                 'volatile_statuses')
     RANK_INITIAL = {'atk': 0, 'def': 0, 'spa': 0, 'spd': 0, 'spe': 0, 'accuracy': 0, 'evasion': 0}
     RANK_MAX = 6
     RANK_MIN = -6
@@ -53,8 +209,8 @@ class ActivePokeStatus:
     hp_current: int
     hp_max: int
     status: str  # 状態異常 (異常がない時は'')
-    ranks: Dict[str, int]
-    volatile_statuses: Set[str]  # 状態変化
+    ranks: Ranks
+    volatile_statuses: FlagSet  # 状態変化
 
     def __init__(self, pokemon: str, species: str, level: int, gender: str, hp_current: int, hp_max: int, status: str):
         """
@@ -65,6 +221,14 @@ class ActivePokeStatus:
         :param hp_max:
         :param status:
         """
+        self.ranks = Ranks()
+        self.volatile_statuses = FlagSet()
+        self.reset(pokemon, species, level, gender, hp_current, hp_max, status)
+
+    def reset(self, pokemon: str, species: str, level: int, gender: str, hp_current: int, hp_max: int, status: str):
+        """
+        交換で場に出たポケモンの状態に置き換える(オブジェクトを再利用する)
+        """
         self.pokemon = pokemon
         self.species = species
         self.level = level
@@ -72,8 +236,8 @@ class ActivePokeStatus:
         self.hp_current = hp_current
         self.hp_max = hp_max
         self.status = status
-        self.ranks = ActivePokeStatus.RANK_INITIAL.copy()
-        self.volatile_statuses = set()
+        self.ranks.clear()
+        self.volatile_statuses.clear()
 
     def rank_boost(self, stat: str, amount: int):
         self._rank_set_clip(stat, self.ranks[stat] + amount)
@@ -89,16 +253,34 @@ class ActivePokeStatus:
         self.ranks[stat] = min(max(value, ActivePokeStatus.RANK_MIN), ActivePokeStatus.RANK_MAX)
 
     def rank_clearallboost(self):
-        for stat in self.ranks.keys():
-            self.ranks[stat] = ActivePokeStatus.RANK_ZERO
+        self.ranks.clear()
+
+    def copy(self) -> "ActivePokeStatus":
+        active = ActivePokeStatus.__new__(ActivePokeStatus)
+        active.pokemon = self.pokemon
+        active.species = self.species
+        active.level = self.level
+        active.gender = self.gender
+        active.hp_current = self.hp_current
+        active.hp_max = self.hp_max
+        active.status = self.status
+        active.ranks = self.ranks.copy()
+        active.volatile_statuses = self.volatile_statuses.copy()
+        return active
+
+    def to_dict(self) -> dict:
+        return {'pokemon': self.pokemon, 'species': self.species, 'level': self.level, 'gender': self.gender,
+                'hp_current': self.hp_current, 'hp_max': self.hp_max, 'status': self.status,
+                'ranks': self.ranks.to_dict(), 'volatile_statuses': list(self.volatile_statuses)}
 
 
 class SideStatus:
     """
     一方のプレイヤーの状態
     """
+    __slots__ = ('active', 'side_statuses', 'total_pokes', 'remaining_pokes')
     active: Optional[ActivePokeStatus]
-    side_statuses: Set[str]  # プレイヤーの場の状態
+    side_statuses: FlagSet  # プレイヤーの場の状態
     total_pokes: int  # 全手持ちポケモン数
     remaining_pokes: int  # 残っているポケモン数
 
@@ -107,7 +289,7 @@ class SideStatus:
         バトル開始時の状態を生成する
         """
         self.active = None
-        self.side_statuses = set()
+        self.side_statuses = FlagSet()
         self.total_pokes = 0
         self.remaining_pokes = 0
 
@@ -119,8 +301,23 @@ class SideStatus:
         """
         self.active = active
 
+    def copy(self) -> "SideStatus":
+        side_status = SideStatus.__new__(SideStatus)
+        side_status.active = self.active.copy() if self.active is not None else None
+        side_status.side_statuses = self.side_statuses.copy()
+        side_status.total_pokes = self.total_pokes
+        side_status.remaining_pokes = self.remaining_pokes
+        return side_status
+
+    def to_dict(self) -> dict:
+        return {'active': self.active.to_dict() if self.active is not None else None,
+                'side_statuses': list(self.side_statuses),
+                'total_pokes': self.total_pokes, 'remaining_pokes': self.remaining_pokes}
+
 
 class BattleStatus:
+    __slots__ = ('turn', 'side_friend', 'side_opponent', 'side_party', 'weather', 'side_statuses', 'rng',
+                 'battle_ref', 'stats', 'feature_buffer', 'action_mapper')
     WEATHER_NONE = 'none'
     turn: int  # ターン番号(最初が0)
     side_friend: str  # 自分側のside ('p1' or 'p2')
@@ -128,8 +325,13 @@ class BattleStatus:
     side_party: Party  # 自分側のパーティ
     weather: str  # 天候（なしの時はWEATHER_NONE='none'）
     side_statuses: Dict[str, SideStatus]  # key: 'p1' or 'p2'
+    rng: random.Random  # 方策が用いる乱数。バトルのシードから決まるため、これを使う方策はバトルを再現できる。
+    battle_ref: Optional["BattleRef"]  # シミュレータ上のバトルの参照(探索を行う方策用)。Simで進行する場合のみ。
+    stats: Optional["SimStats"]  # 計測が有効な場合、方策内の処理時間を記録する
+    feature_buffer: Optional["FeatureBuffer"]  # 差分更新する特徴量(FeatureExtractor.attach_buffer)。使わない場合はNone
+    action_mapper: Optional["ActionMapper"]  # 取れる行動を求めるための事前計算(BattleStreamProcessor.start_battleで生成)
 
-    def __init__(self, side_friend: str, side_party: Party):
+    def __init__(self, side_friend: str, side_party: Party, rng_seed=None):
         assert side_friend in ['p1', 'p2']
         self.side_friend = side_friend
         self.side_opponent = {'p1': 'p2', 'p2': 'p1'}[side_friend]
@@ -137,22 +339,55 @@ class BattleStatus:
         self.turn = 0
         self.weather = BattleStatus.WEATHER_NONE
         self.side_statuses = {'p1': SideStatus(), 'p2': SideStatus()}
+        self.rng = random.Random(rng_seed)
+        self.battle_ref = None
+        self.stats = None
+        self.feature_buffer = None
+        self.action_mapper = None
 
-    def switch(self, pokemon: str, details: str, hp_condition: str):
-        side = pokemon[:2]
-        species, level, gender = _parse_details(details)
-        hp_current, hp_max, status = parse_hp_condition(hp_condition)
-        poke = ActivePokeStatus(pokemon, species, level, gender, hp_current, hp_max, status)
-        self.side_statuses[side].switch(poke)
+    def switch(self, pokemon: str, details: Tuple[str, int, str], hp_condition: Tuple[int, int, str]):
+        """
+        ポケモンを交換、またはゲームの最初に繰り出す
+        :param pokemon: 'p1a: Ninetales'
+        :param details: parse_detailsの結果
+        :param hp_condition: parse_hp_conditionの結果
+        :return:
+        """
+        side_status = self.side_statuses[pokemon[:2]]
+        species, level, gender = details
+        hp_current, hp_max, status = hp_condition
+        if side_status.active is not None:
+            # 場にいたポケモンのオブジェクトを再利用する(copy()した状態とは共有されない)
+            side_status.active.reset(pokemon, species, level, gender, hp_current, hp_max, status)
+        else:
+            side_status.switch(ActivePokeStatus(pokemon, species, level, gender, hp_current, hp_max, status))
 
     def get_side(self, pokemon: str) -> SideStatus:
         return self.side_statuses[pokemon[:2]]
 
-    def json_dumps(self) -> str:
-        def default(obj):
-            if isinstance(obj, set):
-                return list(obj)
-            else:
-                return obj.__dict__
+    def copy(self) -> "BattleStatus":
+        """
+        探索・データセット生成用の複製
+        side_party, battle_ref, stats, action_mapperは共有し、乱数の状態と特徴量のバッファは複製する
+        """
+        battle_status = BattleStatus.__new__(BattleStatus)
+        battle_status.turn = self.turn
+        battle_status.side_friend = self.side_friend
+        battle_status.side_opponent = self.side_opponent
+        battle_status.side_party = self.side_party
+        battle_status.weather = self.weather
+        battle_status.side_statuses = {side: side_status.copy() for side, side_status in self.side_statuses.items()}
+        battle_status.rng = copy.copy(self.rng)
+        battle_status.battle_ref = self.battle_ref
+        battle_status.stats = self.stats
+        battle_status.feature_buffer = self.feature_buffer.copy() if self.feature_buffer is not None else None
+        battle_status.action_mapper = self.action_mapper
+        return battle_status
+
+    def to_dict(self) -> dict:
+        return {'turn': self.turn, 'side_friend': self.side_friend, 'side_opponent': self.side_opponent,
+                'side_party': self.side_party, 'weather': self.weather,
+                'side_statuses': {side: side_status.to_dict() for side, side_status in self.side_statuses.items()}}
 
-        return json.dumps(self, default=default)
+    def json_dumps(self) -> str:
+        return json.dumps(self.to_dict())
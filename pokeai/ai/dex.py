@@ -1,14 +1,187 @@
+from typing import Dict, List, Optional
+
+import numpy as np
+
 from pokeai.util import DATASET_DIR, json_load
 
+_dex = None  # type: Optional[Dex]
+
+POKE_TYPES = [
+    "Normal",
+    "Fighting",
+    "Flying",
+    "Poison",
+    "Ground",
+    "Rock",
+    "Bug",
+    "Ghost",
+    "Steel",
+    "Fire",
+    "Water",
+    "Grass",
+    "Electric",
+    "Psychic",
+    "Ice",
+    "Dragon",
+    "Dark"
+]
+
+POKE_TYPE2NUM = {t: i for i, t in enumerate(POKE_TYPES)}
+BASE_STATS = ['hp', 'atk', 'def', 'spa', 'spd', 'spe']
+# 第2世代では技の分類(物理・特殊)はタイプで決まる
+SPECIAL_TYPES = {"Fire", "Water", "Grass", "Electric", "Psychic", "Ice", "Dragon", "Dark"}
+MOVE_CATEGORIES = ['Physical', 'Special', 'Status']
+
+
+def _build_type_chart() -> np.ndarray:
+    """
+    第2世代のタイプ相性表
+    :return: [攻撃側のタイプ, 防御側のタイプ] => 倍率
+    """
+    # 攻撃側のタイプ: {防御側のタイプ: 倍率} (1倍は省略)
+    effectiveness = {
+        "Normal": {"Rock": 0.5, "Steel": 0.5, "Ghost": 0.0},
+        "Fighting": {"Normal": 2.0, "Ice": 2.0, "Rock": 2.0, "Dark": 2.0, "Steel": 2.0,
+                     "Poison": 0.5, "Flying": 0.5, "Psychic": 0.5, "Bug": 0.5, "Ghost": 0.0},
+        "Flying": {"Grass": 2.0, "Fighting": 2.0, "Bug": 2.0, "Electric": 0.5, "Rock": 0.5, "Steel": 0.5},
+        "Poison": {"Grass": 2.0, "Poison": 0.5, "Ground": 0.5, "Rock": 0.5, "Ghost": 0.5, "Steel": 0.0},
+        "Ground": {"Fire": 2.0, "Electric": 2.0, "Poison": 2.0, "Rock": 2.0, "Steel": 2.0,
+                   "Grass": 0.5, "Bug": 0.5, "Flying": 0.0},
+        "Rock": {"Fire": 2.0, "Ice": 2.0, "Flying": 2.0, "Bug": 2.0, "Fighting": 0.5, "Ground": 0.5, "Steel": 0.5},
+        "Bug": {"Grass": 2.0, "Psychic": 2.0, "Dark": 2.0,
+                "Fire": 0.5, "Fighting": 0.5, "Poison": 0.5, "Flying": 0.5, "Ghost": 0.5, "Steel": 0.5},
+        "Ghost": {"Psychic": 2.0, "Ghost": 2.0, "Dark": 0.5, "Steel": 0.5, "Normal": 0.0},
+        "Steel": {"Ice": 2.0, "Rock": 2.0, "Fire": 0.5, "Water": 0.5, "Electric": 0.5, "Steel": 0.5},
+        "Fire": {"Grass": 2.0, "Ice": 2.0, "Bug": 2.0, "Steel": 2.0, "Fire": 0.5, "Water": 0.5, "Rock": 0.5,
+                 "Dragon": 0.5},
+        "Water": {"Fire": 2.0, "Ground": 2.0, "Rock": 2.0, "Water": 0.5, "Grass": 0.5, "Dragon": 0.5},
+        "Grass": {"Water": 2.0, "Ground": 2.0, "Rock": 2.0, "Fire": 0.5, "Grass": 0.5, "Poison": 0.5,
+                  "Flying": 0.5, "Bug": 0.5, "Dragon": 0.5, "Steel": 0.5},
+        "Electric": {"Water": 2.0, "Flying": 2.0, "Electric": 0.5, "Grass": 0.5, "Dragon": 0.5, "Ground": 0.0},
+        "Psychic": {"Fighting": 2.0, "Poison": 2.0, "Psychic": 0.5, "Steel": 0.5, "Dark": 0.0},
+        "Ice": {"Grass": 2.0, "Ground": 2.0, "Flying": 2.0, "Dragon": 2.0, "Fire": 0.5, "Water": 0.5, "Ice": 0.5,
+                "Steel": 0.5},
+        "Dragon": {"Dragon": 2.0, "Steel": 0.5},
+        "Dark": {"Psychic": 2.0, "Ghost": 2.0, "Fighting": 0.5, "Dark": 0.5, "Steel": 0.5},
+    }
+    chart = np.ones((len(POKE_TYPES), len(POKE_TYPES)), dtype=np.float32)
+    for attack_type, row in effectiveness.items():
+        for defense_type, multiplier in row.items():
+            chart[POKE_TYPE2NUM[attack_type], POKE_TYPE2NUM[defense_type]] = multiplier
+    return chart
+
+
+TYPE_CHART = _build_type_chart()  # type: np.ndarray
+
 
 class Dex:
     """
     ポケモン等の基本情報を提供するデータベースクラス
     """
 
+    species_ids: List[str]  # テーブルの行に対応するポケモンのID
+    species_types: np.ndarray  # [ポケモン, タイプ] => タイプを持つなら1
+    species_type_idxs: np.ndarray  # [ポケモン, 0 or 1] => タイプの番号(単タイプの場合、2番目はlen(POKE_TYPES))
+    base_stats: np.ndarray  # [ポケモン, BASE_STATS] => 種族値
+    type_vs_species: np.ndarray  # [攻撃側のタイプ, 防御側のポケモン] => 倍率(タイプの番号len(POKE_TYPES)の行は0)
+
     def __init__(self):
         self._pokedex = json_load(DATASET_DIR.joinpath('pokedex.json'))
         self._poke2id = {v['name']: k for k, v in self._pokedex.items()}
+        self._build_species_tables()
+        self._movedex = None  # type: Optional[dict]
+
+    def _build_species_tables(self):
+        self.species_ids = list(self._pokedex.keys())
+        self._species_id2idx = {poke_id: i for i, poke_id in enumerate(self.species_ids)}
+        self._species_name2idx = {self._pokedex[poke_id]['name']: i for i, poke_id in enumerate(self.species_ids)}
+        n_species = len(self.species_ids)
+        self.species_types = np.zeros((n_species, len(POKE_TYPES)), dtype=np.float32)
+        self.species_type_idxs = np.full((n_species, 2), len(POKE_TYPES), dtype=np.int64)
+        self.base_stats = np.zeros((n_species, len(BASE_STATS)), dtype=np.float32)
+        for i, poke_id in enumerate(self.species_ids):
+            info = self._pokedex[poke_id]
+            for j, poke_type in enumerate(info['types']):
+                self.species_types[i, POKE_TYPE2NUM[poke_type]] = 1.0
+                self.species_type_idxs[i, j] = POKE_TYPE2NUM[poke_type]
+            self.base_stats[i] = [info['baseStats'][stat] for stat in BASE_STATS]
+        self.type_vs_species = np.zeros((len(POKE_TYPES) + 1, n_species), dtype=np.float32)
+        for i in range(n_species):
+            type_idxs = [t for t in self.species_type_idxs[i] if t < len(POKE_TYPES)]
+            self.type_vs_species[:len(POKE_TYPES), i] = np.prod(TYPE_CHART[:, type_idxs], axis=1)
+
+    def species_index(self, name: str) -> int:
+        """
+        ポケモン名からテーブルの行番号を得る
+        :param name: ポケモン名　例：'Nidoran-F'
+        :return:
+        """
+        return self._species_name2idx[name]
+
+    def species_index_by_id(self, poke_id: str) -> int:
+        return self._species_id2idx[poke_id]
+
+    def _load_movedex(self):
+        path = DATASET_DIR.joinpath('movedex.json')
+        if not path.exists():
+            raise FileNotFoundError(f"{path} does not exist. "
+                                    f"Rebuild it by 'node js/tools/enumerate_movedex.js > data/dataset/movedex.json'")
+        self._movedex = json_load(path)
+        self.move_ids = list(self._movedex.keys())
+        self._move_id2idx = {move_id: i for i, move_id in enumerate(self.move_ids)}
+        n_moves = len(self.move_ids)
+        self._move_types = np.zeros((n_moves,), dtype=np.int64)
+        self._move_powers = np.zeros((n_moves,), dtype=np.float32)
+        self._move_categories = np.zeros((n_moves,), dtype=np.int64)
+        for i, move_id in enumerate(self.move_ids):
+            info = self._movedex[move_id]
+            self._move_types[i] = POKE_TYPE2NUM.get(info['type'], POKE_TYPE2NUM['Normal'])  # '???'(わるあがき)など
+            self._move_powers[i] = info['basePower']
+            if info['category'] == 'Status':
+                category = 'Status'
+            else:
+                category = 'Special' if info['type'] in SPECIAL_TYPES else 'Physical'
+            self._move_categories[i] = MOVE_CATEGORIES.index(category)
+
+    @property
+    def move_types(self) -> np.ndarray:
+        """
+        [技] => タイプの番号
+        """
+        if self._movedex is None:
+            self._load_movedex()
+        return self._move_types
+
+    @property
+    def move_powers(self) -> np.ndarray:
+        """
+        [技] => 威力(変化技・固定ダメージ技は0)
+        """
+        if self._movedex is None:
+            self._load_movedex()
+        return self._move_powers
+
+    @property
+    def move_categories(self) -> np.ndarray:
+        """
+        [技] => MOVE_CATEGORIESの番号
+        """
+        if self._movedex is None:
+            self._load_movedex()
+        return self._move_categories
+
+    def move_index(self, move_id: str) -> int:
+        """
+        技のIDからテーブルの行番号を得る
+        :param move_id: 'thunderbolt'。requestに含まれる'return102'のような威力付きのIDも可
+        :return: 不明な技の場合は-1
+        """
+        if self._movedex is None:
+            self._load_movedex()
+        idx = self._move_id2idx.get(move_id)
+        if idx is None:
+            idx = self._move_id2idx.get(move_id.rstrip('0123456789'), -1)
+        return idx
 
     def get_pokedex_by_name(self, name: str) -> dict:
         """
@@ -18,6 +191,24 @@ class Dex:
         """
         return self._pokedex[self._poke2id[name]]
 
+    def get_pokedex_by_id(self, poke_id: str) -> dict:
+        """
+        ポケモンのIDからポケモン情報を得る
+        :param poke_id: パーティのspeciesに入っているID　例：'nidoranf'
+        :return:
+        """
+        return self._pokedex[poke_id]
+
+
+def get_dex() -> Dex:
+    """
+    Dexのインスタンスを返す。初回呼び出し時にpokedex.jsonを読み込む。
+    """
+    global _dex
+    if _dex is None:
+        _dex = Dex()
+    return _dex
+
 
 """
 pokedex.json:
@@ -99,5 +290,3 @@ pokedex.json:
     "eventOnly": false
   },
 """
-
-dex = Dex()
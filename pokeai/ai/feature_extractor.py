@@ -1,35 +1,83 @@
-from typing import List, Optional
+import copy
+from typing import Dict, List, Optional, Sequence, Union
 
 import numpy as np
 
-from pokeai.ai.battle_status import BattleStatus
-from pokeai.ai.dex import dex
-
-POKE_TYPES = [
-    "Normal",
-    "Fighting",
-    "Flying",
-    "Poison",
-    "Ground",
-    "Rock",
-    "Bug",
-    "Ghost",
-    "Steel",
-    "Fire",
-    "Water",
-    "Grass",
-    "Electric",
-    "Psychic",
-    "Ice",
-    "Dragon",
-    "Dark"
-]
-
-POKE_TYPE2NUM = {t: i for i, t in enumerate(POKE_TYPES)}
+from pokeai.ai.battle_status import BattleStatus, ActivePokeStatus, SideStatus
+from pokeai.sim.party_generator import Party
+from pokeai.ai.dex import get_dex, POKE_TYPES, POKE_TYPE2NUM
 
 NV_CONDITIONS = ["psn", "tox", "par", "brn", "slp", "frz"]
+NV_CONDITION2NUM = {c: i for i, c in enumerate(NV_CONDITIONS)}
 RANKS = ['atk', 'def', 'spa', 'spd', 'spe', 'accuracy', 'evasion']
+RANK2NUM = {r: i for i, r in enumerate(RANKS)}
 WEATHERS = ["SunnyDay", "RainDance", "Sandstorm"]
+WEATHER2NUM = {w: i for i, w in enumerate(WEATHERS)}
+
+# matchup: 自分の各技の相手への相性・威力、素早さの比較、相手のタイプの技の自分への相性
+MATCHUP_MOVES = 4
+MATCHUP_DIMS = MATCHUP_MOVES * 2 + 2
+MATCHUP_POWER_SCALE = 150.0 * 1.5 * 4.0  # 威力150, タイプ一致, 4倍
+
+
+def poke_type_vec(species: str) -> np.ndarray:
+    """
+    ポケモンのタイプを表すベクトル(Dexのテーブルの行。書き換えないこと)
+    :param species: 種族名　例：'Ninetales'
+    :return:
+    """
+    dex = get_dex()
+    return dex.species_types[dex.species_index(species)]
+
+
+def matchup_features(our_species_idxs: np.ndarray, our_move_idxs: np.ndarray,
+                     opponent_species_idxs: np.ndarray) -> np.ndarray:
+    """
+    タイプ相性・種族値による対面の特徴量(Dexのテーブルからの参照のみで計算する)
+    :param our_species_idxs: (N,) 自分の場のポケモン(Dex.species_index)
+    :param our_move_idxs: (N, MATCHUP_MOVES) 自分の場のポケモンの技(Dex.move_index)。技がない所は-1
+    :param opponent_species_idxs: (N,) 相手の場のポケモン
+    :return: (N, MATCHUP_DIMS)
+    """
+    dex = get_dex()
+    n = our_species_idxs.shape[0]
+    valid = our_move_idxs >= 0
+    move_idxs = np.where(valid, our_move_idxs, 0)
+    move_types = dex.move_types[move_idxs]
+    powers = dex.move_powers[move_idxs] * valid
+    effectiveness = dex.type_vs_species[move_types, opponent_species_idxs[:, None]]
+    stab = 1.0 + 0.5 * dex.species_types[our_species_idxs[:, None], move_types]
+    feat = np.empty((n, MATCHUP_DIMS), dtype=np.float32)
+    # 攻撃技の相性(0~4倍を0~1に。変化技は0)
+    feat[:, :MATCHUP_MOVES] = np.where(powers > 0, effectiveness / 4.0, 0.0)
+    # タイプ一致・相性を考慮した威力
+    feat[:, MATCHUP_MOVES:MATCHUP_MOVES * 2] = np.minimum(powers * stab * effectiveness / MATCHUP_POWER_SCALE, 1.0)
+    # 素早さの種族値が相手より高ければ1、同じなら0.5
+    speed_idx = 5
+    feat[:, MATCHUP_MOVES * 2] = (np.sign(dex.base_stats[our_species_idxs, speed_idx] -
+                                          dex.base_stats[opponent_species_idxs, speed_idx]) + 1.0) / 2.0
+    # 相手のタイプの技の、自分への相性の最大値
+    feat[:, MATCHUP_MOVES * 2 + 1] = np.max(
+        dex.type_vs_species[dex.species_type_idxs[opponent_species_idxs], our_species_idxs[:, None]], axis=1) / 4.0
+    return feat
+
+
+def party_move_idxs(side_party: Party, species: str) -> List[int]:
+    """
+    パーティ中のポケモンの技のDex.move_index
+    :param side_party:
+    :param species: 種族名　例：'Ninetales'
+    :return: MATCHUP_MOVES要素。技がない所、パーティにいない場合は-1
+    """
+    dex = get_dex()
+    poke_id = dex.get_pokedex_by_name(species)['id']
+    move_idxs = [-1] * MATCHUP_MOVES
+    for party_poke in side_party:
+        if party_poke['species'] == poke_id:
+            for i, move in enumerate(party_poke['moves'][:MATCHUP_MOVES]):
+                move_idxs[i] = dex.move_index(move)
+            break
+    return move_idxs
 
 
 class FeatureExtractor:
@@ -38,6 +86,7 @@ class FeatureExtractor:
     """
     feature_types: List[str]
     party_size: int
+    incremental: bool  # バトル中の状態変化ごとに特徴量を差分更新する(FeatureBuffer)
     ALL_FEATURE_TYPES = [
         "remaining_count",
         "poke_type",
@@ -45,11 +94,40 @@ class FeatureExtractor:
         "nv_condition",
         "rank",
         "weather"]
+    # ALL_FEATURE_TYPESに含まない特徴。matchupはdata/dataset/movedex.jsonが必要(js/tools/enumerate_movedex.js)
+    OPTIONAL_FEATURE_TYPES = [
+        "matchup"]
     # TODO: 持ち物があるかどうか（BattleStatusに現状情報がなく、requestから取り出す経路が必要）
 
-    def __init__(self, feature_types: Optional[List[str]] = None, party_size: int = 3):
+    def __init__(self, feature_types: Optional[List[str]] = None, party_size: int = 3, incremental: bool = False):
+        """
+        :param feature_types:
+        :param party_size:
+        :param incremental: Trueの場合、attach_bufferでBattleStatusに特徴量のバッファを持たせ、
+        メッセージの処理ごとに変化した部分のみ更新する。transformはバッファのコピーと合法手の書き込みのみとなる。
+        """
         self.feature_types = feature_types or FeatureExtractor.ALL_FEATURE_TYPES
         self.party_size = party_size
+        self.incremental = incremental
+        self._compile()
+
+    def _compile(self):
+        # 各特徴の配置を事前計算する
+        self._choice_dims = self.party_size * 6
+        self._dims = self.get_dims()
+        self._offsets = self.get_offsets()
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        for key in ['_choice_dims', '_dims', '_offsets']:
+            del d[key]
+        return d
+
+    def __setstate__(self, state):
+        # 以前のバージョンでpickleされたものにはincrementalがない
+        self.incremental = False
+        self.__dict__.update(state)
+        self._compile()
 
     def get_dims(self) -> int:
         """
@@ -69,6 +147,8 @@ class FeatureExtractor:
             dims += len(RANKS) * 2
         if "weather" in self.feature_types:
             dims += len(WEATHERS)
+        if "matchup" in self.feature_types:
+            dims += MATCHUP_DIMS
         return dims
 
     def get_dim_meanings(self) -> List[str]:
@@ -91,110 +171,244 @@ class FeatureExtractor:
                 ms += [f"rank/{side}/{rank}" for rank in RANKS]
         if "weather" in self.feature_types:
             ms += [f"weather/{weather}" for weather in WEATHERS]
+        if "matchup" in self.feature_types:
+            ms += [f"matchup/move_{move_idx}/effectiveness" for move_idx in range(MATCHUP_MOVES)]
+            ms += [f"matchup/move_{move_idx}/power" for move_idx in range(MATCHUP_MOVES)]
+            ms += ["matchup/faster", "matchup/opponent_effectiveness"]
         return ms
 
-    def transform(self, battle_status: BattleStatus, choice_vec: np.ndarray) -> np.ndarray:
-        feats = [choice_vec]
-        if "remaining_count" in self.feature_types:
-            feats.append(self._transform_remaining_count(battle_status, battle_status.side_friend))
-            feats.append(self._transform_remaining_count(battle_status, battle_status.side_opponent))
-        if "poke_type" in self.feature_types:
-            feats.append(self._transform_poke_type(battle_status, battle_status.side_opponent))
-        if "hp_ratio" in self.feature_types:
-            feats.append(self._transform_hp_ratio(battle_status, battle_status.side_friend))
-            feats.append(self._transform_hp_ratio(battle_status, battle_status.side_opponent))
-        if "nv_condition" in self.feature_types:
-            feats.append(self._transform_nv_condition(battle_status, battle_status.side_friend))
-            feats.append(self._transform_nv_condition(battle_status, battle_status.side_opponent))
-        if "rank" in self.feature_types:
-            feats.append(self._transform_rank(battle_status, battle_status.side_friend))
-            feats.append(self._transform_rank(battle_status, battle_status.side_opponent))
-        if "weather" in self.feature_types:
-            feats.append(self._transform_weather(battle_status, battle_status.side_friend))
-        return np.concatenate(feats)
+    def get_offsets(self) -> Dict[str, int]:
+        """
+        特徴ベクトル中の各特徴の開始位置
+        :return: "remaining_count/friend"のような名前 => 開始位置。使わない特徴は含まない。
+        """
+        offsets = {}
+        pos = self.party_size * 6  # 合法手
+        sizes = [("remaining_count", 1, True),
+                 ("poke_type", len(POKE_TYPES), False),
+                 ("hp_ratio", 1, True),
+                 ("nv_condition", len(NV_CONDITIONS), True),
+                 ("rank", len(RANKS), True),
+                 ("weather", len(WEATHERS), False),
+                 ("matchup", MATCHUP_DIMS, False)]
+        for feature_type, size, both_sides in sizes:
+            if feature_type not in self.feature_types:
+                continue
+            if feature_type == "poke_type":
+                offsets["poke_type/opponent"] = pos
+                pos += size
+            elif both_sides:
+                for side in ["friend", "opponent"]:
+                    offsets[f"{feature_type}/{side}"] = pos
+                    pos += size
+            else:
+                offsets[feature_type] = pos
+                pos += size
+        assert pos == self.get_dims()
+        return offsets
 
-    def _transform_remaining_count(self, battle_status: BattleStatus, side: str) -> np.ndarray:
+    def attach_buffer(self, battle_status: BattleStatus):
         """
-        ポケモンの残り数/パーティサイズ
+        バトル開始時のBattleStatusに特徴量のバッファを持たせる
+        以降、BattleStreamProcessorがメッセージを処理するたびにバッファが更新される
         :param battle_status:
-        :param side:
         :return:
         """
-        side_status = battle_status.side_statuses[side]
-        feat = np.zeros((1,), dtype=np.float32)
-        feat[0] = side_status.remaining_pokes / side_status.total_pokes
-        return feat
+        battle_status.feature_buffer = FeatureBuffer(self, battle_status.side_friend, battle_status.side_party)
 
-    def _transform_poke_type(self, battle_status: BattleStatus, side: str) -> np.ndarray:
+    def transform(self, battle_status: BattleStatus, choice_vec: np.ndarray, copy: bool = True) -> np.ndarray:
         """
-        相手のタイプを表すベクトル
+        バトルの状態と合法手を特徴ベクトルに変換する
         :param battle_status:
-        :param side:
+        :param choice_vec: get_possible_actionsで得られる合法手のベクトル
+        :param copy: バッファを用いる場合に、Falseならバッファそのものを返す(次のメッセージ処理で書き換わる)
         :return:
         """
-        active = battle_status.side_statuses[side].active
-        assert active is not None
-        dex_poke_info = dex.get_pokedex_by_name(active.species)
-        feat = np.zeros((len(POKE_TYPES),), dtype=np.float32)
-        for poke_type in dex_poke_info["types"]:
-            feat[POKE_TYPE2NUM[poke_type]] = 1.0
-        return feat
+        feature_buffer = battle_status.feature_buffer
+        if feature_buffer is not None:
+            assert feature_buffer.buffer.shape[0] == self._dims
+            return feature_buffer.get(choice_vec, copy)
+        return self.transform_batch([battle_status], [choice_vec])[0]
 
-    def _transform_hp_ratio(self, battle_status: BattleStatus, side: str) -> np.ndarray:
+    def transform_batch(self, battle_statuses: Sequence[BattleStatus],
+                        choice_vecs: Union[Sequence[np.ndarray], np.ndarray],
+                        out: Optional[np.ndarray] = None) -> np.ndarray:
         """
-        ポケモンの残りHP/最大HP
-        :param battle_status:
-        :param side:
-        :return:
+        複数のバトルの状態をまとめて特徴ベクトルに変換する
+        特徴量のバッファ(attach_buffer)は用いず、常にバトルの状態から計算する
+        :param battle_statuses: N個のバトルの状態
+        :param choice_vecs: 各状態の合法手のベクトル。(N, party_size * 6)の行列でもよい
+        :param out: 結果を書き込む(N, get_dims())のfloat32行列。省略時は新たに確保する
+        :return: (N, get_dims())の行列
         """
-        active = battle_status.side_statuses[side].active
-        assert active is not None
-        feat = np.zeros((1,), dtype=np.float32)
-        feat[0] = active.hp_current / active.hp_max
-        return feat
+        n = len(battle_statuses)
+        if out is None:
+            out = np.zeros((n, self._dims), dtype=np.float32)
+        else:
+            assert out.shape == (n, self._dims) and out.dtype == np.float32
+            out.fill(0.0)
+        if n == 0:
+            return out
+        out[:, :self._choice_dims] = choice_vecs
+        offsets = self._offsets
+        sides = [(battle_status.side_statuses[battle_status.side_friend],
+                  battle_status.side_statuses[battle_status.side_opponent]) for battle_status in battle_statuses]
+        rows = np.arange(n)
+        for role_idx, role in enumerate(("friend", "opponent")):
+            pos = offsets.get(f"remaining_count/{role}")
+            if pos is not None:
+                # ポケモンの残り数/パーティサイズ
+                out[:, pos] = [side[role_idx].remaining_pokes / side[role_idx].total_pokes for side in sides]
+            actives = [side[role_idx].active for side in sides]
+            pos = offsets.get(f"hp_ratio/{role}")
+            if pos is not None:
+                # ポケモンの残りHP/最大HP
+                out[:, pos] = [active.hp_current / active.hp_max for active in actives]
+            pos = offsets.get(f"nv_condition/{role}")
+            if pos is not None:
+                # 状態異常(なしの場合は全て0)
+                cond_idxs = np.array([NV_CONDITION2NUM.get(active.status, -1) for active in actives])
+                has_cond = cond_idxs >= 0
+                out[rows[has_cond], pos + cond_idxs[has_cond]] = 1.0
+            pos = offsets.get(f"rank/{role}")
+            if pos is not None:
+                # ランク補正を0~1に
+                ranks = np.array([active.ranks.values() for active in actives], dtype=np.float32)
+                out[:, pos:pos + len(RANKS)] = (ranks + 6.0) / 12.0
+        pos = offsets.get("poke_type/opponent")
+        if pos is not None:
+            # 相手のタイプ
+            out[:, pos:pos + len(POKE_TYPES)] = [poke_type_vec(side[1].active.species) for side in sides]
+        pos = offsets.get("weather")
+        if pos is not None:
+            weather_idxs = np.array([WEATHER2NUM.get(battle_status.weather, -1) for battle_status in battle_statuses])
+            has_weather = weather_idxs >= 0
+            out[rows[has_weather], pos + weather_idxs[has_weather]] = 1.0
+        pos = offsets.get("matchup")
+        if pos is not None:
+            dex = get_dex()
+            friend_species = [side[0].active.species for side in sides]
+            out[:, pos:pos + MATCHUP_DIMS] = matchup_features(
+                np.array([dex.species_index(species) for species in friend_species]),
+                np.array([party_move_idxs(battle_status.side_party, species)
+                          for battle_status, species in zip(battle_statuses, friend_species)]),
+                np.array([dex.species_index(side[1].active.species) for side in sides]))
+        return out
+
+
+class FeatureBuffer:
+    """
+    FeatureExtractor.transformの結果を保持し、状態の変化に応じて該当部分のみ更新するバッファ
+    BattleStreamProcessorの各ハンドラが、BattleStatusを更新した後に対応するupdate_*を呼び出す。
+    更新内容はFeatureExtractor.transform_batchと同じ。
+    """
+    buffer: np.ndarray
+    side_friend: str
+
+    def __init__(self, feature_extractor: FeatureExtractor, side_friend: str, side_party: Party):
+        self.buffer = np.zeros((feature_extractor.get_dims(),), dtype=np.float32)
+        self.side_friend = side_friend
+        offsets = feature_extractor.get_offsets()
+        self._choice_dims = feature_extractor.party_size * 6
+        side_opponent = {'p1': 'p2', 'p2': 'p1'}[side_friend]
+        # side('p1' or 'p2') => 開始位置(使わない特徴はNone)
+        self._remaining_count = {}
+        self._hp_ratio = {}
+        self._nv_condition = {}
+        self._rank = {}
+        for side, role in [(side_friend, "friend"), (side_opponent, "opponent")]:
+            self._remaining_count[side] = offsets.get(f"remaining_count/{role}")
+            self._hp_ratio[side] = offsets.get(f"hp_ratio/{role}")
+            self._nv_condition[side] = offsets.get(f"nv_condition/{role}")
+            self._rank[side] = offsets.get(f"rank/{role}")
+        self._poke_type = {side_friend: None, side_opponent: offsets.get("poke_type/opponent")}
+        self._weather = offsets.get("weather")
+        self._matchup = offsets.get("matchup")
+        self._side_party = side_party
+        self._side_opponent = side_opponent
+        self._active_species = {side_friend: None, side_opponent: None}  # matchupの計算用
+        if self._rank[side_friend] is not None:
+            # ランク0は(0+6)/12=0.5
+            for side in [side_friend, side_opponent]:
+                self.buffer[self._rank[side]:self._rank[side] + len(RANKS)] = 0.5
 
-    def _transform_nv_condition(self, battle_status: BattleStatus, side: str) -> np.ndarray:
+    def copy(self) -> "FeatureBuffer":
+        feature_buffer = copy.copy(self)
+        feature_buffer.buffer = self.buffer.copy()
+        return feature_buffer
+
+    def get(self, choice_vec: np.ndarray, copy: bool = True) -> np.ndarray:
         """
-        状態異常
-        :param battle_status:
-        :param side:
-        :return:
+        合法手を書き込んだ特徴ベクトルを返す
         """
-        active = battle_status.side_statuses[side].active
-        assert active is not None
-        feat = np.zeros((len(NV_CONDITIONS),), dtype=np.float32)
-        for i, cond in enumerate(NV_CONDITIONS):
-            if cond == active.status:
-                feat[i] = 1.0
-                break
-        return feat
+        self.buffer[:self._choice_dims] = choice_vec
+        return self.buffer.copy() if copy else self.buffer
 
-    def _transform_rank(self, battle_status: BattleStatus, side: str) -> np.ndarray:
+    def update_remaining_count(self, side: str, side_status: SideStatus):
+        pos = self._remaining_count[side]
+        if pos is not None:
+            self.buffer[pos] = side_status.remaining_pokes / side_status.total_pokes
+
+    def update_active(self, side: str, active: ActivePokeStatus):
         """
-        ランク補正
-        :param battle_status:
-        :param side:
-        :return:
+        ポケモンが交換された(場のポケモンに関する全特徴を更新)
         """
-        active = battle_status.side_statuses[side].active
-        assert active is not None
-        feat = np.zeros((len(RANKS),), dtype=np.float32)
-        for i, cond in enumerate(RANKS):
-            rank = active.ranks[cond]
-            feat[i] = (rank + 6.0) / 12.0  # 0~1
-        return feat
+        pos = self._poke_type[side]
+        if pos is not None:
+            self.buffer[pos:pos + len(POKE_TYPES)] = poke_type_vec(active.species)
+        if self._matchup is not None:
+            self._active_species[side] = active.species
+            self._update_matchup()
+        self.update_hp(side, active)
+        self.update_rank(side, active)
 
-    def _transform_weather(self, battle_status: BattleStatus, side: str) -> np.ndarray:
+    def _update_matchup(self):
+        friend_species = self._active_species[self.side_friend]
+        opponent_species = self._active_species[self._side_opponent]
+        if friend_species is None or opponent_species is None:
+            return
+        dex = get_dex()
+        pos = self._matchup
+        self.buffer[pos:pos + MATCHUP_DIMS] = matchup_features(
+            np.array([dex.species_index(friend_species)]),
+            np.array([party_move_idxs(self._side_party, friend_species)]),
+            np.array([dex.species_index(opponent_species)]))[0]
+
+    def update_hp(self, side: str, active: ActivePokeStatus):
         """
-        天候
-        :param battle_status:
-        :param side:
-        :return:
+        HPと状態異常を更新
         """
-        weather = battle_status.weather
-        feat = np.zeros((len(WEATHERS),), dtype=np.float32)
-        for i, w in enumerate(WEATHERS):
-            if w == weather:
-                feat[i] = 1.0
-                break
-        return feat
+        pos = self._hp_ratio[side]
+        if pos is not None:
+            self.buffer[pos] = active.hp_current / active.hp_max
+        self.update_nv_condition(side, active)
+
+    def update_nv_condition(self, side: str, active: ActivePokeStatus):
+        pos = self._nv_condition[side]
+        if pos is not None:
+            feat = self.buffer[pos:pos + len(NV_CONDITIONS)]
+            feat[:] = 0.0
+            if active.status in NV_CONDITION2NUM:
+                feat[NV_CONDITION2NUM[active.status]] = 1.0
+
+    def update_rank(self, side: str, active: ActivePokeStatus, stat: Optional[str] = None):
+        """
+        ランク補正を更新
+        :param stat: 変化した能力。Noneの場合は全て更新
+        """
+        pos = self._rank[side]
+        if pos is None:
+            return
+        if stat is not None:
+            self.buffer[pos + RANK2NUM[stat]] = (active.ranks[stat] + 6.0) / 12.0
+        else:
+            for i, rank_name in enumerate(RANKS):
+                self.buffer[pos + i] = (active.ranks[rank_name] + 6.0) / 12.0
+
+    def update_weather(self, weather: str):
+        pos = self._weather
+        if pos is not None:
+            feat = self.buffer[pos:pos + len(WEATHERS)]
+            feat[:] = 0.0
+            if weather in WEATHER2NUM:
+                feat[WEATHER2NUM[weather]] = 1.0
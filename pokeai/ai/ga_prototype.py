@@ -14,61 +14,82 @@ Deep Neuroevolutionに準拠
 
 import argparse
 import random
-from typing import List
+from typing import List, Optional
 import numpy as np
 from bson import ObjectId
 from tqdm import tqdm
+from pokeai.ai.batched_policy import InferenceServer
 from pokeai.ai.bias_model import BiasModel
 from pokeai.ai.feature_extractor import FeatureExtractor
 from pokeai.ai.linear_model import LinearModel
 from pokeai.ai.rl_policy import RLPolicy
-from pokeai.sim.battle_stream_processor import BattleStreamProcessor
-from pokeai.sim.sim import Sim
+from pokeai.sim.battle_result_cache import BattleResultCache
+from pokeai.sim.sim_pool import SimPool, AsyncSimPool
 from pokeai.sim.party_generator import Party
 from pokeai.ai.party_db import col_party, col_agent, col_rate, pack_obj, unpack_obj, AgentDoc
 from pokeai.ai.rating_battle import load_agent
 
 
-def fitness(sim, feature_extractor, fitness_policies, fitness_parties, target_party, target_model):
-    bsp_t = BattleStreamProcessor()
-    bsp_t.set_policy(RLPolicy(feature_extractor, target_model))
-    wins = 0
-    for fitness_policy, fitness_party in zip(fitness_policies, fitness_parties):
-        bsp_f = BattleStreamProcessor()
-        bsp_f.set_policy(fitness_policy)
-        sim.set_processor([bsp_t, bsp_f])
-        sim.set_party([target_party, fitness_party])
-        result = sim.run()  # {'winner': 'p1',...}
-        if result['winner'] == 'p1':
-            wins += 1
-    return wins / len(fitness_parties)
+def fitness(pool, feature_extractor, fitness_policies, fitness_parties, target_party, target_models,
+            seed: Optional[int] = None) -> List[float]:
+    """
+    各モデルの、対戦相手群に対する勝率を求める
+    全モデル・全対戦相手の組み合わせのバトルをまとめて実行する
+    seedを指定した場合、対戦相手ごとに同じシードを用いる(全モデルを同じ条件で比較し、結果のキャッシュを効かせる)
+    """
+    jobs = []
+    for target_model in target_models:
+        target_policy = RLPolicy(feature_extractor, target_model)
+        for opponent_idx, (fitness_policy, fitness_party) in enumerate(zip(fitness_policies, fitness_parties)):
+            battle_seed = f'{seed}:{opponent_idx}' if seed is not None else None
+            jobs.append(([target_party, fitness_party], [target_policy, fitness_policy], battle_seed))
+    results = pool.map_battles(jobs)  # [{'winner': 'p1',...}, ...]
+    fitnesses = []
+    for model_idx in range(len(target_models)):
+        model_results = results[model_idx * len(fitness_parties):(model_idx + 1) * len(fitness_parties)]
+        wins = sum(1 for result in model_results if result['winner'] == 'p1')
+        fitnesses.append(wins / len(fitness_parties))
+    return fitnesses
 
 
 def ga(feature_extractor, initial_model, fitness_policies, fitness_parties, target_party, generations, populations,
-       selections, std):
-    sim = Sim()
-    current_models = [initial_model] * selections
-    current_fitnesses = [0.0] * selections
-    for gen in tqdm(range(generations)):
-        cand_models = []
-        cand_fitnesses = []
-        for pop in range(populations):
-            base_model = random.choice(current_models)
-            cand_model = base_model.copy()
-            base_model.add_noise(std=std)
-            cand_fitness = fitness(sim, feature_extractor, fitness_policies, fitness_parties, target_party, cand_model)
-            cand_models.append(cand_model)
-            cand_fitnesses.append(cand_fitness)
-        # TODO: elite
-        order = np.argsort(cand_fitnesses)[::-1]
-        print(f"gen {gen} fitnesses {np.sort(cand_fitnesses)}")
-        next_fitnesses = []
-        next_models = []
-        for idx in order[:selections]:
-            next_models.append(cand_models[idx])
-            next_fitnesses.append(cand_fitnesses[idx])
-        current_fitnesses = next_fitnesses
-        current_models = next_models
+       selections, std, workers=1, seed=None, batch_inference=False, max_batch=64, max_wait_us=500):
+    # 選択されて次世代に残ったモデルの再評価は、シードを指定していればキャッシュされた結果を用いる
+    result_cache = BattleResultCache(maxsize=1000000)
+    if batch_inference:
+        # 各対戦相手は全候補モデルと同時に対戦するため、対戦相手のRLPolicyの行動は最大populations個の観測をまとめて計算できる
+        server = InferenceServer(max_batch=max_batch, max_wait_us=max_wait_us)
+        fitness_policies = [server.wrap(policy) if isinstance(policy, RLPolicy) else policy
+                            for policy in fitness_policies]
+        pool = AsyncSimPool(result_cache=result_cache)
+    else:
+        server = None
+        pool = SimPool(workers, result_cache=result_cache)
+    with pool:
+        current_models = [initial_model] * selections
+        current_fitnesses = [0.0] * selections
+        for gen in tqdm(range(generations)):
+            cand_models = []
+            for pop in range(populations):
+                base_model = random.choice(current_models)
+                cand_model = base_model.copy()
+                base_model.add_noise(std=std)
+                cand_models.append(cand_model)
+            cand_fitnesses = fitness(pool, feature_extractor, fitness_policies, fitness_parties, target_party,
+                                     cand_models, seed)
+            # TODO: elite
+            order = np.argsort(cand_fitnesses)[::-1]
+            print(f"gen {gen} fitnesses {np.sort(cand_fitnesses)}")
+            next_fitnesses = []
+            next_models = []
+            for idx in order[:selections]:
+                next_models.append(cand_models[idx])
+                next_fitnesses.append(cand_fitnesses[idx])
+            current_fitnesses = next_fitnesses
+            current_models = next_models
+    if server is not None:
+        print(f"batch inference: {server.n_inferred} observations in {server.n_forward} forwards "
+              f"(mean batch size {server.mean_batch_size():.1f})")
     return RLPolicy(feature_extractor, current_models[0])
 
 
@@ -84,15 +105,24 @@ def main():
     parser.add_argument("--populations", type=int, default=100)
     parser.add_argument("--selections", type=int, default=10)
     parser.add_argument("--std", type=float, default=0.1)
+    parser.add_argument("--workers", type=int, default=1, help="対戦を並列実行するワーカープロセス数")
+    parser.add_argument("--seed", type=int, help="バトルの乱数のシード")
+    parser.add_argument("--batch_inference", action="store_true",
+                        help="対戦相手のRLPolicyの行動選択を同時進行中のバトル間でまとめて計算する(1プロセスで実行)")
+    parser.add_argument("--max_batch", type=int, default=64, help="--batch_inferenceの1回の計算の最大観測数")
+    parser.add_argument("--max_wait_us", type=int, default=500,
+                        help="--batch_inferenceで観測がたまるのを待つ最大時間(マイクロ秒)")
     args = parser.parse_args()
+    if args.batch_inference and args.workers > 1:
+        parser.error("--batch_inference runs all battles in one process and cannot be used with --workers")
     fitness_parties = []
     fitness_policies = []
     # agent_tagsのいずれかのタグを含むエージェントを列挙
-    for agent_doc in col_agent.find({"tags": {"$in": args.agent_tags.split(",")}}):
+    for agent_doc in col_agent().find({"tags": {"$in": args.agent_tags.split(",")}}):
         party, policy = load_agent(agent_doc)
         fitness_parties.append(party)
         fitness_policies.append(policy)
-    target_party_doc = col_party.find_one({'_id': ObjectId(args.party_id)})
+    target_party_doc = col_party().find_one({'_id': ObjectId(args.party_id)})
     target_party = target_party_doc['party']
 
     feature_extractor = FeatureExtractor()
@@ -103,9 +133,10 @@ def main():
     else:
         raise ValueError
     trained_policy = ga(feature_extractor, initial_model, fitness_policies, fitness_parties, target_party,
-                        args.generations, args.populations, args.selections, args.std)
+                        args.generations, args.populations, args.selections, args.std, args.workers, args.seed,
+                        args.batch_inference, args.max_batch, args.max_wait_us)
     trained_agent_id = ObjectId()
-    col_agent.insert_one({
+    col_agent().insert_one({
         '_id': trained_agent_id,
         'party_id': target_party_doc['_id'],
         'policy_packed': pack_obj(trained_policy),
@@ -8,6 +8,7 @@ from bson import ObjectId
 
 from pokeai.sim.random_party_generator import RandomPartyGenerator
 from pokeai.ai.party_db import col_party
+from pokeai.sim.pack_team import pack_team
 
 
 def main():
@@ -17,8 +18,11 @@ def main():
     args = parser.parse_args()
     tags = args.tags.split(",") if args.tags else []
     gen = RandomPartyGenerator()
-    parties = [{'_id': ObjectId(), 'party': gen.generate(), 'tags': tags} for _ in range(args.n)]
-    col_party.insert_many(parties)
+    parties = []
+    for _ in range(args.n):
+        party = gen.generate()
+        parties.append({'_id': ObjectId(), 'party': party, 'tags': tags, 'packed': pack_team(party)})
+    col_party().insert_many(parties)
 
 
 if __name__ == '__main__':
@@ -2,22 +2,43 @@ from typing import List, Optional, TypedDict, Dict
 import os
 import pickle
 import gzip
-from pymongo import MongoClient
 from bson import ObjectId
 
 from pokeai.sim.party_generator import Party
 
-client = MongoClient()
-db = client[os.environ.get("POKEAI_PARTY_DB_NAME", "pokeai_2")]
-col_party = db["Party"]  # document type PartyDoc
-col_agent = db["Agent"]  # document type AgentDoc
-col_rate = db["Rate"]  # document type RateDoc
+# MongoClientは初回使用時に生成する(import時にデータベースに接続しない)
+# fork後の子プロセスでは親プロセスの接続を使わず生成しなおす
+_db = None
+_db_pid = None
+
+
+def get_db():
+    global _db, _db_pid
+    if _db is None or _db_pid != os.getpid():
+        from pymongo import MongoClient
+        client = MongoClient()
+        _db = client[os.environ.get("POKEAI_PARTY_DB_NAME", "pokeai_2")]
+        _db_pid = os.getpid()
+    return _db
+
+
+def col_party():
+    return get_db()["Party"]  # document type PartyDoc
+
+
+def col_agent():
+    return get_db()["Agent"]  # document type AgentDoc
+
+
+def col_rate():
+    return get_db()["Rate"]  # document type RateDoc
 
 
 class PartyDoc(TypedDict):
     _id: ObjectId
     party: Party
     tags: List[str]
+    packed: str  # 任意。partyをpack_teamで変換したもの。あればシミュレータ起動時の変換を省略できる。
 
 
 class AgentDoc(TypedDict):
@@ -12,6 +12,7 @@ from bson import ObjectId
 
 from pokeai.ai.party_db import col_party, col_agent, col_rate
 from pokeai.ai.party_feature.party_rate_predictor import PartyRatePredictor
+from pokeai.sim.pack_team import pack_team
 from pokeai.sim.party_generator import Party, PartyGenerator
 from pokeai.sim.random_party_generator import RandomPartyGenerator
 from pokeai.util import pickle_dump, yaml_load, yaml_dump, pickle_load
@@ -44,7 +45,7 @@ def main():
     args = parser.parse_args()
     predictor = pickle_load(args.predictor)  # type: PartyRatePredictor
     seed_parties = []  # type: List[Party]
-    for party_doc in col_party.find({"tags": {"$in": args.seed_tags.split(",")}}):
+    for party_doc in col_party().find({"tags": {"$in": args.seed_tags.split(",")}}):
         seed_parties.append(party_doc["party"])
     dst_tags = args.dst_tags.split(",")
     party_generator = RandomPartyGenerator()
@@ -53,8 +54,9 @@ def main():
                                   seed_parties=seed_parties,
                                   generations=args.generations,
                                   populations=args.populations)
-    parties_doc = [{'_id': ObjectId(), 'party': party, 'tags': dst_tags} for party in generated_parties]
-    col_party.insert_many(parties_doc)
+    parties_doc = [{'_id': ObjectId(), 'party': party, 'tags': dst_tags, 'packed': pack_team(party)}
+                   for party in generated_parties]
+    col_party().insert_many(parties_doc)
 
 
 if __name__ == '__main__':
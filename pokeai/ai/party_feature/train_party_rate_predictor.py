@@ -25,18 +25,18 @@ def get_rate_parties(rate_id: ObjectId) -> Tuple[List[float], List[Party]]:
     """
     rates = []
     parties = []
-    for record in col_rate.aggregate([{"$match": {"_id": rate_id}},
-                                      {"$project": {"rates": {"$objectToArray": "$rates"}}},
-                                      {"$unwind": "$rates"},
-                                      {"$project": {"rate": "$rates.v", "agent_id": {"$toObjectId": "$rates.k"}}},
-                                      {"$lookup": {"from": "Agent", "localField": "agent_id",
-                                                   "foreignField": "_id", "as": "agent"}},
-                                      {"$unwind": "$agent"},
-                                      {"$project": {"rate": 1, "party_id": "$agent.party_id"}},
-                                      {"$lookup": {"from": "Party", "localField": "party_id",
-                                                   "foreignField": "_id", "as": "party"}},
-                                      {"$unwind": "$party"},
-                                      {"$project": {"rate": 1, "party": "$party.party"}}]):
+    for record in col_rate().aggregate([{"$match": {"_id": rate_id}},
+                                        {"$project": {"rates": {"$objectToArray": "$rates"}}},
+                                        {"$unwind": "$rates"},
+                                        {"$project": {"rate": "$rates.v", "agent_id": {"$toObjectId": "$rates.k"}}},
+                                        {"$lookup": {"from": "Agent", "localField": "agent_id",
+                                                     "foreignField": "_id", "as": "agent"}},
+                                        {"$unwind": "$agent"},
+                                        {"$project": {"rate": 1, "party_id": "$agent.party_id"}},
+                                        {"$lookup": {"from": "Party", "localField": "party_id",
+                                                     "foreignField": "_id", "as": "party"}},
+                                        {"$unwind": "$party"},
+                                        {"$project": {"rate": 1, "party": "$party.party"}}]):
         # {'_id': ObjectId('5dd903df4c09c8835b995852'),
         # 'rate': 1667.9865011411382,
         # 'party': [{'name': 'magcargo', 'species': 'magcargo', 'moves': ['toxic', 'swagger', 'endure', 'rollout'], ...
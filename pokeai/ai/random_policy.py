@@ -1,4 +1,4 @@
-import random
+from typing import Optional
 
 from pokeai.ai.action_policy import ActionPolicy
 from pokeai.ai.battle_status import BattleStatus
@@ -32,12 +32,12 @@ class RandomPolicy(ActionPolicy):
             else:
                 raise NotImplementedError
 
-        if len(switch_choices) > 0 and (len(move_choices) == 0 or random.random() < self.switch_prob):
+        if len(switch_choices) > 0 and (len(move_choices) == 0 or battle_status.rng.random() < self.switch_prob):
             # 交換しかできない場合か、両方できる場合で一定確率で交換を選ぶ
-            return random.choice(switch_choices)
+            return battle_status.rng.choice(switch_choices)
         else:
             assert len(move_choices) > 0
-            return random.choice(move_choices)
+            return battle_status.rng.choice(move_choices)
 
     def choice_force_switch(self, battle_status: BattleStatus, request: dict) -> str:
         """
@@ -49,6 +49,16 @@ class RandomPolicy(ActionPolicy):
         # TODO: バトンタッチ対応
         choice_idxs, choice_keys, _ = get_possible_actions(battle_status, request)
         if len(choice_keys) > 1:
-            return random.choice(choice_keys)
+            return battle_status.rng.choice(choice_keys)
         else:
             return choice_keys[0]
+
+    def fingerprint(self) -> Optional[str]:
+        # 乱数はBattleStatus.rngのみを用いるため決定的
+        return f'RandomPolicy(switch_prob={self.switch_prob})'
+
+    def simple_spec(self) -> Optional[dict]:
+        if type(self) is not RandomPolicy:
+            # 行動選択を変更したサブクラス(RLPolicyなど)は対象外
+            return None
+        return {'type': 'random', 'switchProb': self.switch_prob}
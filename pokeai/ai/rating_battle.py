@@ -4,46 +4,50 @@
 
 import os
 import argparse
-from typing import List, Tuple
+from typing import List, Tuple, Optional
 import numpy as np
 from bson import ObjectId
 from logging import getLogger
 
 from pokeai.ai.common import load_agent
 from pokeai.ai.party_db import col_party, col_agent, col_rate, pack_obj, unpack_obj, AgentDoc
-from pokeai.sim.battle_stream_processor import BattleStreamProcessor
-from pokeai.sim.sim import Sim
+from pokeai.sim.battle_result_cache import BattleResultCache
+from pokeai.sim.sim_pool import SimPool
 from pokeai.util import pickle_dump
 
 logger = getLogger(__name__)
 
 
-def match_agents(sim, parties, policies):
-    bsps = []
-    for i in [0, 1]:
-        bsp = BattleStreamProcessor()
-        bsp.set_policy(policies[i])
-        bsps.append(bsp)
-    sim.set_processor(bsps)
-    sim.set_party(parties)
-    result = sim.run()
-    winner = {'p1': 0, 'p2': 1, '': -1}[result['winner']]
-    return winner
-
-
-def rating_battle(parties, policies, agent_ids, match_count: int, fixed_rates: List[float] = None) -> Tuple[
-    List[float], list]:
+def rating_battle(parties, policies, agent_ids, match_count: int, fixed_rates: List[float] = None,
+                  workers: int = 1, seed: Optional[int] = None,
+                  result_cache: Optional[BattleResultCache] = None, fast_path: bool = True,
+                  stats: bool = False) -> Tuple[List[float], list]:
     """
     パーティ同士を多数戦わせ、レーティングを算出する。
     :param parties:
     :param policies:
     :param match_count: 1エージェント当たりの対戦回数
     :param fixed_rates: 各パーティの固定レート。固定されてないパーティは0。
+    :param workers: 対戦を並列実行するワーカープロセス数
+    :param seed: 指定した場合、対戦組み合わせと各バトルの乱数を再現可能にする
+    :param result_cache: 指定した場合、同じエージェント同士の同じシードのバトルの結果を再利用する(seedの指定が必要)
+    :param fast_path: 単純な方策(RandomPolicy)同士のバトルはシミュレータ内で行動選択まで行う
+    :param stats: フェーズごとの処理時間等を計測し、ログに出力する
     :return: パーティのレーティングおよび対戦ログ
     """
     assert len(parties) == len(policies)
     assert len(fixed_rates) == len(parties)
-    sim = Sim()
+    with SimPool(workers, result_cache=result_cache, fast_path=fast_path, stats=stats) as pool:
+        result = _rating_battle(pool, parties, policies, agent_ids, match_count, fixed_rates, seed)
+        if pool.stats is not None:
+            logger.info(f"battle stats:\n{pool.stats.summary()}")
+        return result
+
+
+def _rating_battle(pool: SimPool, parties, policies, agent_ids, match_count: int, fixed_rates: List[float],
+                   seed: Optional[int] = None) -> Tuple[List[float], list]:
+    rng = np.random.RandomState(seed)
+    pair_counts = {}  # (エージェントID, エージェントID) => これまでの対戦回数
 
     # レート初期値設定
     rates = np.full((len(parties),), 1500.0)
@@ -56,8 +60,9 @@ def rating_battle(parties, policies, agent_ids, match_count: int, fixed_rates: L
     for i in range(match_count):
         # 対戦相手を決める
         # レーティングに乱数を加算し、ソートして隣接パーティ同士を戦わせる
-        rates_with_random = rates + np.random.normal(scale=200., size=rates.shape)
+        rates_with_random = rates + rng.normal(scale=200., size=rates.shape)
         ranking = np.argsort(rates_with_random)
+        matches = []
         for j in range(0, len(parties), 2):
             if j + 1 >= len(parties):
                 # 奇数個パーティがある場合
@@ -67,8 +72,20 @@ def rating_battle(parties, policies, agent_ids, match_count: int, fixed_rates: L
             if fixed_rates[left] != 0 and fixed_rates[right] != 0:
                 # どちらもレート固定パーティなので、対戦不要
                 continue
-            logger.debug(f"match start: {agent_ids[left]}, {agent_ids[right]}")
-            winner = match_agents(sim, [parties[left], parties[right]], [policies[left], policies[right]])
+            matches.append((left, right))
+        # 1ラウンド内では各エージェントは1回しか対戦しないため、対戦をまとめて並列実行してもレート変動は逐次実行と同じ
+        jobs = []
+        for left, right in matches:
+            # バトルのシードは対戦するエージェントと、その組み合わせでの対戦回数から決める
+            # 同じエージェント同士の対戦は、別の実行でも同じシードとなる
+            pair = (str(agent_ids[left]), str(agent_ids[right]))
+            pair_count = pair_counts.get(pair, 0)
+            pair_counts[pair] = pair_count + 1
+            battle_seed = f'{seed}:{pair[0]}:{pair[1]}:{pair_count}' if seed is not None else None
+            jobs.append(([parties[left], parties[right]], [policies[left], policies[right]], battle_seed))
+        results = pool.map_battles(jobs)
+        for (left, right), result in zip(matches, results):
+            winner = {'p1': 0, 'p2': 1, '': -1}[result['winner']]
             # レートを変動させる
             if winner >= 0:
                 left_winrate = 1.0 / (1.0 + 10.0 ** ((rates[right] - rates[left]) / 400.0))
@@ -82,7 +99,7 @@ def rating_battle(parties, policies, agent_ids, match_count: int, fixed_rates: L
                     rates[right] -= left_incr
             log.append({"agents": [agent_ids[left], agent_ids[right]],
                         "winner": winner})
-            logger.debug(f"match end: winner: {winner}")
+            logger.debug(f"match end: {agent_ids[left]}, {agent_ids[right]}, winner: {winner}")
         abs_mean_diff = np.mean(np.abs(rates - 1500.0))
         logger.info(f"{i} rate mean diff: {abs_mean_diff}")
     return rates.tolist(), log
@@ -95,6 +112,12 @@ def main():
     parser.add_argument("--fixed_rate", help="レート固定パーティのレートid")
     parser.add_argument("--match_count", type=int, default=100, help="1パーティあたりの対戦回数")
     parser.add_argument("--log", help="ログディレクトリ")
+    parser.add_argument("--workers", type=int, default=1, help="対戦を並列実行するワーカープロセス数")
+    parser.add_argument("--seed", type=int, help="乱数のシード(対戦を再現可能にする)")
+    parser.add_argument("--result_cache", help="バトル結果のキャッシュファイル(--seedが必要)")
+    parser.add_argument("--no_fast_path", action="store_true",
+                        help="RandomPolicy同士のバトルもpython側で行動選択する(シミュレータ内で行わない)")
+    parser.add_argument("--stats", action="store_true", help="フェーズごとの処理時間等を計測してログに出力する")
     parser.add_argument("--loglevel", help="対戦経過のログ出力のレベル", choices=["INFO", "WARNING", "DEBUG"], default="INFO")
     args = parser.parse_args()
     logging.basicConfig(level=getattr(logging, args.loglevel))
@@ -107,18 +130,24 @@ def main():
         os.makedirs(args.log, exist_ok=True)
     print(f"rate_id: {rate_id}")
     if args.fixed_rate:
-        fixed_rate_map = col_rate.find_one({'_id': ObjectId(args.fixed_rate)})['rates']
+        fixed_rate_map = col_rate().find_one({'_id': ObjectId(args.fixed_rate)})['rates']
     else:
         fixed_rate_map = {}
     # agent_tagsのいずれかのタグを含むエージェントを列挙
-    for agent_doc in col_agent.find({"tags": {"$in": args.agent_tags.split(",")}}):
+    for agent_doc in col_agent().find({"tags": {"$in": args.agent_tags.split(",")}}):
         party, policy = load_agent(agent_doc)
         parties.append(party)
         policies.append(policy)
         agent_ids.append(agent_doc['_id'])
         fixed_rates.append(fixed_rate_map.get(str(agent_doc['_id']), 0.0))
-    rates, log = rating_battle(parties, policies, agent_ids, args.match_count, fixed_rates=fixed_rates)
-    col_rate.insert_one({
+    result_cache = BattleResultCache(path=args.result_cache) if args.result_cache else None
+    rates, log = rating_battle(parties, policies, agent_ids, args.match_count, fixed_rates=fixed_rates,
+                              workers=args.workers, seed=args.seed, result_cache=result_cache,
+                              fast_path=not args.no_fast_path, stats=args.stats)
+    if result_cache is not None:
+        logger.info(f"result cache hits: {result_cache.hits}, misses: {result_cache.misses}")
+        result_cache.save()
+    col_rate().insert_one({
         "_id": rate_id,
         "rates": {str(agent_id): rate for agent_id, rate in zip(agent_ids, rates)},
     })
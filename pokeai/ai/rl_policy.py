@@ -1,28 +1,143 @@
-import chainer
 import numpy as np
-from logging import getLogger
-import tempfile
-import shutil
+from logging import getLogger, DEBUG
+import hashlib
+import io
+import json
 import os
+import random
+import tarfile
+import time
+from typing import Optional, TYPE_CHECKING
 
-from chainerrl.agent import Agent
-
-from pokeai.ai.agent_builder import build_agent
 from pokeai.ai.battle_status import BattleStatus
 from pokeai.ai.common import get_possible_actions
 from pokeai.ai.feature_extractor import FeatureExtractor
 from pokeai.ai.random_policy import RandomPolicy
 
+if TYPE_CHECKING:
+    from chainerrl.agent import Agent
+
 logger = getLogger(__name__)
 
 
+def _build_agent(agent_build_params: dict, feature_extractor: FeatureExtractor) -> "Agent":
+    # chainer, chainerrlのimportは時間がかかるため、エージェントを生成する時点(unpickle時を含む)まで遅らせる
+    from pokeai.ai.agent_builder import build_agent
+    return build_agent(agent_build_params, feature_extractor.get_dims(), feature_extractor.party_size)
+
+
+def _dump_saved_attributes(obj) -> dict:
+    """
+    agent.save(dirname)と同じ内容を、ファイルの代わりにメモリ上のnpzに書き出す
+    :param obj: chainerrlのAttributeSavingMixin(agentなど)
+    :return: 属性名→npzのバイト列(属性がAttributeSavingMixinの場合は再帰的にdict)
+    """
+    from chainer import serializers
+    from chainerrl.agent import AttributeSavingMixin
+    dumped = {}
+    for attr in obj.saved_attributes:
+        value = getattr(obj, attr)
+        if value is None:
+            continue
+        if isinstance(value, AttributeSavingMixin):
+            dumped[attr] = _dump_saved_attributes(value)
+        else:
+            buf = io.BytesIO()
+            # pickle全体がpack_objでgzip圧縮されるため、npz単体では圧縮しない
+            serializers.save_npz(buf, value, compression=False)
+            dumped[attr] = buf.getvalue()
+    return dumped
+
+
+def _load_saved_attributes(obj, dumped: dict):
+    """
+    _dump_saved_attributesの出力を読み込む(agent.load(dirname)に相当)
+    :param obj: chainerrlのAttributeSavingMixin(agentなど)
+    :param dumped: 属性名→npzのバイト列
+    :return:
+    """
+    from chainer import serializers
+    from chainerrl.agent import AttributeSavingMixin
+    for attr in obj.saved_attributes:
+        value = getattr(obj, attr)
+        if value is None:
+            continue
+        if isinstance(value, AttributeSavingMixin):
+            _load_saved_attributes(value, dumped[attr])
+        else:
+            serializers.load_npz(io.BytesIO(dumped[attr]), value)
+
+
+def _read_agent_archive(archive_data: bytes) -> dict:
+    """
+    agent.saveで保存したディレクトリのtarアーカイブを、一時ディレクトリに展開せずに_dump_saved_attributesの形式に変換する
+    :param archive_data: tarアーカイブのバイト列
+    :return: 属性名→npzのバイト列
+    """
+    dumped = {}
+    with tarfile.open(fileobj=io.BytesIO(archive_data), mode='r:') as tar:
+        for member in tar.getmembers():
+            if not member.isfile():
+                continue
+            # ./model.npz, ./sub_agent/model.npz など
+            path = os.path.normpath(member.name).split(os.sep)
+            if not path[-1].endswith('.npz'):
+                continue
+            d = dumped
+            for dirname in path[:-1]:
+                d = d.setdefault(dirname, {})
+            d[path[-1][:-len('.npz')]] = tar.extractfile(member).read()
+    return dumped
+
+
+def choose_action(probs: np.ndarray, rng: random.Random, deterministic: bool = False) -> int:
+    """
+    方策モデルが出力した各行動の確率から行動を選ぶ
+    :param probs: 各行動の確率(非合法手は0)
+    :param rng: サンプリングに用いる乱数(BattleStatus.rng)
+    :param deterministic: Trueなら確率最大の行動を選ぶ
+    :return: 行動の番号
+    """
+    if deterministic:
+        return int(np.argmax(probs))
+    cumsum = np.cumsum(probs, dtype=np.float64)
+    idx = int(np.searchsorted(cumsum, rng.random() * cumsum[-1], side='right'))
+    # 丸め誤差で末尾を超えた場合や、確率0の行動に当たった場合は確率が正の行動に寄せる
+    idx = min(idx, len(probs) - 1)
+    while probs[idx] <= 0.0 and idx > 0:
+        idx -= 1
+    return idx
+
+
+# chainerrlのA3C, ACERが学習のためにエピソード中に蓄積する情報
+_EPISODE_BUFFER_ATTRS = ['past_states', 'past_actions', 'past_rewards', 'past_values', 'past_action_log_prob',
+                         'past_action_entropy', 'past_action_distrib', 'past_action_values', 'past_avg_action_distrib']
+
+
+def _drop_episode(agent: "Agent"):
+    """
+    学習中のエージェントが蓄積した途中までのエピソードを、学習に用いずに破棄する
+    :param agent: chainerrlのA3C, ACERなど
+    :return:
+    """
+    for attr in _EPISODE_BUFFER_ATTRS:
+        if hasattr(agent, attr):
+            setattr(agent, attr, {})
+    if hasattr(agent, 't_start'):
+        agent.t_start = agent.t
+    replay_buffer = getattr(agent, 'replay_buffer', None)
+    if replay_buffer is not None and hasattr(replay_buffer, 'current_episode'):
+        # ACERのEpisodicReplayBufferに追加済みの、終了していないエピソード
+        replay_buffer.current_episode.clear()
+
+
 class RLPolicy(RandomPolicy):
     """
     強化学習による方策
     """
     feature_extractor: FeatureExtractor
     agent_build_params: dict
-    agent: Agent
+    agent: "Agent"
 
     def __init__(self, feature_extractor: FeatureExtractor, agent_build_params: dict):
         """
@@ -33,7 +148,12 @@ class RLPolicy(RandomPolicy):
         super().__init__()
         self.feature_extractor = feature_extractor
         self.agent_build_params = agent_build_params
-        self.agent = build_agent(agent_build_params, feature_extractor.get_dims(), feature_extractor.party_size)
+        self.agent = _build_agent(agent_build_params, feature_extractor)
+
+    def init_battle_status(self, battle_status: BattleStatus):
+        # 以前のバージョンでpickleされたFeatureExtractorにはincrementalがない
+        if getattr(self.feature_extractor, 'incremental', False):
+            self.feature_extractor.attach_buffer(battle_status)
 
     def choice_turn_start(self, battle_status: BattleStatus, request: dict) -> str:
         """
@@ -68,12 +188,20 @@ class RLPolicy(RandomPolicy):
         :return:
         """
         logger.debug(f"choice of player {battle_status.side_friend}")
+        stats = battle_status.stats
+        if stats is not None:
+            time_start = time.perf_counter()
         feat = self.feature_extractor.transform(battle_status, choice_vec)
-        logger.debug(f"feature: {feat.tolist()}")
+        if stats is not None:
+            time_start = stats.add_time_since('feature', time_start)
+        if logger.isEnabledFor(DEBUG):
+            logger.debug(f"feature: {feat.tolist()}")
         if self.train:
             action = self.agent.act_and_train(feat, 0.0)  # 0~17の番号
         else:
-            action = self.agent.act(feat)
+            action = self._act(battle_status, feat)
+        if stats is not None:
+            stats.add_time_since('model', time_start)
         for idx, key in zip(choice_idxs, choice_keys):
             if idx == action:
                 chosen = key
@@ -83,6 +211,20 @@ class RLPolicy(RandomPolicy):
         logger.debug(f"chosen: {chosen}")
         return chosen
 
+    def _act(self, battle_status: BattleStatus, feat: np.ndarray) -> int:
+        """
+        評価時の行動選択
+        agent.actと異なり、行動のサンプリングにBattleStatus.rngを用いるため、バトルのシードが同じなら同じ行動を選ぶ
+        :param battle_status:
+        :param feat: 特徴量
+        :return: 行動の番号
+        """
+        import chainer
+        with chainer.using_config('train', False), chainer.no_backprop_mode():
+            action_distrib = self.agent.model.pi(feat[np.newaxis])
+            probs = chainer.backends.cuda.to_cpu(action_distrib.all_prob.array)[0]
+        return choose_action(probs, battle_status.rng, getattr(self.agent, 'act_deterministically', False))
+
     def game_end(self, reward: float):
         if self.train:
             # done=Trueの場合はstateは使用されないので問題ない
@@ -91,37 +233,46 @@ class RLPolicy(RandomPolicy):
             # LSTMなどの場合には呼び出しが必要
             self.agent.stop_episode()
 
+    def fingerprint(self) -> Optional[str]:
+        # 評価時は行動のサンプリングにBattleStatus.rngのみを用いるため決定的
+        # 学習中はagent.act_and_trainがnumpyの乱数を用い、パラメータも変化する
+        if self.train:
+            return None
+        h = hashlib.sha1()
+        h.update(json.dumps(self.agent_build_params, sort_keys=True).encode('utf-8'))
+        h.update(json.dumps(getattr(self.agent, 'act_deterministically', False)).encode('utf-8'))
+        h.update(json.dumps([self.feature_extractor.feature_types, self.feature_extractor.party_size]).encode('utf-8'))
+        for name, param in sorted(self.agent.model.namedparams()):
+            h.update(name.encode('utf-8'))
+            h.update(np.ascontiguousarray(param.array).tobytes())
+        return f'RLPolicy({h.hexdigest()})'
+
+    def game_abort(self):
+        # 途中までのエピソードは、やり直しのエピソードと混ざらないよう終了させる
+        if self.train:
+            # 中断は本当の終端ではないため、報酬0の終端として学習せずに破棄する
+            _drop_episode(self.agent)
+        self.agent.stop_episode()
+
     def __getstate__(self):
         # pickle.dumpで呼び出される
         # agentはdumpできないので、インスタンスの生成引数を別途dictに入れる
         # エラー例: AttributeError: Can't pickle local object 'Optimizer.setup.<locals>.OptimizerHookable'
-        # 学習された重みはディレクトリに保存しそれをtarアーカイブ、バイナリ文字列として読んでpickleに保存
+        # 学習された重みはagent.saveと同じ単位(model, optimizerなど)でメモリ上のnpzにしてpickleに保存
         d = self.__dict__.copy()
         del d['agent']
-        dump_dir = tempfile.mkdtemp()  # /tmp/xyz
-        agent_dump_dir = os.path.join(dump_dir, 'agent')  # /tmp/xyz/agent
-        os.mkdir(agent_dump_dir)
-        self.agent.save(agent_dump_dir)  # /tmp/xyz/agent/model.npz など
-        tar_path_wo_ext = os.path.join(dump_dir, 'archive')
-        tar_path = tar_path_wo_ext + '.tar'
-        shutil.make_archive(tar_path_wo_ext, 'tar', agent_dump_dir)  # /tmp/xyz/archive.tar
-        with open(tar_path, 'rb') as f:
-            archive_data = f.read()  # /tmp/xyz/archive.tar の中身
-        shutil.rmtree(dump_dir)
-        d['agent_archive'] = archive_data
+        d['agent_npz'] = _dump_saved_attributes(self.agent)
         return d
 
     def __setstate__(self, state):
         state_direct = state.copy()
-        del state_direct['agent_archive']
+        state_direct.pop('agent_npz', None)
+        state_direct.pop('agent_archive', None)
         self.__dict__.update(state_direct)
-        self.agent = build_agent(self.agent_build_params, self.feature_extractor.get_dims(),
-                                 self.feature_extractor.party_size)
-        dump_dir = tempfile.mkdtemp()  # /tmp/xyz
-        tar_path = os.path.join(dump_dir, 'archive.tar')
-        with open(tar_path, 'wb') as f:  # /tmp/xyz/archive.tar を作成
-            f.write(state['agent_archive'])
-        agent_dump_dir = os.path.join(dump_dir, 'agent')  # /tmp/xyz/agent
-        shutil.unpack_archive(tar_path, agent_dump_dir)  # /tmp/xyz/agent/model.npz など
-        self.agent.load(agent_dump_dir)
-        shutil.rmtree(dump_dir)
+        self.agent = _build_agent(self.agent_build_params, self.feature_extractor)
+        if 'agent_npz' in state:
+            agent_npz = state['agent_npz']
+        else:
+            # 以前のバージョンではagent.saveで保存したディレクトリのtarアーカイブ
+            agent_npz = _read_agent_archive(state['agent_archive'])
+        _load_saved_attributes(self.agent, agent_npz)
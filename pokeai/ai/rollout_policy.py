@@ -0,0 +1,78 @@
+"""
+プレイアウトによる先読みを行う方策
+シミュレータ内でバトルを複製し、取れる行動ごとにランダムなプレイアウトを行って価値の高い行動を選ぶ。
+プレイアウトはシミュレータ(js/simpipe)内で一括して行うため、1回の行動選択でpythonとの通信は1往復となる。
+"""
+from typing import Optional
+
+from pokeai.ai.action_policy import ActionPolicy
+from pokeai.ai.battle_status import BattleStatus
+from pokeai.ai.common import get_possible_actions
+from pokeai.ai.random_policy import RandomPolicy
+
+
+class RolloutPolicy(ActionPolicy):
+    n_rollouts: int  # 1行動あたりのプレイアウト回数
+    max_turns: Optional[int]  # プレイアウトで進めるターン数の上限
+    fallback: ActionPolicy  # バトルを参照できない場合(AsyncSimなど)の方策
+
+    def __init__(self, n_rollouts: int = 32, max_turns: Optional[int] = None,
+                 fallback: Optional[ActionPolicy] = None):
+        """
+        :param n_rollouts: 1行動あたりのプレイアウト回数
+        :param max_turns: プレイアウトで進めるターン数の上限。到達した場合は残りHPの割合の差で評価する。
+        :param fallback: バトルを参照できない場合の方策。NoneならRandomPolicy
+        """
+        super().__init__()
+        self.n_rollouts = n_rollouts
+        self.max_turns = max_turns
+        self.fallback = fallback or RandomPolicy()
+
+    def choice_turn_start(self, battle_status: BattleStatus, request: dict) -> str:
+        """
+        ターン開始時の行動選択
+        :param battle_status:
+        :param request:
+        :return: 行動。"move [1-4]|switch [1-6]"
+        """
+        chosen = self._choice_by_rollout(battle_status, request)
+        if chosen is None:
+            return self.fallback.choice_turn_start(battle_status, request)
+        return chosen
+
+    def choice_force_switch(self, battle_status: BattleStatus, request: dict) -> str:
+        """
+        強制交換時の行動選択
+        :param battle_status:
+        :param request:
+        :return: 行動。"switch [1-6]"
+        """
+        chosen = self._choice_by_rollout(battle_status, request)
+        if chosen is None:
+            return self.fallback.choice_force_switch(battle_status, request)
+        return chosen
+
+    def _choice_by_rollout(self, battle_status: BattleStatus, request: dict) -> Optional[str]:
+        """
+        各行動のプレイアウトの平均価値が最大の行動を選ぶ
+        :return: バトルを参照できない場合None
+        """
+        if battle_status.battle_ref is None:
+            return None
+        choice_idxs, choice_keys, _ = get_possible_actions(battle_status, request)
+        if len(choice_keys) == 1:
+            return choice_keys[0]
+        # プレイアウトの乱数もBattleStatus.rngから決め、バトルのシードが同じなら同じ行動を選ぶようにする
+        seed = [battle_status.rng.randrange(0x10000) for _ in range(4)]
+        values = battle_status.battle_ref.rollout(battle_status.side_friend, choice_keys, self.n_rollouts,
+                                                  self.max_turns, seed)
+        if len(values) == 0:
+            # シミュレータ上にバトルが存在しない
+            return None
+        return max(choice_keys, key=lambda key: values[key]['value'])
+
+    def fingerprint(self) -> Optional[str]:
+        fallback_fingerprint = self.fallback.fingerprint()
+        if fallback_fingerprint is None:
+            return None
+        return f'RolloutPolicy(n_rollouts={self.n_rollouts},max_turns={self.max_turns},fallback={fallback_fingerprint})'
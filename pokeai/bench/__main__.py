@@ -0,0 +1,69 @@
+"""
+バトル処理のスループットのベンチマーク一式
+パーティと乱数のシードを固定して実行し、結果をjsonで出力する。コミット間で結果を比較して性能の退行を検出する。
+
+python -m pokeai.bench -n 100 --out bench_result.json
+"""
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+
+from pokeai.bench import battle_bench, simpipe_bench, transport_bench, processor_bench
+from pokeai.util import ROOT_DIR, json_dump, yaml_load
+
+SUITES = {
+    'battle': battle_bench,
+    'simpipe': simpipe_bench,
+    'transport': transport_bench,
+    'processor': processor_bench,
+}
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=str(ROOT_DIR), stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=100, help="バトル数")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--suites", default=','.join(SUITES.keys()), help="実行するベンチマーク(カンマ区切り)")
+    parser.add_argument("--corpus", help="processorベンチマークのコーパスのパス(なければ生成する)")
+    parser.add_argument("--agent_params", help="RLPolicyのモデル構造パラメータファイル")
+    parser.add_argument("--out", help="結果のjsonファイル。指定しない場合は標準出力")
+    args = parser.parse_args()
+    results = []
+    for suite_name in args.suites.split(','):
+        suite = SUITES[suite_name]
+        if suite is processor_bench:
+            agent_params = yaml_load(args.agent_params) if args.agent_params else None
+            suite_results = suite.run(args.n, args.seed, args.corpus, agent_params)
+        else:
+            suite_results = suite.run(args.n, args.seed)
+        for result in suite_results:
+            result['suite'] = suite_name
+            print(json.dumps(result), file=sys.stderr)
+            results.append(result)
+    report = {
+        'commit': _git_commit(),
+        'time': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'n': args.n,
+        'seed': args.seed,
+        'results': results,
+    }
+    if args.out:
+        json_dump(report, args.out)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+ランダム方策同士のバトルのスループット
+Sim.runで1バトルずつ行う場合と、run_manyで多重化する場合、シミュレータ内で行動選択まで行う場合(fast_path)を計測する
+
+python -m pokeai.bench.battle_bench -n 100
+"""
+import argparse
+import json
+from typing import List
+
+from pokeai.ai.random_policy import RandomPolicy
+from pokeai.bench.common import fixed_parties, bench_result, Timer
+from pokeai.sim.battle_stream_processor import BattleStreamProcessor
+from pokeai.sim.party_generator import Party
+from pokeai.sim.sim import Sim
+
+
+def _make_processors(policy) -> List[BattleStreamProcessor]:
+    processors = []
+    for _ in range(2):
+        bsp = BattleStreamProcessor()
+        bsp.set_policy(policy)
+        processors.append(bsp)
+    return processors
+
+
+def bench_sim_run(parties_list: List[List[Party]], seed: int) -> dict:
+    sim = Sim(fast_path=False)
+    policy = RandomPolicy()
+    sim.supervisor.get()  # nodeの起動時間を計測に含めない
+    with Timer() as timer:
+        for i, parties in enumerate(parties_list):
+            sim.set_party(parties)
+            sim.set_processor(_make_processors(policy))
+            sim.run(seed=f'{seed}:{i}')
+    sim.close()
+    return bench_result('sim_run', len(parties_list), timer.elapsed)
+
+
+def bench_sim_run_many(parties_list: List[List[Party]], seed: int, fast_path: bool) -> dict:
+    sim = Sim(fast_path=fast_path)
+    sim.supervisor.get()
+    policy = RandomPolicy()
+    jobs = [(parties, _make_processors(policy), f'{seed}:{i}') for i, parties in enumerate(parties_list)]
+    with Timer() as timer:
+        for _ in sim.run_many(jobs):
+            pass
+    sim.close()
+    return bench_result('sim_run_many_fast_path' if fast_path else 'sim_run_many', len(parties_list), timer.elapsed,
+                        max_parallel=sim.max_parallel)
+
+
+def run(n: int, seed: int) -> List[dict]:
+    parties_list = fixed_parties(n, seed)
+    return [
+        bench_sim_run(parties_list, seed),
+        bench_sim_run_many(parties_list, seed, fast_path=False),
+        bench_sim_run_many(parties_list, seed, fast_path=True),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=100, help="バトル数")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    for result in run(args.n, args.seed):
+        print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
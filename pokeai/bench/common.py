@@ -0,0 +1,63 @@
+"""
+ベンチマークの共通処理
+パーティ・乱数のシードを固定し、結果を1件ごとにdict(json)で表す
+"""
+import random
+import time
+from typing import List
+
+from pokeai.sim.party_generator import Party
+from pokeai.sim.random_party_generator import RandomPartyGenerator
+from pokeai.util import ROOT_DIR
+
+BENCH_DIR = ROOT_DIR.joinpath('data', 'bench')
+
+
+def fixed_parties(n: int, seed: int) -> List[List[Party]]:
+    """
+    ベンチマーク用の対戦パーティの組をシードから決定的に生成する
+    :param n: 組の数
+    :param seed:
+    :return: [[パーティ, パーティ], ...]
+    """
+    random.seed(seed)
+    party_generator = RandomPartyGenerator()
+    return [[party_generator.generate(), party_generator.generate()] for _ in range(n)]
+
+
+def bench_result(name: str, n: int, elapsed: float, unit: str = 'battle', **extra) -> dict:
+    """
+    ベンチマーク1件の結果
+    :param name: ベンチマーク名
+    :param n: 処理した件数
+    :param elapsed: 経過時間(秒)
+    :param unit: 件数の単位
+    :param extra: その他の計測値
+    :return:
+    """
+    result = {
+        'name': name,
+        'unit': unit,
+        'n': n,
+        'elapsed': elapsed,
+        'per_sec': n / elapsed if elapsed > 0 else None,
+    }
+    result.update(extra)
+    return result
+
+
+class Timer:
+    """
+    with文で囲んだ区間の経過時間を計測する
+    """
+    elapsed: float
+
+    def __init__(self):
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.elapsed += time.perf_counter() - self._start
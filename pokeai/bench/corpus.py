@@ -0,0 +1,121 @@
+"""
+シミュレータの出力を記録したバトルのコーパス
+プロセッサ・特徴抽出のベンチマークで、シミュレータを動かさずに同じ入力を再生するために用いる
+
+コーパスの形式(json):
+[{"parties": [パーティ, パーティ], "chunks": [[chunkの種類, side, 本体], ...]}, ...]
+"""
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+from pokeai.ai.action_policy import ActionPolicy
+from pokeai.ai.battle_status import BattleStatus
+from pokeai.ai.feature_extractor import FeatureExtractor
+from pokeai.ai.random_policy import RandomPolicy
+from pokeai.bench.common import BENCH_DIR, fixed_parties
+from pokeai.sim.battle_stream_processor import BattleStreamProcessor
+from pokeai.sim.sim import Sim, BattleContext
+from pokeai.sim.transport import make_transport
+from pokeai.util import json_load, json_dump
+
+DEFAULT_CORPUS_PATH = BENCH_DIR.joinpath('battle_corpus.json')
+
+
+def record_corpus(n: int, seed: int) -> List[dict]:
+    """
+    ランダム方策同士のバトルを行い、シミュレータの出力を記録する
+    :param n: バトル数
+    :param seed:
+    :return: コーパス
+    """
+    parties_list = fixed_parties(n, seed)
+    sim = Sim(transport=make_transport('json', record=True), fast_path=False)
+    policy = RandomPolicy()
+    jobs = []
+    for i, parties in enumerate(parties_list):
+        processors = []
+        for _ in range(2):
+            bsp = BattleStreamProcessor()
+            bsp.set_policy(policy)
+            processors.append(bsp)
+        jobs.append((parties, processors, f'{seed}:{i}'))
+    for _ in sim.run_many(jobs):
+        pass
+    corpus = [{'parties': parties, 'chunks': []} for parties in parties_list]
+    for raw in sim.transport.record:
+        # 新しいSimではバトルIDはjobsのインデックスと一致する
+        battle_id, chunk_type, side, chunk_data = sim.transport.decode(raw)
+        corpus[battle_id]['chunks'].append([chunk_type, side, chunk_data])
+    sim.close()
+    return corpus
+
+
+def load_corpus(n: int, seed: int, path: Optional[Union[str, Path]] = None) -> List[dict]:
+    """
+    コーパスを読み込む。ファイルがなければ生成して保存する。
+    コミット間で比較する場合は同じファイルを用いること(シミュレータの変更で出力が変わりうるため)。
+    """
+    path = Path(path) if path else DEFAULT_CORPUS_PATH
+    if path.exists():
+        corpus = json_load(path)
+        if len(corpus) >= n:
+            return corpus[:n]
+    corpus = record_corpus(n, seed)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    json_dump(corpus, path)
+    return corpus
+
+
+class NullPolicy(ActionPolicy):
+    """
+    常にdefault(シミュレータの既定の行動)を返す方策。コーパスの再生時に方策の計算量を除くために用いる。
+    """
+
+    def choice_turn_start(self, battle_status: BattleStatus, request: dict) -> str:
+        return 'default'
+
+    def choice_force_switch(self, battle_status: BattleStatus, request: dict) -> str:
+        return 'default'
+
+
+class CapturePolicy(NullPolicy):
+    """
+    行動選択時のバトル状態とrequestを記録する方策
+    """
+    captured: List[Tuple[BattleStatus, dict]]
+    feature_extractor: Optional[FeatureExtractor]
+
+    def __init__(self, feature_extractor: Optional[FeatureExtractor] = None):
+        """
+        :param feature_extractor: 指定した場合、バトル状態に特徴量のバッファを持たせる(FeatureExtractor.attach_buffer)
+        """
+        super().__init__()
+        self.captured = []
+        self.feature_extractor = feature_extractor
+
+    def init_battle_status(self, battle_status: BattleStatus):
+        if self.feature_extractor is not None:
+            self.feature_extractor.attach_buffer(battle_status)
+
+    def choice_turn_start(self, battle_status: BattleStatus, request: dict) -> str:
+        self.captured.append((battle_status.copy(), request))
+        return super().choice_turn_start(battle_status, request)
+
+    def choice_force_switch(self, battle_status: BattleStatus, request: dict) -> str:
+        self.captured.append((battle_status.copy(), request))
+        return super().choice_force_switch(battle_status, request)
+
+
+def replay_battle(battle_record: dict, policy: ActionPolicy):
+    """
+    記録されたバトルの出力を、新しいプロセッサで処理する
+    """
+    processors = []
+    for _ in range(2):
+        bsp = BattleStreamProcessor()
+        bsp.set_policy(policy)
+        processors.append(bsp)
+    battle = BattleContext(0, battle_record['parties'], processors)
+    battle.start()
+    for chunk_type, side, chunk_data in battle_record['chunks']:
+        battle.process_chunk(chunk_type, side, chunk_data)
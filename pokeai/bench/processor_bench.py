@@ -0,0 +1,125 @@
+"""
+python側の処理単体のスループット
+processor: 記録したコーパスをBattleStreamProcessorで処理する(方策の計算を除く)
+feature: FeatureExtractor.transformのみ
+feature_incremental: 特徴量のバッファ(FeatureExtractor(incremental=True))を用いたtransform
+feature_batch: FeatureExtractor.transform_batchでコーパス全体を一度に変換
+rl_policy: RLPolicyの行動選択1回の所要時間
+
+python -m pokeai.bench.processor_bench -n 100
+"""
+import argparse
+import json
+import time
+from typing import List, Optional
+
+import numpy as np
+
+from pokeai.ai.common import get_possible_actions
+from pokeai.ai.feature_extractor import FeatureExtractor
+from pokeai.bench.common import bench_result, Timer
+from pokeai.bench.corpus import load_corpus, replay_battle, NullPolicy, CapturePolicy
+from pokeai.util import yaml_load
+
+# --agent_paramsを指定しない場合のモデル構造
+DEFAULT_AGENT_PARAMS = {
+    'version': 2,
+    'model': {
+        'type': 'A3CSeparateModel',
+        'pi': {'kwargs': {'n_hidden_layers': 2, 'n_hidden_channels': 64}},
+        'v': {'kwargs': {'n_hidden_layers': 2, 'n_hidden_channels': 64}},
+    },
+    'agent': {'type': 'A3C'},
+}
+
+
+def bench_processor(corpus: List[dict]) -> dict:
+    policy = NullPolicy()
+    n_chunks = sum(len(battle_record['chunks']) for battle_record in corpus)
+    with Timer() as timer:
+        for battle_record in corpus:
+            replay_battle(battle_record, policy)
+    return bench_result('processor', len(corpus), timer.elapsed, chunks=n_chunks)
+
+
+def capture_choices(corpus: List[dict], feature_extractor: Optional[FeatureExtractor] = None) -> list:
+    """
+    コーパスの各行動選択時の(バトル状態, request, choice_vec)
+    :param feature_extractor: 指定した場合、バトル状態に特徴量のバッファを持たせる
+    """
+    policy = CapturePolicy(feature_extractor)
+    for battle_record in corpus:
+        replay_battle(battle_record, policy)
+    captured = []
+    for battle_status, request in policy.captured:
+        _, _, choice_vec = get_possible_actions(battle_status, request)
+        captured.append((battle_status, request, choice_vec.copy()))
+    return captured
+
+
+def bench_feature(captured: list, feature_extractor: Optional[FeatureExtractor] = None,
+                  name: str = 'feature') -> dict:
+    feature_extractor = feature_extractor or FeatureExtractor()
+    with Timer() as timer:
+        for battle_status, _, choice_vec in captured:
+            feature_extractor.transform(battle_status, choice_vec)
+    return bench_result(name, len(captured), timer.elapsed, unit='transform')
+
+
+def bench_feature_batch(captured: list) -> dict:
+    feature_extractor = FeatureExtractor()
+    battle_statuses = [battle_status for battle_status, _, _ in captured]
+    choice_vecs = np.stack([choice_vec for _, _, choice_vec in captured])
+    out = np.empty((len(captured), feature_extractor.get_dims()), dtype=np.float32)
+    with Timer() as timer:
+        feature_extractor.transform_batch(battle_statuses, choice_vecs, out)
+    return bench_result('feature_batch', len(captured), timer.elapsed, unit='transform')
+
+
+def bench_rl_policy(captured: list, seed: int, agent_params: Optional[dict] = None) -> dict:
+    from pokeai.ai.rl_policy import RLPolicy  # chainerが必要なため、このベンチマークでのみimport
+    np.random.seed(seed)
+    policy = RLPolicy(FeatureExtractor(), agent_params or DEFAULT_AGENT_PARAMS)
+    latencies = []
+    for battle_status, request, _ in captured:
+        time_start = time.perf_counter()
+        if request.get('forceSwitch'):
+            policy.choice_force_switch(battle_status, request)
+        else:
+            policy.choice_turn_start(battle_status, request)
+        latencies.append(time.perf_counter() - time_start)
+    latencies = np.array(latencies)
+    return bench_result('rl_policy', len(captured), float(np.sum(latencies)), unit='act',
+                        latency_mean=float(np.mean(latencies)),
+                        latency_p50=float(np.percentile(latencies, 50)),
+                        latency_p99=float(np.percentile(latencies, 99)))
+
+
+def run(n: int, seed: int, corpus_path: Optional[str] = None, agent_params: Optional[dict] = None) -> List[dict]:
+    corpus = load_corpus(n, seed, corpus_path)
+    captured = capture_choices(corpus)
+    incremental_extractor = FeatureExtractor(incremental=True)
+    captured_incremental = capture_choices(corpus, incremental_extractor)
+    return [
+        bench_processor(corpus),
+        bench_feature(captured),
+        bench_feature(captured_incremental, incremental_extractor, 'feature_incremental'),
+        bench_feature_batch(captured),
+        bench_rl_policy(captured, seed, agent_params),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=100, help="コーパスのバトル数")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--corpus", help="コーパスのパス(なければ生成する)")
+    parser.add_argument("--agent_params", help="RLPolicyのモデル構造パラメータファイル")
+    args = parser.parse_args()
+    agent_params = yaml_load(args.agent_params) if args.agent_params else None
+    for result in run(args.n, args.seed, args.corpus, agent_params):
+        print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
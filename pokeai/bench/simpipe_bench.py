@@ -0,0 +1,87 @@
+"""
+シミュレータ単体のスループット
+simpipe: pythonの方策を使わず、要求に決まった行動(default)を返すだけでバトルを進める
+node: js/random.js (nodeのプロセス内でRandomPlayerAI同士が対戦する。python側の処理を含まない上限値の目安)
+
+python -m pokeai.bench.simpipe_bench -n 100
+"""
+import argparse
+import json
+import subprocess
+from typing import List
+
+from pokeai.bench.common import fixed_parties, bench_result, Timer
+from pokeai.sim.party_generator import Party
+from pokeai.sim.sim import simpipe_command, make_seed, _makePartySpec
+from pokeai.sim.sim_process import SimProcess
+from pokeai.sim.transport import make_transport
+from pokeai.util import ROOT_DIR
+
+
+def _start_commands(parties: List[Party], seed) -> List[str]:
+    spec = {'formatid': 'gen2customgame', 'seed': make_seed(seed)}
+    return [
+        f'>start {json.dumps(spec)}',
+        f'>player p1 {json.dumps(_makePartySpec("p1", parties[0]))}',
+        f'>player p2 {json.dumps(_makePartySpec("p2", parties[1]))}',
+    ]
+
+
+def bench_simpipe(parties_list: List[List[Party]], seed: int, transport_name: str = 'json',
+                  max_parallel: int = 32) -> dict:
+    transport = make_transport(transport_name)
+    sim_process = SimProcess(simpipe_command(transport, True), transport)
+    next_idx = 0
+    in_flight = set()
+    n_chunks = 0
+    with Timer() as timer:
+        while next_idx < len(parties_list) or len(in_flight) > 0:
+            while next_idx < len(parties_list) and len(in_flight) < max_parallel:
+                sim_process.write(transport.encode(next_idx, _start_commands(parties_list[next_idx],
+                                                                             f'{seed}:{next_idx}')))
+                in_flight.add(next_idx)
+                next_idx += 1
+            battle_id, chunk_type, side, chunk_data = sim_process.read(None)
+            n_chunks += 1
+            if chunk_type == 'end':
+                in_flight.discard(battle_id)
+            elif chunk_type == 'sideupdate':
+                if chunk_data.startswith('|request|') and '"wait":true' not in chunk_data:
+                    sim_process.write(transport.encode(battle_id, [f'>{side} default']))
+            elif chunk_type == 'update' and side == 'p1' and '|turn|100' in chunk_data:
+                sim_process.write(transport.encode(battle_id, ['>forcetie']))
+    sim_process.close()
+    return bench_result(f'simpipe_{transport_name}', len(parties_list), timer.elapsed, chunks=n_chunks,
+                        bytes_read=transport.bytes_read, bytes_written=transport.bytes_written)
+
+
+def bench_node_random(n: int) -> dict:
+    """
+    js/random.jsによる、node内で完結するバトルのスループット
+    パーティはjs側でランダムに生成するため、他のベンチマークとはパーティが異なる
+    """
+    with Timer() as timer:
+        subprocess.run(['node', 'js/random.js', str(n)], cwd=str(ROOT_DIR), stdout=subprocess.DEVNULL, check=True)
+    return bench_result('node_random', n, timer.elapsed)
+
+
+def run(n: int, seed: int) -> List[dict]:
+    parties_list = fixed_parties(n, seed)
+    return [
+        bench_simpipe(parties_list, seed, 'json'),
+        bench_simpipe(parties_list, seed, 'framed'),
+        bench_node_random(n),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=100, help="バトル数")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    for result in run(args.n, args.seed):
+        print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
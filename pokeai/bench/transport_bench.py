@@ -0,0 +1,69 @@
+"""
+シミュレータとの通信方式(json, framed)のマイクロベンチマーク
+同じパーティ・ランダム方策で各方式のバトルを行い、1バトルあたりの通信バイト数と受信データのパース時間を計測する
+
+python -m pokeai.bench.transport_bench -n 100
+"""
+import argparse
+import json
+import time
+from typing import List
+
+from pokeai.ai.random_policy import RandomPolicy
+from pokeai.bench.common import fixed_parties
+from pokeai.sim.battle_stream_processor import BattleStreamProcessor
+from pokeai.sim.sim import Sim
+from pokeai.sim.transport import TRANSPORTS, make_transport
+
+
+def bench_transport(transport_name: str, parties_list, seed: int) -> dict:
+    sim = Sim(transport=make_transport(transport_name, record=True), fast_path=False)
+    policy = RandomPolicy()
+    jobs = []
+    for parties in parties_list:
+        processors = []
+        for _ in range(2):
+            bsp = BattleStreamProcessor()
+            bsp.set_policy(policy)
+            processors.append(bsp)
+        jobs.append((parties, processors, f'{seed}:{len(jobs)}'))
+    time_start = time.perf_counter()
+    for _ in sim.run_many(jobs):
+        pass
+    elapsed = time.perf_counter() - time_start
+    sim.close()
+    transport = sim.transport
+    # 記録した受信データのパースのみを再度行って計測
+    parse_start = time.perf_counter()
+    for raw in transport.record:
+        transport.decode(raw)
+    parse_time = time.perf_counter() - parse_start
+    n_battles = len(parties_list)
+    return {
+        'name': f'transport_{transport_name}',
+        'transport': transport_name,
+        'battles': n_battles,
+        'chunks_read': len(transport.record),
+        'bytes_read_per_battle': transport.bytes_read / n_battles,
+        'bytes_written_per_battle': transport.bytes_written / n_battles,
+        'parse_time_per_battle': parse_time / n_battles,
+        'wall_time_per_battle': elapsed / n_battles,
+    }
+
+
+def run(n: int, seed: int) -> List[dict]:
+    parties_list = fixed_parties(n, seed)
+    return [bench_transport(transport_name, parties_list, seed) for transport_name in TRANSPORTS.keys()]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=100, help="バトル数")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    for result in run(args.n, args.seed):
+        print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""
+asyncioによるシミュレータラッパー
+1つのイベントループ上で多数のバトルを同時に進行させる
+"""
+import asyncio
+import inspect
+from typing import List, Dict, Optional, Iterable, Union
+from logging import getLogger
+
+from pokeai.sim.battle_stream_processor import BattleStreamProcessor
+from pokeai.sim.party_generator import Party
+from pokeai.sim.sim import BattleContext, BattleJob, BattleSeed, format_command, make_seed, simpipe_command
+from pokeai.sim.transport import Transport, make_transport
+from pokeai.util import ROOT_DIR
+
+logger = getLogger(__name__)
+
+
+class AsyncSim:
+    """
+    asyncio版シミュレータ
+    await sim.run(...)でシミュレータの応答を待つ間、他のバトルや方策の計算に処理を譲る。
+    ActionPolicyのchoice_turn_start, choice_force_switch, game_endはcoroutine(async def)でもよい。
+    Simと異なりSimSupervisorは使わず、RESTART_BATTLESごとにプロセスを再起動するのみ。
+    プロセスが異常終了した場合、進行中のバトルはやり直さずにRuntimeErrorとなる。
+    """
+    RESTART_BATTLES = 1000  # このバトル数ごとにシミュレータプロセスを再起動する
+    proc: Optional[asyncio.subprocess.Process]
+    transport: Transport
+    n_battle: int
+    _queues: Dict[int, asyncio.Queue]  # バトルID => そのバトル宛てのchunkのキュー
+    _next_battle_id: int
+
+    def __init__(self, transport: Union[str, Transport] = 'json', split_in_node: bool = False):
+        """
+        :param transport: シミュレータとの通信方式 ('json' or 'framed')またはTransportインスタンス
+        :param split_in_node: updateの各プレイヤー向けへの分割をシミュレータ側で行う。
+            False(既定)の場合は受信したupdateを1回だけトークン化し、両プレイヤーのプロセッサでイベントを共有する。
+        """
+        self.proc = None
+        self.transport = transport if isinstance(transport, Transport) else make_transport(transport)
+        self.split_in_node = split_in_node
+        self.n_battle = 0
+        self._queues = {}
+        self._next_battle_id = 0
+        self._reader_task = None
+        # イベントループ上で生成する必要があるため、最初のrunで生成
+        self._proc_lock = None
+        self._idle = None  # 進行中のバトルがないときにセット
+
+    async def _ensure_proc(self):
+        if self._proc_lock is None:
+            self._proc_lock = asyncio.Lock()
+            self._idle = asyncio.Event()
+            self._idle.set()
+        async with self._proc_lock:
+            # 長く運用するとクラッシュすることがあるので定期的に再起動
+            # 進行中のバトルが終わるのを待ってから再起動する。その間新しいバトルは開始しない。
+            while self.n_battle >= AsyncSim.RESTART_BATTLES:
+                if len(self._queues) == 0:
+                    await self.close()
+                    self.n_battle = 0
+                else:
+                    await self._idle.wait()
+            if self.proc is None:
+                # 1 chunkが長い場合があるので、行の長さの上限を大きくしておく
+                self.proc = await asyncio.create_subprocess_exec(*simpipe_command(self.transport,
+                                                                                  self.split_in_node),
+                                                                 stdin=asyncio.subprocess.PIPE,
+                                                                 stdout=asyncio.subprocess.PIPE, cwd=str(ROOT_DIR),
+                                                                 limit=2 ** 24)
+                self._reader_task = asyncio.ensure_future(self._read_loop(self.proc))
+
+    async def close(self):
+        """
+        シミュレータプロセスを終了する
+        """
+        if self.proc is None:
+            return
+        self.proc.stdin.close()
+        self.proc.terminate()
+        await self.proc.wait()
+        self._reader_task.cancel()
+        self.proc = None
+        self._reader_task = None
+
+    async def _read_loop(self, proc: asyncio.subprocess.Process):
+        # シミュレータからのchunkをバトルIDごとのキューに振り分ける
+        while True:
+            raw_chunk = await self.transport.read_async(proc.stdout)
+            if raw_chunk is None:
+                break
+            logger.debug("readChunk %s", raw_chunk)
+            battle_id, chunk_type, side, chunk_data = raw_chunk
+            queue = self._queues.get(battle_id)
+            if queue is None:
+                # 方策などの例外で中断されたバトル宛ての残りのchunk
+                logger.debug("chunk for finished battle %s", battle_id)
+                continue
+            queue.put_nowait((chunk_type, side, chunk_data))
+        if self.proc is proc:
+            # 予期せぬプロセス終了。待っているバトルに通知する
+            for queue in self._queues.values():
+                queue.put_nowait(None)
+
+    def _writeChunk(self, battle_id: int, commands: List[str]):
+        logger.debug("writeChunk %s %s", battle_id, commands)
+        self.proc.stdin.write(self.transport.encode(battle_id, commands))
+
+    async def run(self, parties: List[Party], processors: List[BattleStreamProcessor],
+                  seed: Union[int, str, BattleSeed, None] = None) -> dict:
+        """
+        バトルを１回行う
+        同時に進行するバトルで同じActionPolicyインスタンスを共有する場合、そのpolicyはバトルごとの内部状態を持たないこと
+        :param parties: パーティ2つ
+        :param processors: プロセッサ2つ。バトルごとに別のインスタンスとすること。
+        :param seed: 乱数のシード
+        :return: endメッセージの内容 {'winner': 'p1', 'turns': 34, ...}
+        """
+        await self._ensure_proc()
+        self.n_battle += 1
+        battle_id = self._next_battle_id
+        self._next_battle_id += 1
+        queue = asyncio.Queue()
+        self._queues[battle_id] = queue
+        self._idle.clear()
+        try:
+            battle = BattleContext(battle_id, parties, processors, make_seed(seed))
+            self._writeChunk(battle_id, battle.start())
+            while True:
+                item = await queue.get()
+                if item is None:
+                    raise RuntimeError("simulator process exited unexpectedly")
+                chunk_type, side, chunk_data = item
+                battle_result, choices = battle.process_chunk(chunk_type, side, chunk_data)
+                if len(choices) > 0:
+                    # 方策がcoroutineの場合、両プレイヤーの行動選択を並行して待つ
+                    choice_values = await asyncio.gather(*[_resolve(choice) for _, choice in choices])
+                    self._writeChunk(battle_id, [format_command(side, choice_value)
+                                                 for (side, _), choice_value in zip(choices, choice_values)])
+                    await self.proc.stdin.drain()
+                if battle_result is not None:
+                    await asyncio.gather(*[_resolve(ret) for ret in battle.end(battle_result)])
+                    return battle_result
+        finally:
+            del self._queues[battle_id]
+            if len(self._queues) == 0:
+                self._idle.set()
+
+    async def run_many(self, jobs: Iterable[BattleJob], max_parallel: int = 256) -> List[dict]:
+        """
+        複数のバトルを同時に進行させる
+        :param jobs: (パーティ2つ, プロセッサ2つ[, シード])の列
+        :param max_parallel: 同時に進行させるバトル数の上限
+        :return: jobsと同じ順序のendメッセージの内容のリスト
+        """
+        semaphore = asyncio.Semaphore(max_parallel)
+
+        async def run_one(job: BattleJob):
+            async with semaphore:
+                return await self.run(*job)
+
+        return await asyncio.gather(*[run_one(job) for job in jobs])
+
+
+async def _resolve(value):
+    if inspect.isawaitable(value):
+        return await value
+    return value
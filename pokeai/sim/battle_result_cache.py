@@ -0,0 +1,84 @@
+"""
+バトル結果のキャッシュ
+パーティ・方策・乱数のシードが同じで、方策が決定的であればバトル結果は同じになるため、再度バトルを行わずに済む。
+キーは(両パーティのpacked形式, 両方策のfingerprint, シード, 行動選択をシミュレータ内で行うか)。シードがない場合や方策が決定的でない場合はキャッシュしない。
+"""
+import copy
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from typing import List, Optional, Union
+
+from pokeai.ai.action_policy import ActionPolicy
+from pokeai.sim.pack_team import pack_team_cached
+from pokeai.sim.party_generator import Party
+from pokeai.sim.sim import BattleSeed, make_seed
+from pokeai.util import pickle_load, pickle_dump
+
+
+def battle_cache_key(parties: List[Party], policies: List[ActionPolicy],
+                     seed: Union[int, str, BattleSeed, None], fast_path: bool = False) -> Optional[str]:
+    """
+    キャッシュのキーを作る
+    :param fast_path: バトルを実行するSimのfast_path。
+        シミュレータ内で行動選択まで行うバトルは、同じシードでもpython側で行動選択する場合と異なるバトルになるため、キーを区別する。
+    :return: キャッシュできないバトルの場合None
+    """
+    seed = make_seed(seed)
+    if seed is None:
+        return None
+    fingerprints = [policy.fingerprint() for policy in policies]
+    if any(fp is None for fp in fingerprints):
+        return None
+    in_simulator = fast_path and all(policy.simple_spec() is not None for policy in policies)
+    key_src = json.dumps([[pack_team_cached(party) for party in parties], fingerprints, seed,
+                          'simulator' if in_simulator else 'python'])
+    return hashlib.sha1(key_src.encode('utf-8')).hexdigest()
+
+
+class BattleResultCache:
+    """
+    バトル結果(endメッセージの内容)のLRUキャッシュ
+    pathを指定した場合、loadで読み込み、saveで書き出せる
+    """
+    maxsize: Optional[int]
+    path: Optional[str]
+    hits: int
+    misses: int
+
+    def __init__(self, maxsize: Optional[int] = None, path: Optional[str] = None):
+        self.maxsize = maxsize
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        if path is not None and os.path.exists(path):
+            self._cache.update(pickle_load(path))
+
+    def get(self, key: Optional[str]) -> Optional[dict]:
+        if key is None:
+            return None
+        battle_result = self._cache.get(key)
+        if battle_result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._cache.move_to_end(key)
+        return copy.deepcopy(battle_result)
+
+    def put(self, key: Optional[str], battle_result: dict):
+        if key is None:
+            return
+        self._cache[key] = copy.deepcopy(battle_result)
+        self._cache.move_to_end(key)
+        if self.maxsize is not None:
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def save(self):
+        if self.path is not None:
+            pickle_dump(self._cache, self.path)
+
+    def __len__(self):
+        return len(self._cache)
@@ -4,11 +4,15 @@
 import json
 import random
 import re
+import time
 from typing import Optional, List, Tuple
-from logging import getLogger
+from logging import getLogger, DEBUG
 
-from pokeai.ai.battle_status import BattleStatus, parse_hp_condition
+from pokeai.ai.action_mapper import ActionMapper
+from pokeai.ai.battle_status import BattleStatus, ActivePokeStatus
 from pokeai.sim.party_generator import Party
+from pokeai.sim.protocol import BattleEvent, tokenize
+from pokeai.sim.sim_stats import SimStats
 
 logger = getLogger(__name__)
 
@@ -17,10 +21,12 @@ class BattleStreamProcessor:
     side: Optional[str]  # p1 or p2
     side_party: Optional[Party]  # プレイヤー側のパーティ
     last_request: dict  # 最新の行動選択時における味方の状態
+    replaying: bool  # 複製・復元されたバトルのログを再生中(行動選択をしない)
+    stats: Optional[SimStats]  # 計測が有効な場合、バトルごとの計測結果
     battle_status: BattleStatus
     policy: "ActionPolicy"
     # 処理しないメッセージ（進行上重要でなく、AIの判断に使わない情報）
-    ignore_msgs = ['',
+    ignore_msgs = frozenset(['',
                    'debug',
                    'player',
                    'gametype',
@@ -57,12 +63,13 @@ class BattleStreamProcessor:
                    'cant',  # 麻痺などで行動ができない
                    'win',  # 勝敗決定(勝者の取得は別途endメッセージで行う)
                    'tie',  # 引き分け(forcetieで発生)
-                   ]
+                   ])
 
     def __init__(self):
         self.side = None
         self.side_party = None
         self.policy = None
+        self.stats = None
         self._handlers = {
             'request': self._handle_request,
             'switch': self._handle_switch,
@@ -91,18 +98,28 @@ class BattleStreamProcessor:
     def set_policy(self, policy: "ActionPolicy"):
         self.policy = policy
 
-    def start_battle(self, side: str, side_party: Party):
+    def start_battle(self, side: str, side_party: Party, rng_seed=None, battle_ref=None,
+                     stats: Optional[SimStats] = None):
         """
         バトルの開始。バトルの状態を初期化する。
         :param side:
+        :param rng_seed: 方策が用いる乱数(BattleStatus.rng)のシード
+        :param battle_ref: 方策がシミュレータ上のバトルを参照するためのもの(BattleStatus.battle_ref)
+        :param stats: 指定した場合、処理時間・メッセージ数を記録する
         :return:
         """
         assert self.policy is not None
         self.side = side
         self.side_party = side_party
         self.last_request = None
+        self.replaying = False
         # FIXME: BattleStatusと責任境界が分かれてない
-        self.battle_status = BattleStatus(side, side_party)
+        self.battle_status = BattleStatus(side, side_party, rng_seed)
+        self.battle_status.battle_ref = battle_ref
+        self.battle_status.stats = stats
+        self.battle_status.action_mapper = ActionMapper(side, side_party)
+        self.stats = stats
+        self.policy.init_battle_status(self.battle_status)
 
     def process_chunk(self, chunk_type: str, data: str) -> Optional[str]:
         """
@@ -111,35 +128,65 @@ class BattleStreamProcessor:
         :param data:
         :return: "move 2"や"switch 1"のような行動
         """
+        return self.process_events(chunk_type, tokenize(data))
+
+    def process_events(self, chunk_type: str, events: List[BattleEvent]) -> Optional[str]:
+        """
+        トークン化済みのchunkを処理し、行動がある場合はそれを返す
+        updateを両プレイヤーで処理する場合、同じイベントのオブジェクトを共有する(書き換えないこと)
+        :param chunk_type:
+        :param events: このプレイヤーに見えるイベントのみからなる列
+        :return: "move 2"や"switch 1"のような行動
+        """
+        stats = self.stats
+        if stats is not None:
+            time_start = time.perf_counter()
+            policy_time_start = stats.phase_time.get('policy', 0.0)
         choice = None
-        for line in data.splitlines():
-            # |request|xxx
-            lineparts = line.split('|')
-            msg = lineparts[1]
-            msgargs = lineparts[2:]
-            msgchoice = None
-            handler = self._handlers.get(msg)
+        handlers = self._handlers
+        ignore_msgs = BattleStreamProcessor.ignore_msgs
+        for event in events:
+            msg = event.msg
+            if stats is not None:
+                stats.message_counts[msg] += 1
+            handler = handlers.get(msg)
             if handler is not None:
-                msgchoice = handler(msgargs)
-            elif msg in BattleStreamProcessor.ignore_msgs:
-                # 安全に無視できるメッセージ
-                pass
-            else:
-                raise NotImplementedError(f"unknown message {msg} in {data}")
-            if msgchoice is not None:
-                assert choice is None, "multiple choice occurred for one chunk"
-                choice = msgchoice
+                msgchoice = handler(event)
+                if msgchoice is not None:
+                    assert choice is None, "multiple choice occurred for one chunk"
+                    choice = msgchoice
+            elif msg not in ignore_msgs:
+                raise NotImplementedError(f"unknown message {msg} in {events}")
+        if stats is not None:
+            # 方策の時間は別途policyとして計上されるので除く
+            policy_time = stats.phase_time.get('policy', 0.0) - policy_time_start
+            stats.add_time('processor', time.perf_counter() - time_start - policy_time)
         return choice
 
-    def _handle_request(self, msgargs: List[str]) -> Optional[str]:
+    def _choice(self, choice_method, request: dict):
+        # 方策の行動選択を呼び出す(計測が有効なら時間を記録)
+        if self.stats is None:
+            return choice_method(self.battle_status, request)
+        time_start = time.perf_counter()
+        choice = choice_method(self.battle_status, request)
+        self.stats.add_time_since('policy', time_start)
+        return choice
+
+    def _handle_request(self, event: BattleEvent) -> Optional[str]:
         """
         |request|{"active":[{"moves":[{"move":"Toxic", ...
         :param data:
         :return: 行動選択を行う場合は返す
         """
         # 味方の状態(技、残りPP, 控えのポケモンのHPなど)
-        request = json.loads(msgargs[0])
+        request = json.loads(event.args[0])
         self.last_request = request
+        if self.replaying:
+            # 複製・復元されたバトルのログの再生が終わり、シミュレータが要求を送りなおした
+            # 再生中のturnメッセージでは行動していないため、ここで行動を選ぶ
+            self.replaying = False
+            if request.get('active') and not request.get('forceSwitch') and not request.get('wait'):
+                return self._choice(self.policy.choice_turn_start, request)
 
         if request.get('wait'):
             # 相手だけが強制交換の状況
@@ -149,7 +196,7 @@ class BattleStreamProcessor:
             # 強制交換(瀕死)
             # このタイミングで交換先を選ぶ
             # 厳密には、この後にターンの経過（どの技が使われたかなど）のメッセージが来るのでそれも判断に取り入れるべきだが、現状では無視
-            return self.policy.choice_force_switch(self.battle_status, request)
+            return self._choice(self.policy.choice_force_switch, request)
         elif request.get('active'):
             # 通常のターン開始時の行動選択
             # この後に前回ターンの経過が来るので、それを待った上でAIが判断する
@@ -159,139 +206,166 @@ class BattleStreamProcessor:
             raise ValueError("Unknown situation of choice")
         return None
 
-    def _handle_switch(self, msgargs: List[str]) -> Optional[str]:
+    def _handle_switch(self, event: BattleEvent) -> Optional[str]:
         """
         |switch|p1a: Ninetales|Ninetales, L50, M|179/179
         :return:
         """
-        self.battle_status.switch(msgargs[0], msgargs[1], msgargs[2])
+        self.battle_status.switch(event.args[0], event.details, event.hp)
+        feature_buffer = self.battle_status.feature_buffer
+        if feature_buffer is not None:
+            side = event.args[0][:2]
+            feature_buffer.update_active(side, self.battle_status.side_statuses[side].active)
         return None
 
-    def _handle_drag(self, msgargs: List[str]) -> Optional[str]:
+    def _handle_drag(self, event: BattleEvent) -> Optional[str]:
         """
         switchと似ているが強制的に引き摺り出された場合（吠える）
         |move|p2a: Moltres|Roar|p1a: Ninetales
         |drag|p1a: Natu|Natu, L55, M|116/160
         :return:
         """
-        self.battle_status.switch(msgargs[0], msgargs[1], msgargs[2])
+        self.battle_status.switch(event.args[0], event.details, event.hp)
+        feature_buffer = self.battle_status.feature_buffer
+        if feature_buffer is not None:
+            side = event.args[0][:2]
+            feature_buffer.update_active(side, self.battle_status.side_statuses[side].active)
         # 今のところswitchと違いはない
         return None
 
-    def _handle_teamsize(self, msgargs: List[str]) -> Optional[str]:
+    def _handle_teamsize(self, event: BattleEvent) -> Optional[str]:
         """
         |teamsize|p2|3
         :return:
         """
-        teamsize = int(msgargs[1])
-        ss = self.battle_status.side_statuses[msgargs[0]]
+        teamsize = int(event.args[1])
+        ss = self.battle_status.side_statuses[event.args[0]]
         ss.total_pokes = teamsize
         ss.remaining_pokes = teamsize
+        if self.battle_status.feature_buffer is not None:
+            self.battle_status.feature_buffer.update_remaining_count(event.args[0], ss)
         return None
 
-    def _handle_turn(self, msgargs: List[str]) -> Optional[str]:
+    def _handle_turn(self, event: BattleEvent) -> Optional[str]:
         """
         |turn|1
         :return:
         """
         # 最初のターンは1
-        turn = int(msgargs[0])
+        turn = int(event.args[0])
         self.battle_status.turn = turn
-        logger.debug('turn_start ' + self.battle_status.json_dumps())
-        return self.policy.choice_turn_start(self.battle_status, self.last_request)
+        if self.replaying:
+            # 過去のターンのログを再生中
+            return None
+        if logger.isEnabledFor(DEBUG):
+            # json_dumpsは重いため、ログを出力しない場合は呼び出さない
+            logger.debug('turn_start ' + self.battle_status.json_dumps())
+        return self._choice(self.policy.choice_turn_start, self.last_request)
 
-    def _handle_start(self, msgargs: List[str]) -> Optional[str]:
+    def _handle_start(self, event: BattleEvent) -> Optional[str]:
         """
         状態変化開始
-        :param msgargs:
+        :param event:
         :return:
         """
         # |-start|p1a: Ninetales|Substitute
-        self.battle_status.get_side(msgargs[0]).active.volatile_statuses.add(msgargs[1])
+        self.battle_status.get_side(event.args[0]).active.volatile_statuses.add(event.args[1])
         return None
 
-    def _handle_end(self, msgargs: List[str]) -> Optional[str]:
+    def _handle_end(self, event: BattleEvent) -> Optional[str]:
         # 状態変化終了
         # |-start|p1a: Ninetales|Substitute
         # set.removeでなくset.discard(要素なくてもエラーにならない)を使用
         # |-end|p2a: Dodrio|move: Bide
         # という例あり
-        self.battle_status.get_side(msgargs[0]).active.volatile_statuses.discard(msgargs[1])
+        self.battle_status.get_side(event.args[0]).active.volatile_statuses.discard(event.args[1])
         return None
 
-    def _handle_damage(self, msgargs: List[str]) -> Optional[str]:
+    def _handle_damage(self, event: BattleEvent) -> Optional[str]:
         # ダメージを受けた
         # |-damage|p1a: Ninetales|135/179
         # |-damage|p2a: Granbull|184/196 tox|[from] psn
-        hp_current, hp_max, status = parse_hp_condition(msgargs[1])
-        active = self.battle_status.get_side(msgargs[0]).active
-        active.hp_current = hp_current
-        active.status = status
+        self._set_hp(event)
         return None
 
-    def _handle_heal(self, msgargs: List[str]) -> Optional[str]:
+    def _handle_heal(self, event: BattleEvent) -> Optional[str]:
         # 回復
         # |move|p2a: Skiploom|Giga Drain|p1a: Natu
         # |-resisted|p1a: Natu
         # |-damage|p1a: Natu|139/160
         # |-heal|p2a: Skiploom|132/176|[from] drain|[of] p1a: Natu
-        hp_current, hp_max, status = parse_hp_condition(msgargs[1])
-        active = self.battle_status.get_side(msgargs[0]).active
+        self._set_hp(event)
+        return None
+
+    def _set_hp(self, event: BattleEvent):
+        # HPと状態異常を更新(-damage, -heal, -sethp共通)
+        hp_current, hp_max, status = event.hp
+        active = self.battle_status.get_side(event.args[0]).active
         active.hp_current = hp_current
         active.status = status
-        return None
+        if self.battle_status.feature_buffer is not None:
+            self.battle_status.feature_buffer.update_hp(event.args[0][:2], active)
 
-    def _handle_status(self, msgargs: List[str]) -> Optional[str]:
+    def _handle_status(self, event: BattleEvent) -> Optional[str]:
         # 状態異常が発生
         # |move|p1a: Ninetales|Toxic|p2a: Granbull
         # |-status|p2a: Granbull|tox
-        self.battle_status.get_side(msgargs[0]).active.status = msgargs[1]
+        self._set_status(event.args[0], event.args[1])
         return None
 
-    def _handle_curestatus(self, msgargs: List[str]) -> Optional[str]:
+    def _set_status(self, pokemon: str, status: str):
+        active = self.battle_status.get_side(pokemon).active
+        active.status = status
+        if self.battle_status.feature_buffer is not None:
+            self.battle_status.feature_buffer.update_nv_condition(pokemon[:2], active)
+
+    def _handle_curestatus(self, event: BattleEvent) -> Optional[str]:
         # 状態異常が回復
         # |-curestatus|p2a: Granbull|tox
-        self.battle_status.get_side(msgargs[0]).active.status = ''
+        self._set_status(event.args[0], '')
         return None
 
-    def _handle_cureteam(self, msgargs: List[str]) -> Optional[str]:
+    def _handle_cureteam(self, event: BattleEvent) -> Optional[str]:
         # 味方全員の状態異常が回復（いやしのすず）
         # |-cureteam|p2a: Snubbull|[from] move: Heal Bell
         # 現状控えのポケモンの状態異常を管理していないため、curestatusと同じ
-        self.battle_status.get_side(msgargs[0]).active.status = ''
+        self._set_status(event.args[0], '')
         return None
 
-    def _handle_sethp(self, msgargs: List[str]) -> Optional[str]:
+    def _handle_sethp(self, event: BattleEvent) -> Optional[str]:
         # HPを特定の値にセット(いたみわけで発生)
         # |-sethp|p1a: Cleffa|104/171 par|[from] move: Pain Split|[silent]
-        hp_current, hp_max, status = parse_hp_condition(msgargs[1])
-        active = self.battle_status.get_side(msgargs[0]).active
-        active.hp_current = hp_current
-        active.status = status
+        self._set_hp(event)
         return None
 
-    def _handle_boost(self, msgargs: List[str]) -> Optional[str]:
+    def _handle_boost(self, event: BattleEvent) -> Optional[str]:
         # ランク変化（上がる）
         # |move|p2a: Porygon|Barrier|p2a: Porygon
         # |-boost|p2a: Porygon|def|2
         # 数値は変化量
-        self.battle_status.get_side(msgargs[0]).active.rank_boost(msgargs[1], int(msgargs[2]))
+        active = self.battle_status.get_side(event.args[0]).active
+        active.rank_boost(event.args[1], int(event.args[2]))
+        self._rank_changed(event.args[0], active, event.args[1])
         return None
 
-    def _handle_unboost(self, msgargs: List[str]) -> Optional[str]:
+    def _handle_unboost(self, event: BattleEvent) -> Optional[str]:
         # ランク変化（下がる）
         # |move|p2a: Granbull|Tail Whip|p1a: Ninetales
         # |-unboost|p1a: Ninetales|def|1
-        self.battle_status.get_side(msgargs[0]).active.rank_unboost(msgargs[1], int(msgargs[2]))
+        active = self.battle_status.get_side(event.args[0]).active
+        active.rank_unboost(event.args[1], int(event.args[2]))
+        self._rank_changed(event.args[0], active, event.args[1])
         return None
 
-    def _handle_setboost(self, msgargs: List[str]) -> Optional[str]:
+    def _handle_setboost(self, event: BattleEvent) -> Optional[str]:
         # ランク変化（特定の値をセット）　はらだいこなど
         # 数値は変化後の値
-        self.battle_status.get_side(msgargs[0]).active.rank_setboost(msgargs[1], int(msgargs[2]))
+        active = self.battle_status.get_side(event.args[0]).active
+        active.rank_setboost(event.args[1], int(event.args[2]))
+        self._rank_changed(event.args[0], active, event.args[1])
         return None
 
-    def _handle_copyboost(self, msgargs: List[str]) -> Optional[str]:
+    def _handle_copyboost(self, event: BattleEvent) -> Optional[str]:
         # ランク変化（相手のものをそのままコピー）
         # |move|p1a: Natu|Psych Up|p2a: Granbull
         # |-copyboost|p1a: Natu|p2a: Granbull|[from] move: Psych Up
@@ -299,45 +373,56 @@ class BattleStreamProcessor:
         # |-copyboost|SOURCE|TARGET
         # という説明になっているが、実際のメッセージは逆のように見える
         # じこあんじをしたのはNatuなのでNatuが変化する側
-        source = self.battle_status.get_side(msgargs[1]).active
-        target = self.battle_status.get_side(msgargs[0]).active
+        source = self.battle_status.get_side(event.args[1]).active
+        target = self.battle_status.get_side(event.args[0]).active
         target.ranks = source.ranks.copy()
+        self._rank_changed(event.args[0], target)
         return None
 
-    def _handle_clearallboost(self, msgargs: List[str]) -> Optional[str]:
+    def _handle_clearallboost(self, event: BattleEvent) -> Optional[str]:
         # 全てのポケモンの全てのランク変化をリセット（くろいきり）
         # |move|p2a: Golbat|Haze|p2a: Golbat
         # |-clearallboost
-        for side in self.battle_status.side_statuses.values():
-            side.active.rank_clearallboost()
+        for side, side_status in self.battle_status.side_statuses.items():
+            side_status.active.rank_clearallboost()
+            self._rank_changed(side, side_status.active)
         return None
 
-    def _handle_sidestart(self, msgargs: List[str]) -> Optional[str]:
+    def _rank_changed(self, pokemon: str, active: ActivePokeStatus, stat: Optional[str] = None):
+        if self.battle_status.feature_buffer is not None:
+            self.battle_status.feature_buffer.update_rank(pokemon[:2], active, stat)
+
+    def _handle_sidestart(self, event: BattleEvent) -> Optional[str]:
         # プレイヤーの場に生じる状態の発生
         # |move|p2a: Skiploom|Reflect|p2a: Skiploom
         # |-sidestart|p2: p2|Reflect
-        self.battle_status.get_side(msgargs[0]).side_statuses.add(msgargs[1])
+        self.battle_status.get_side(event.args[0]).side_statuses.add(event.args[1])
         return None
 
-    def _handle_sideend(self, msgargs: List[str]) -> Optional[str]:
+    def _handle_sideend(self, event: BattleEvent) -> Optional[str]:
         # プレイヤーの場に生じる状態の消滅
         # |-sideend|p2: p2|Safeguard
-        self.battle_status.get_side(msgargs[0]).side_statuses.remove(msgargs[1])
+        self.battle_status.get_side(event.args[0]).side_statuses.remove(event.args[1])
         return None
 
-    def _handle_faint(self, msgargs: List[str]) -> Optional[str]:
+    def _handle_faint(self, event: BattleEvent) -> Optional[str]:
         # ポケモンの瀕死
         # |-damage|p2a: Granbull|0 fnt|[from] psn|[of] p1a: Ninetales
         # |faint|p2a: Granbull
-        self.battle_status.get_side(msgargs[0]).remaining_pokes -= 1
+        side_status = self.battle_status.get_side(event.args[0])
+        side_status.remaining_pokes -= 1
+        if self.battle_status.feature_buffer is not None:
+            self.battle_status.feature_buffer.update_remaining_count(event.args[0][:2], side_status)
         return None
 
-    def _handle_weather(self, msgargs: List[str]) -> Optional[str]:
+    def _handle_weather(self, event: BattleEvent) -> Optional[str]:
         # 天候の開始/終了 (天候のところにnone)
         # |move|p1a: Xatu|Sunny Day|p1a: Xatu
         # |-weather|SunnyDay
         # SunnyDay,RainDance,Sandstorm,none
-        self.battle_status.weather = msgargs[0]
+        self.battle_status.weather = event.args[0]
+        if self.battle_status.feature_buffer is not None:
+            self.battle_status.feature_buffer.update_weather(event.args[0])
         return None
 
 
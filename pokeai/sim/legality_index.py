@@ -0,0 +1,213 @@
+"""
+ポケモンの技の習得可否のインデックス
+シミュレータのTeamValidatorを呼び出さずに、妥当な個体を直接サンプリングするために用いる。
+
+pokedex.jsonの各ポケモンのlearnset(習得方法 '2L10', '1M', '2E', '2S0'など)を進化前まで辿り、
+技ごとに以下の3種類の習得経路の最低レベルを求める。
+gen1: 第1世代で習得(第2世代へ送る)
+gen2: 第2世代でレベルアップ・技マシン・教え技により習得
+gen2_birth: 第2世代のタマゴ技・配布で、生まれたときに習得
+第1世代でしか覚えられない技と、第1世代に存在せず第2世代で生まれたときにしか覚えられない技は両立しない。
+
+インデックスの生成(レギュレーションごと):
+python -m pokeai.sim.legality_index data/dataset/pokedex.json data/dataset/regulations/default/learnsets.json > data/dataset/regulations/default/legality.json
+"""
+
+import sys
+import json
+import argparse
+import random
+from typing import Dict, List, Optional, Tuple
+
+from pokeai.util import DATASET_DIR, json_load
+
+# 技ごとの習得経路の最低レベル (gen1, gen2, gen2_birth) 経路がなければNone
+MoveRoutes = Tuple[Optional[int], Optional[int], Optional[int]]
+
+
+def _source_level(source: str, template: dict) -> int:
+    # 習得方法の文字列から、その方法で習得できる最低レベルを求める
+    method = source[1]
+    if method == 'L':
+        return int(source[2:])
+    if method == 'S':
+        return template['eventPokemon'][int(source[2:])].get('level', 1)
+    return 1
+
+
+def _min_level(species: str, pokedex: dict) -> int:
+    # 進化レベルによるポケモンの最低レベル
+    min_level = 1
+    template = pokedex[species]
+    while template is not None:
+        min_level = max(min_level, template.get('evoLevel') or 1)
+        template = pokedex.get(template.get('prevo') or '')
+    return min_level
+
+
+def _move_routes(species: str, pokedex: dict) -> Dict[str, MoveRoutes]:
+    routes = {}
+    template = pokedex[species]
+    while template is not None:
+        for move, sources in template['learnset'].items():
+            levels = list(routes.get(move, (None, None, None)))
+            for source in sources:
+                if source[0] == '1':
+                    route = 0
+                elif source[1] in 'ES':
+                    route = 2
+                else:
+                    route = 1
+                level = _source_level(source, template)
+                if levels[route] is None or level < levels[route]:
+                    levels[route] = level
+            routes[move] = tuple(levels)
+        template = pokedex.get(template.get('prevo') or '')
+    return routes
+
+
+def build_legality_index(pokedex: dict, learnsets: Dict[str, List[str]]) -> dict:
+    """
+    インデックスを生成する
+    :param pokedex: pokedex.jsonの内容
+    :param learnsets: レギュレーションで使用可能なポケモンと技(learnsets.json)
+    :return:
+    """
+    gen1_moves = set()  # 第1世代に存在する技
+    for template in pokedex.values():
+        for move, sources in template['learnset'].items():
+            if any(source[0] == '1' for source in sources):
+                gen1_moves.add(move)
+    species_index = {}
+    for species, valid_moves in learnsets.items():
+        routes = _move_routes(species, pokedex)
+        species_index[species] = {
+            'min_level': _min_level(species, pokedex),
+            'moves': {move: routes[move] for move in sorted(valid_moves) if move in routes},
+        }
+    return {
+        'gen1_moves': sorted(gen1_moves),
+        'species': species_index,
+    }
+
+
+class LegalMoveSet:
+    """
+    あるポケモン・レベルで覚えられる技の集合
+    技の集合は技のリストに対するビットマスク(int)で表す
+    """
+    moves: List[str]
+    move2idx: Dict[str, int]
+    all_mask: int
+    gen1_only_mask: int  # 第1世代でしか覚えられない技
+    gen2_birth_only_mask: int  # 第1世代に存在せず、第2世代で生まれたときにしか覚えられない技
+
+    def __init__(self, moves: List[str], gen1_only: List[str], gen2_birth_only: List[str]):
+        self.moves = moves
+        self.move2idx = {move: i for i, move in enumerate(moves)}
+        self.all_mask = (1 << len(moves)) - 1
+        self.gen1_only_mask = self.to_mask(gen1_only)
+        self.gen2_birth_only_mask = self.to_mask(gen2_birth_only)
+
+    def to_mask(self, moves: List[str]) -> int:
+        mask = 0
+        for move in moves:
+            # 覚えられない技(インデックス生成前に作られたパーティ等)は無視
+            if move in self.move2idx:
+                mask |= 1 << self.move2idx[move]
+        return mask
+
+    def compatible_mask(self, moves: List[str]) -> int:
+        """
+        与えられた技と両立できる技の集合(与えられた技自体は除く)
+        """
+        mask = self.to_mask(moves)
+        compatible = self.all_mask & ~mask
+        if mask & self.gen1_only_mask:
+            compatible &= ~self.gen2_birth_only_mask
+        if mask & self.gen2_birth_only_mask:
+            compatible &= ~self.gen1_only_mask
+        return compatible
+
+    def choice(self, mask: int) -> Optional[str]:
+        """
+        技の集合から1つをランダムに選ぶ
+        :return: 集合が空ならNone
+        """
+        candidates = [i for i in range(len(self.moves)) if mask >> i & 1]
+        if len(candidates) == 0:
+            return None
+        return self.moves[random.choice(candidates)]
+
+    def sample(self, k: int = 4) -> List[str]:
+        """
+        両立可能な技をk個(覚えられる技がそれより少なければすべて)ランダムに選ぶ
+        """
+        chosen = []
+        while len(chosen) < k:
+            move = self.choice(self.compatible_mask(chosen))
+            if move is None:
+                break
+            chosen.append(move)
+        return chosen
+
+
+class LegalityIndex:
+    """
+    build_legality_indexで生成したインデックスを用いた、妥当な個体の判定・サンプリング
+    """
+
+    def __init__(self, index: dict):
+        self._index = index
+        self._gen1_moves = set(index['gen1_moves'])
+        self._move_sets = {}  # (species, level) => LegalMoveSet
+
+    @classmethod
+    def load(cls, regulation: str = "default") -> "LegalityIndex":
+        path = DATASET_DIR.joinpath('regulations', regulation, 'legality.json')
+        if not path.exists():
+            raise FileNotFoundError(f"{path} does not exist. Build it with `python -m pokeai.sim.legality_index`.")
+        return cls(json_load(path))
+
+    def species_at_level(self, level: int) -> List[str]:
+        """
+        指定レベルで存在でき、技を1つ以上覚えられるポケモンのリスト
+        """
+        return [species for species, entry in self._index['species'].items()
+                if entry['min_level'] <= level and len(self.move_set(species, level).moves) > 0]
+
+    def move_set(self, species: str, level: int) -> LegalMoveSet:
+        key = (species, level)
+        move_set = self._move_sets.get(key)
+        if move_set is None:
+            move_set = self._build_move_set(species, level)
+            self._move_sets[key] = move_set
+        return move_set
+
+    def _build_move_set(self, species: str, level: int) -> LegalMoveSet:
+        moves = []
+        gen1_only = []
+        gen2_birth_only = []
+        for move, routes in self._index['species'][species]['moves'].items():
+            gen1, gen2, gen2_birth = [r is not None and r <= level for r in routes]
+            if not (gen1 or gen2 or gen2_birth):
+                continue
+            moves.append(move)
+            if gen1 and not (gen2 or gen2_birth):
+                gen1_only.append(move)
+            if gen2_birth and not (gen1 or gen2) and move not in self._gen1_moves:
+                gen2_birth_only.append(move)
+        return LegalMoveSet(moves, gen1_only, gen2_birth_only)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pokedex")
+    parser.add_argument("learnsets")
+    args = parser.parse_args()
+    result = build_legality_index(json_load(args.pokedex), json_load(args.learnsets))
+    sys.stdout.write(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""
+パーティのpacked形式への変換
+Pokemon-ShowdownのDex.packTeamをpythonに移植したもの。シミュレータの付属機能(simutil)を呼び出さずに変換できる。
+PartyPokeの形式(第2世代)で使われる項目のみ対応する。
+
+packed形式(ポケモンごとに']'で区切る):
+NICKNAME|SPECIES|ITEM|ABILITY|MOVES|NATURE|EVS|GENDER|IVS|SHINY|LEVEL|HAPPINESS
+"""
+import hashlib
+import json
+import re
+from collections import OrderedDict
+from typing import Optional
+
+from pokeai.sim.party_generator import Party, PartyPoke
+from pokeai.util import DATASET_DIR, json_load
+
+_pokedex = None
+_ID_PATTERN = re.compile(r'[^a-z0-9]+')
+_STAT_KEYS = ['hp', 'atk', 'def', 'spa', 'spd', 'spe']
+
+
+def to_id(text: str) -> str:
+    """
+    Pokemon-ShowdownのtoIDと同じ変換
+    'Nidoran-F' => 'nidoranf'
+    """
+    return _ID_PATTERN.sub('', str(text).lower())
+
+
+def _get_pokedex() -> dict:
+    global _pokedex
+    if _pokedex is None:
+        _pokedex = json_load(DATASET_DIR.joinpath('pokedex.json'))
+    return _pokedex
+
+
+def _pack_ability(ability: str, template: Optional[dict]) -> str:
+    ability_id = to_id(ability)
+    abilities = template.get('abilities') if template else None
+    if abilities:
+        if ability_id == to_id(abilities.get('0', '')):
+            return ''
+        if ability_id == to_id(abilities.get('1', '')):
+            return '1'
+        if ability_id == to_id(abilities.get('H', '')):
+            return 'H'
+    return ability_id
+
+
+def _pack_evs(evs: Optional[dict]) -> str:
+    if not evs:
+        return ''
+    # 0は省略される
+    packed = ','.join(str(evs[key]) if evs.get(key) else '' for key in _STAT_KEYS)
+    return '' if packed == ',,,,,' else packed
+
+
+def _pack_ivs(ivs: Optional[dict]) -> str:
+    if not ivs:
+        return ''
+    # 31(最大値)は省略される。第2世代の個体値の最大値30は省略されない。
+    packed = ','.join('' if ivs.get(key) is None or ivs[key] == 31 else str(ivs[key]) for key in _STAT_KEYS)
+    return '' if packed == ',,,,,' else packed
+
+
+def _pack_poke(poke: PartyPoke) -> str:
+    name = poke.get('name') or poke['species']
+    species_id = to_id(poke.get('species') or name)
+    template = _get_pokedex().get(species_id)
+    gender = poke.get('gender')
+    level = poke.get('level')
+    fields = [
+        name,
+        '' if to_id(name) == species_id else species_id,
+        to_id(poke.get('item') or ''),
+        _pack_ability(poke.get('ability') or '', template),
+        ','.join(to_id(move) for move in poke['moves']),
+        poke.get('nature') or '',
+        _pack_evs(poke.get('evs')),
+        gender if gender and (template is None or gender != template.get('gender')) else '',
+        _pack_ivs(poke.get('ivs')),
+        'S' if poke.get('shiny') else '',
+        str(level) if level and level != 100 else '',
+        '',  # なつき度(PartyPokeでは指定しない)
+    ]
+    return '|'.join(fields)
+
+
+def pack_team(party: Party) -> str:
+    """
+    パーティをシミュレータに与えるpacked形式に変換する
+    :param party:
+    :return: packed形式の文字列
+    """
+    return ']'.join(_pack_poke(poke) for poke in party)
+
+
+def party_hash(party: Party) -> str:
+    """
+    パーティの内容のハッシュ値
+    """
+    return hashlib.sha1(json.dumps(party, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class PackedTeamCache:
+    """
+    パーティの内容のハッシュ値をキーとした、packed形式のLRUキャッシュ
+    """
+    maxsize: int
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+
+    def get(self, party: Party) -> str:
+        """
+        packed形式を返す。キャッシュになければ変換してキャッシュする。
+        """
+        key = party_hash(party)
+        packed = self._cache.get(key)
+        if packed is None:
+            packed = pack_team(party)
+            self._put(key, packed)
+        else:
+            self._cache.move_to_end(key)
+        return packed
+
+    def put(self, party: Party, packed: str):
+        """
+        変換済みのpacked形式(PartyDocに保存されたものなど)を登録する
+        """
+        self._put(party_hash(party), packed)
+
+    def _put(self, key: str, packed: str):
+        self._cache[key] = packed
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def clear(self):
+        self._cache.clear()
+
+
+packed_team_cache = PackedTeamCache()
+
+
+def pack_team_cached(party: Party) -> str:
+    """
+    キャッシュを用いてパーティをpacked形式に変換する
+    """
+    return packed_team_cache.get(party)
+
+
+def main():
+    """
+    ランダムに生成したパーティについて、シミュレータのpackTeamと結果が一致することを確認する
+    python -m pokeai.sim.pack_team
+    """
+    import argparse
+    from pokeai.sim.random_party_generator import RandomPartyGenerator
+    from pokeai.sim.simutil import get_sim_util
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=100, help="確認するパーティ数")
+    args = parser.parse_args()
+    party_generator = RandomPartyGenerator()
+    parties = [party_generator.generate() for _ in range(args.n)]
+    n_mismatch = 0
+    for party, expected in zip(parties, get_sim_util().call_many([('packTeam', {'party': party}) for party in parties])):
+        actual = pack_team(party)
+        if expected != actual:
+            n_mismatch += 1
+            print(f"mismatch:\n  simulator: {expected}\n  python:    {actual}")
+    print(f"{n_mismatch} / {args.n} mismatched")
+
+
+if __name__ == '__main__':
+    main()
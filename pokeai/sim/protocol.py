@@ -0,0 +1,100 @@
+"""
+シミュレータのプロトコル(SIM-PROTOCOL.md)のトークナイザ
+updateのchunkを1回だけ走査してイベントの列に変換し、両プレイヤーのプロセッサで共有する。
+|split|による秘密情報は、イベントの公開範囲(owner, secret)として表す。
+
+|split|p1
+|-damage|p1a: Ninetales|135/179     <- p1のみに見えるイベント (owner='p1', secret=True)
+|-damage|p1a: Ninetales|76/100      <- p1以外に見えるイベント (owner='p1', secret=False)
+"""
+from typing import List, Optional, Tuple
+
+from pokeai.ai.battle_status import parse_hp_condition, parse_details
+
+# HPと状態異常の引数の位置。イベント生成時にデコードする。
+HP_ARG_INDEX = {
+    'switch': 2,
+    'drag': 2,
+    '-damage': 1,
+    '-heal': 1,
+    '-sethp': 1,
+}
+# ポケモンの情報(DETAILS)の引数の位置
+DETAILS_ARG_INDEX = {
+    'switch': 1,
+    'drag': 1,
+}
+
+
+class BattleEvent:
+    """
+    プロトコルの1行分のメッセージ
+    """
+    __slots__ = ('msg', 'args', 'owner', 'secret', 'hp', 'details')
+    msg: str  # メッセージの種類 'switch', '-damage'など
+    args: List[str]  # メッセージの引数
+    owner: Optional[str]  # |split|で分割された行の場合、秘密情報の持ち主
+    secret: bool  # ownerのみに見える行(Falseの場合、owner以外に見える行)
+    hp: Optional[Tuple[int, int, str]]  # HPを含むメッセージの場合、(現在HP, 最大HP, 状態異常)
+    details: Optional[Tuple[str, int, str]]  # DETAILSを含むメッセージの場合、(種族, レベル, 性別)
+
+    def __init__(self, msg: str, args: List[str], owner: Optional[str] = None, secret: bool = False):
+        self.msg = msg
+        self.args = args
+        self.owner = owner
+        self.secret = secret
+        hp_idx = HP_ARG_INDEX.get(msg)
+        self.hp = parse_hp_condition(args[hp_idx]) if hp_idx is not None else None
+        details_idx = DETAILS_ARG_INDEX.get(msg)
+        self.details = parse_details(args[details_idx]) if details_idx is not None else None
+
+    def __repr__(self):
+        return f"BattleEvent({self.msg!r}, {self.args!r}, owner={self.owner!r}, secret={self.secret!r})"
+
+
+def _make_event(line: str, owner: Optional[str] = None, secret: bool = False) -> Optional[BattleEvent]:
+    if not line.startswith('|'):
+        # 空行など
+        return None
+    parts = line.split('|')
+    return BattleEvent(parts[1], parts[2:], owner, secret)
+
+
+def tokenize(data: str) -> List[BattleEvent]:
+    """
+    chunkの本体をイベントの列に変換する
+    :param data: update, sideupdateの本体
+    :return:
+    """
+    events = []
+    lines = data.split('\n')
+    n_lines = len(lines)
+    i = 0
+    while i < n_lines:
+        line = lines[i]
+        if line.startswith('|split|'):
+            # 次の行が秘密情報、その次の行がそれ以外向け
+            owner = line[7:]
+            if i + 1 < n_lines:
+                event = _make_event(lines[i + 1], owner, True)
+                if event is not None:
+                    events.append(event)
+            if i + 2 < n_lines:
+                event = _make_event(lines[i + 2], owner, False)
+                if event is not None:
+                    events.append(event)
+            i += 3
+            continue
+        event = _make_event(line)
+        if event is not None:
+            events.append(event)
+        i += 1
+    return events
+
+
+def events_for_side(events: List[BattleEvent], side: str) -> List[BattleEvent]:
+    """
+    プレイヤーsideに見えるイベントのみを返す
+    split_updateと同じく、|split|の秘密情報はownerのみ、それ以外向けの行はowner以外に渡す
+    """
+    return [event for event in events if event.owner is None or event.secret == (event.owner == side)]
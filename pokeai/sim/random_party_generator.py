@@ -2,6 +2,7 @@ import copy
 import random
 from typing import Set
 
+from pokeai.sim.legality_index import LegalityIndex
 from pokeai.sim.party_generator import PartyGenerator, Party, PartyPoke
 from pokeai.util import DATASET_DIR
 from pokeai.sim.team_validator import TeamValidator
@@ -9,27 +10,58 @@ from pokeai.util import json_load
 
 
 class RandomPartyGenerator(PartyGenerator):
+    """
+    レギュレーションに沿ったランダムなパーティの生成
+    技の習得可否はLegalityIndexで判定し、妥当な個体を直接サンプリングする。
+    """
+
     def __init__(self,
                  regulation: str = "default",
                  neighbor_poke_change_rate: float = 0.1,
-                 neighbor_item_change_rate: float = 0.1):
-        self._validator = TeamValidator()
+                 neighbor_item_change_rate: float = 0.1,
+                 validate: bool = False):
+        """
+        :param regulation:
+        :param neighbor_poke_change_rate:
+        :param neighbor_item_change_rate:
+        :param validate: 生成したパーティをシミュレータのTeamValidatorでも検証する
+        """
+        self._validator = TeamValidator() if validate else None
+        self._legality = LegalityIndex.load(regulation)
         self._pokedex = json_load(DATASET_DIR.joinpath('pokedex.json'))
         self._regulation = json_load(DATASET_DIR.joinpath('regulations', regulation, 'regulation.json'))
-        self._learnsets = json_load(DATASET_DIR.joinpath('regulations', regulation, 'learnsets.json'))
         self._items = json_load(DATASET_DIR.joinpath('regulations', regulation, 'items.json'))
+        self._species_at_level = {}  # level => そのレベルで存在できるポケモンのリスト
         self.neighbor_poke_change_rate = neighbor_poke_change_rate
         self.neighbor_item_change_rate = neighbor_item_change_rate if len(self._items) > 0 else 0.0
 
-    def _single_random(self, level: int) -> PartyPoke:
-        # 1体ランダム個体を生成(validationしない)
-        species = random.choice(list(self._learnsets.keys()))
+    def _random_species(self, level: int, exclude_species: Set[str]) -> str:
+        species_list = self._species_at_level.get(level)
+        if species_list is None:
+            species_list = self._legality.species_at_level(level)
+            self._species_at_level[level] = species_list
+        while True:
+            species = random.choice(species_list)
+            if species not in exclude_species:
+                return species
+
+    def _random_item(self, exclude_items: Set[str]) -> str:
+        if len(self._items) == 0:
+            return ''
+        while True:
+            item = random.choice(self._items)  # FIXME: 戦略的な"アイテムなし"が選べない
+            if item not in exclude_items:
+                return item
+
+    def _single_random(self, level: int, exclude_species: Set[str], exclude_items: Set[str]) -> PartyPoke:
+        # 1体ランダム個体を生成
+        # 種族・アイテムは他のポケモンと被らないようにする
+        species = self._random_species(level, exclude_species)
         # 性別固定ポケモンはgenderにその文字が、そうでなければ空文字列
         # 性別固定でなければ、攻撃個体値maxはオスとなる
         gender = self._pokedex[species]['gender'] or 'M'
-        available_moves = self._learnsets[species]
-        moves = random.sample(available_moves, min(4, len(available_moves)))
-        item = random.choice(self._items) if len(self._items) > 0 else ''  # FIXME: 戦略的な"アイテムなし"が選べない
+        moves = self._legality.move_set(species, level).sample(4)
+        item = self._random_item(exclude_items)
         return {
             'name': species,
             'species': species,
@@ -44,6 +76,14 @@ class RandomPartyGenerator(PartyGenerator):
             'nature': ''
         }
 
+    def _final_check(self, party: Party):
+        if self._validator is None:
+            return
+        val_error = self._validator.validate(party)
+        if val_error:
+            # インデックスでは妥当と判定されたが、シミュレータでは妥当でない
+            raise RuntimeError('party validation failed: ' + str(val_error))
+
     def generate(self) -> Party:
         levels = self._regulation['levels'].copy()
         random.shuffle(levels)
@@ -51,19 +91,11 @@ class RandomPartyGenerator(PartyGenerator):
         species: Set[str] = set()
         items: Set[str] = set()
         for level in levels:
-            while True:
-                cand = self._single_random(level)
-                # ポケモン単体でおかしくないか＆種族が被っていないか
-                if (cand['species'] not in species) and (cand['item'] not in items) and (
-                        self._validator.validate([cand]) is None):
-                    break
+            cand = self._single_random(level, species, items)
             party.append(cand)
             species.add(cand['species'])
             items.add(cand['item'])
-        val_error = self._validator.validate(party)
-        if val_error:
-            # 単体ではOKの個体の組み合わせでエラーになることは想定していない
-            raise RuntimeError('party validation failed: ' + str(val_error))
+        self._final_check(party)
         return party
 
     def neighbor(self, party: Party) -> Party:
@@ -78,42 +110,25 @@ class RandomPartyGenerator(PartyGenerator):
         if self.neighbor_poke_change_rate > rnd:
             # ポケモンを変更
             species = {poke['species'] for i, poke in enumerate(new_party) if i != change_idx}
-            while True:
-                cand = self._single_random(new_party[change_idx]['level'])
-                # ポケモン単体でおかしくないか＆種族が被っていないか
-                if (cand['species'] not in species) and (self._validator.validate([cand]) is None):
-                    break
-            new_party[change_idx] = cand
+            new_party[change_idx] = self._single_random(new_party[change_idx]['level'], species, set())
         else:
             rnd -= self.neighbor_poke_change_rate
             change_poke = new_party[change_idx]
             if self.neighbor_item_change_rate > rnd:
                 # アイテムの変更
                 items = {poke['item'] for i, poke in enumerate(new_party) if i != change_idx}  # 他のポケモンが持っているアイテム
-                cur_item = change_poke['item']
-                while True:
-                    new_item = random.choice(self._items)
-                    if new_item != cur_item and new_item not in items:
-                        change_poke['item'] = new_item
-                        break
+                items.add(change_poke['item'])
+                change_poke['item'] = self._random_item(items)
             else:
                 # 技を変更
-                available_moves = self._learnsets[change_poke['species']]
-                current_moves = change_poke['moves'].copy()
-                if len(available_moves) > 4:  # 覚えられる技が4つ以下なら選択の余地なし
-                    for i in range(100):  # 技は4つより多いものの、両立不可によりどうしても変更できない場合の無限ループ回避
-                        change_move_idx = random.randrange(len(current_moves))
-                        new_move = random.choice(available_moves)
-                        if new_move in current_moves:
-                            continue
-                        change_poke['moves'][change_move_idx] = new_move
-                        # 両立不可などの理由でダメな場合を弾く
-                        if self._validator.validate([change_poke]) is None:
-                            break
-                        # 変えた技を元に戻す
-                        change_poke['moves'][change_move_idx] = current_moves[change_move_idx]
-        val_error = self._validator.validate(new_party)
-        if val_error:
-            # 単体ではOKの個体の組み合わせでエラーになることは想定していない
-            raise RuntimeError('party validation failed: ' + str(val_error))
+                move_set = self._legality.move_set(change_poke['species'], change_poke['level'])
+                current_moves = change_poke['moves']
+                change_move_idx = random.randrange(len(current_moves))
+                other_moves = [move for i, move in enumerate(current_moves) if i != change_move_idx]
+                # 残りの技と両立可能で、現在の技以外の技から選ぶ
+                # 覚えられる技が4つ以下の場合などは選択の余地がなく変更なし
+                new_move = move_set.choice(move_set.compatible_mask(other_moves) & ~move_set.to_mask(current_moves))
+                if new_move is not None:
+                    current_moves[change_move_idx] = new_move
+        self._final_check(new_party)
         return new_party
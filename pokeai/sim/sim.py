@@ -2,37 +2,359 @@
 シミュレータラッパー
 """
 import os
+import inspect
 import random
-import subprocess
 import json
-import re
-from typing import List, Optional
+import time
+from typing import List, Optional, Dict, Tuple, Iterable, Iterator, Union
 from logging import getLogger
 
 from pokeai.ai.action_policy import ActionPolicy
 from pokeai.sim.battle_stream_processor import BattleStreamProcessor
 from pokeai.sim.party_generator import Party
-from pokeai.sim.simutil import sim_util
-from pokeai.util import ROOT_DIR, side2idx, idx2side
+from pokeai.sim.pack_team import pack_team_cached
+from pokeai.sim.protocol import tokenize, events_for_side
+from pokeai.sim.sim_process import SimSupervisor, SimProcessError
+from pokeai.sim.sim_stats import SimStats
+from pokeai.sim.transport import Transport, RawChunk, make_transport
+from pokeai.util import side2idx, idx2side
 
 logger = getLogger(__name__)
 
 
+BattleSeed = List[int]  # シミュレータの乱数のシード(16bit整数4つ)
+
+
+def make_seed(seed: Union[int, str, BattleSeed, None]) -> Optional[BattleSeed]:
+    """
+    整数・文字列からシミュレータの乱数のシードを作る
+    :param seed: 整数・文字列、またはシード(そのまま返す)
+    :return: Noneの場合None(シミュレータがランダムに決める)
+    """
+    if seed is None or isinstance(seed, list):
+        return seed
+    rng = random.Random(seed)
+    return [rng.randrange(0x10000) for _ in range(4)]
+
+
+class BattleContext:
+    """
+    シミュレータ上で進行中のバトル1つ分の情報
+    シミュレータからのchunkをプロセッサに振り分け、シミュレータに送るべき行動を返す
+    """
+    battle_id: int
+    parties: List[Party]
+    processors: List[BattleStreamProcessor]
+    seed: Optional[BattleSeed]
+    sent_forcetie: bool
+    replays: int  # シミュレータの異常によりやり直した回数
+    restore_command: Optional[str]  # スナップショットから復元したバトルの場合、復元コマンド
+    forked: bool  # 他のバトルから複製したバトル
+    replies: Dict[str, str]  # snapshot, rolloutコマンドの応答(chunkの種類 => 本体)
+    battle_ref: Optional["BattleRef"]  # 方策からこのバトルを参照するためのもの
+    simple_specs: Optional[List[dict]]  # 両プレイヤーの方策が単純な場合、そのsimple_spec。シミュレータ内でバトル全体を行う。
+    stats: Optional[SimStats]  # 計測が有効な場合、このバトルの計測結果
+
+    def __init__(self, battle_id: int, parties: List[Party], processors: List[BattleStreamProcessor],
+                 seed: Optional[BattleSeed] = None):
+        self.battle_id = battle_id
+        self.parties = parties
+        self.processors = processors
+        self.seed = seed
+        self.sent_forcetie = False
+        self.replays = 0
+        self.restore_command = None
+        self.forked = False
+        self.replies = {}
+        self.battle_ref = None
+        self.simple_specs = None
+        self.stats = None
+
+    def _start_processors(self):
+        self.sent_forcetie = False
+        if self.parties is None:
+            raise Exception('parties not set')
+        for i in [0, 1]:
+            side = idx2side(i)
+            # 方策が用いる乱数もシードから決める
+            policy_seed = f'{self.seed}:{side}' if self.seed is not None else random.getrandbits(64)
+            self.processors[i].start_battle(side, self.parties[i], policy_seed, self.battle_ref, self.stats)
+
+    def start(self) -> List[str]:
+        """
+        プロセッサを初期化し、バトル開始のコマンドを返す
+        やり直しの場合も同じメソッドで最初から開始する
+        :return:
+        """
+        if self.forked:
+            raise RuntimeError(f"forked battle {self.battle_id} cannot be restarted")
+        if self.restore_command is not None:
+            self.resume()
+            return [self.restore_command]
+        if self.simple_specs is not None:
+            return [self._simple_battle_command()]
+        self._start_processors()
+        spec = {'formatid': 'gen2customgame'}
+        if self.seed is not None:
+            spec['seed'] = self.seed
+        return [
+            f'>start {json.dumps(spec)}',
+            f'>player p1 {json.dumps(_makePartySpec("p1", self.parties[0]))}',
+            f'>player p2 {json.dumps(_makePartySpec("p2", self.parties[1]))}',
+        ]
+
+    def _simple_battle_command(self) -> str:
+        # 行動選択もシミュレータ内で行い、endのみが返ってくる。プロセッサは使わない。
+        spec = {
+            'seed': self.seed,
+            'policySeed': make_seed(f'{self.seed}:policy') if self.seed is not None else None,
+        }
+        for i in [0, 1]:
+            side = idx2side(i)
+            spec[side] = _makePartySpec(side, self.parties[i])
+            spec[side]['policy'] = self.simple_specs[i]
+        return f'>simplebattle {json.dumps(spec)}'
+
+    def resume(self):
+        """
+        複製・復元されたバトルのプロセッサを初期化する
+        シミュレータはそれまでのログを送った後、行動選択の要求を送りなおす。
+        プロセッサはログから状態を再構築し、要求を受け取った時点で行動を選ぶ。
+        """
+        self._start_processors()
+        for processor in self.processors:
+            processor.replaying = True
+
+    def process_chunk(self, chunk_type: str, side: str, chunk_data: str) -> Tuple[
+        Optional[dict], List[Tuple[str, object]]]:
+        """
+        chunkを処理する
+        :param chunk_type:
+        :param side: sideupdateの宛先
+        :param chunk_data:
+        :return: (バトル終了の場合はendメッセージの内容, シミュレータに送る(side, 行動)のリスト)
+        行動はActionPolicyの返り値そのままで、coroutineのこともある。
+        sideが''の場合はバトル全体へのコマンド。
+        """
+        if chunk_data.find('|turn|100') >= 0 and not self.sent_forcetie:
+            # 長すぎるバトルをカット
+            logger.warning(f"battle reached to 100 turns, exiting as tie")
+            self.sent_forcetie = True
+            # この後はendメッセージを待つだけ。エージェントにchoiceを送らせてはいけない
+            # (|error|[Invalid choice] Can't do anything: The game is over)というエラーになる
+            return None, [('', 'forcetie')]
+        try:
+            return self._processChunk(chunk_type, side, chunk_data)
+        except Exception as ex:
+            raise ValueError(f"Exception on processing chunk {chunk_type},{chunk_data}", ex)
+
+    def _processChunk(self, chunk_type: str, side: str, chunk_data: str) -> Tuple[
+        Optional[dict], List[Tuple[str, object]]]:
+        # 振り分けについては
+        # battle-stream.ts を参考にする
+        choices = []
+        if chunk_type == 'end':
+            # バトル終了
+            battle_result = json.loads(chunk_data)
+            if 'error' in battle_result:
+                # 複製元のバトルが存在しないなど
+                raise RuntimeError(battle_result['error'])
+            return battle_result, choices  # バトルの結果を返す
+        if chunk_type in ('snapshot', 'rollout'):
+            self.replies[chunk_type] = chunk_data
+            return None, choices
+        if self.sent_forcetie:
+            # forcetieを送った後は、endメッセージ以外無視
+            return None, choices
+        if chunk_type == 'sideupdate':
+            choice = self.processors[side2idx(side)].process_chunk(chunk_type, chunk_data)
+            if choice is not None:
+                choices.append((side, choice))
+        elif chunk_type == 'update':
+            if side:
+                # シミュレータ側で分割済み
+                side_events = [(side, tokenize(chunk_data))]
+            else:
+                # 1回だけトークン化し、各プレイヤーに見えるイベントを振り分ける(イベントのオブジェクトは共有)
+                if self.stats is not None:
+                    time_start = time.perf_counter()
+                events = tokenize(chunk_data)
+                side_events = [('p1', events_for_side(events, 'p1')), ('p2', events_for_side(events, 'p2'))]
+                if self.stats is not None:
+                    self.stats.add_time_since('split', time_start)
+            for update_side, events in side_events:
+                choice = self.processors[side2idx(update_side)].process_events(chunk_type, events)
+                if choice is not None:
+                    choices.append((update_side, choice))
+        else:
+            raise NotImplementedError(f"Unknown chunk type {chunk_type}")
+        return None, choices
+
+    def abort(self) -> list:
+        """
+        シミュレータの異常によりバトルを中断したことを各プレイヤーの方策に通知する
+        :return: 各方策のgame_abortの返り値
+        """
+        return [processor.policy.game_abort() for processor in self.processors]
+
+    def end(self, battle_result: dict) -> list:
+        """
+        バトル終了を各プレイヤーの方策に通知する
+        :param battle_result: endメッセージの内容
+        :return: 各方策のgame_endの返り値(coroutineのこともある)
+        """
+        # FIXME: ここで呼ぶべきか、processorにメソッドを設けるべきか
+        winner = battle_result['winner']  # 'p1', 'p2', '' (forcetieで引き分けの時)
+        reward_p1 = {'p1': 1.0, 'p2': -1.0, '': 0.0}[winner]
+        return [self.processors[side2idx(side)].policy.game_end(reward=reward_p1 * sign)
+                for side, sign in [('p1', 1.0), ('p2', -1.0)]]
+
+
+def format_command(side: str, choice: str) -> str:
+    if side:
+        return f'>{side} {choice}'
+    return f'>{choice}'
+
+
+def split_update(chunk_data: str) -> Tuple[str, str]:
+    """
+    updateのうち各プレイヤーの秘密情報を処理し、p1向けとp2向けを1回の走査で作る
+    Pokemon-Showdown/sim/battle.ts の extractUpdateForSide と同じ結果になる
+    |split|p1
+    p1向けの秘密情報の行
+    それ以外向けの行(空行の場合は出力しない)
+    :param chunk_data:
+    :return: p1向け, p2向けのupdate
+    """
+    if '|split|' not in chunk_data:
+        return chunk_data, chunk_data
+    lines = chunk_data.split('\n')
+    p1_lines = []
+    p2_lines = []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if not line.startswith('|split|'):
+            p1_lines.append(line)
+            p2_lines.append(line)
+            i += 1
+            continue
+        owner = line[7:]
+        secret = lines[i + 1] if i + 1 < len(lines) else ''
+        shared = lines[i + 2] if i + 2 < len(lines) else ''
+        if owner == 'p1':
+            p1_lines.append(secret)
+        elif shared:
+            p1_lines.append(shared)
+        if owner == 'p2':
+            p2_lines.append(secret)
+        elif shared:
+            p2_lines.append(shared)
+        i += 3
+    return '\n'.join(p1_lines), '\n'.join(p2_lines)
+
+
+def simpipe_command(transport: Transport, split_in_node: bool) -> List[str]:
+    command = ['node', 'js/simpipe'] + transport.simpipe_args()
+    if split_in_node:
+        command.append('--split')
+    return command
+
+
+def _makePartySpec(name, party):
+    return {'name': name, 'team': pack_team_cached(party)}
+
+
+def simple_specs(processors: List[BattleStreamProcessor]) -> Optional[List[dict]]:
+    """
+    両プレイヤーの方策がシミュレータ内で実行できる単純なものであれば、そのsimple_specを返す
+    :param processors:
+    :return: いずれかが単純でなければNone
+    """
+    specs = [processor.policy.simple_spec() for processor in processors]
+    if any(spec is None for spec in specs):
+        return None
+    return specs
+
+
+class BattleRef:
+    """
+    方策から進行中のバトルを参照する(探索を行う方策用)
+    BattleStatus.battle_refとして渡される。AsyncSimで進行するバトルでは渡されない。
+    """
+    sim: "Sim"
+    battle_id: int
+
+    def __init__(self, sim: "Sim", battle_id: int):
+        self.sim = sim
+        self.battle_id = battle_id
+
+    def rollout(self, side: str, actions: List[str], n_rollouts: int, max_turns: Optional[int] = None,
+                seed: Optional[BattleSeed] = None) -> Dict[str, dict]:
+        return self.sim.rollout(self.battle_id, side, actions, n_rollouts, max_turns, seed)
+
+    def fork(self, processors: List[BattleStreamProcessor], seed: Union[int, str, BattleSeed, None] = None) -> int:
+        return self.sim.fork(self.battle_id, processors, seed)
+
+    def snapshot(self) -> str:
+        return self.sim.snapshot(self.battle_id)
+
+
+# (パーティ2つ, プロセッサ2つ) または (パーティ2つ, プロセッサ2つ, シード)
+BattleJob = Union[Tuple[List[Party], List[BattleStreamProcessor]],
+                  Tuple[List[Party], List[BattleStreamProcessor], Union[int, str, BattleSeed, None]]]
+
+
 class Sim:
     """
     シミュレータ
+    1つのシミュレータプロセス上で複数のバトルを同時に進行できる(バトルIDで多重化)
+    シミュレータプロセスはSimSupervisorで監視し、メモリ使用量・応答時間に応じて入れ替える。
+    プロセスが異常終了・応答なしとなった場合、進行中のバトルを新しいプロセスで最初からやり直す。
     """
+    MAX_REPLAYS = 3  # 1バトルをやり直す回数の上限
     parties: List[Party]
     processors: List[BattleStreamProcessor]
     policies: List[ActionPolicy]
-    proc: subprocess.Popen
+    supervisor: SimSupervisor
+    transport: Transport
     n_battle: int
+    n_simple_battle: int  # シミュレータ内で行動選択まで行ったバトル数
+    fast_path: bool
+    stats: Optional[SimStats]  # 計測が有効な場合、終了したバトルの計測結果の合計
+    max_parallel: int  # run_manyで同時に進行させるバトル数の上限
+    _battles: Dict[int, BattleContext]  # 進行中のバトル
+    _finished: List[Tuple[int, dict]]  # stepで返す前に終了したバトル(コマンドの応答待ちの間など)
+    _pending_calls: int  # 応答待ちのsnapshot, rolloutなどのコマンド数
+    _next_battle_id: int
 
-    def __init__(self):
+    def __init__(self, max_parallel: int = 32, transport: Union[str, Transport] = 'json', split_in_node: bool = False,
+                 supervisor_params: Optional[dict] = None, fast_path: bool = True, stats: bool = False):
+        """
+        :param max_parallel: run_manyで同時に進行させるバトル数の上限
+        :param transport: シミュレータとの通信方式 ('json' or 'framed')またはTransportインスタンス
+        :param split_in_node: updateの各プレイヤー向けへの分割をシミュレータ側で行う。
+            False(既定)の場合は受信したupdateを1回だけトークン化し、両プレイヤーのプロセッサでイベントを共有する。
+        :param supervisor_params: SimSupervisorのパラメータ(max_rss_mb, max_latency, use_standbyなど)
+        :param fast_path: 両プレイヤーの方策が単純(ActionPolicy.simple_spec)なバトルは、シミュレータ内で行動選択まで行う
+        :param stats: フェーズごとの処理時間等を計測する。各バトルの計測結果はendメッセージの内容のstatsに入る。
+        """
         self.n_battle = 0
-        self.proc = None
+        self.n_simple_battle = 0
+        self.fast_path = fast_path
+        self.stats = SimStats() if stats else None
+        self.transport = transport if isinstance(transport, Transport) else make_transport(transport)
+        self.transport.timing = stats
+        self.split_in_node = split_in_node
+        self.supervisor = SimSupervisor(simpipe_command(self.transport, split_in_node), self.transport,
+                                        **(supervisor_params or {}))
         self.parties = None
         self.processors = None
+        self.max_parallel = max_parallel
+        self._battles = {}
+        self._finished = []
+        self._pending_calls = 0
+        self._next_battle_id = 0
 
     def set_party(self, parites: List[Party]):
         self.parties = parites
@@ -40,113 +362,257 @@ class Sim:
     def set_processor(self, processors: List[BattleStreamProcessor]):
         self.processors = processors
 
-    def _writeChunk(self, commands: List[str]):
-        logger.debug("writeChunk " + json.dumps('\n'.join(commands)))
-        self.proc.stdin.write(json.dumps('\n'.join(commands)) + '\n')
-        self.proc.stdin.flush()
+    def close(self):
+        """
+        シミュレータプロセスを終了する
+        """
+        self.supervisor.close()
+
+    def _writeChunk(self, battle_id: int, commands: List[str]):
+        logger.debug("writeChunk %s %s", battle_id, commands)
+        battle = self._battles.get(battle_id) if self.stats is not None else None
+        if battle is None or battle.stats is None:
+            self.supervisor.get().write(self.transport.encode(battle_id, commands))
+            return
+        time_start = time.perf_counter()
+        data = self.transport.encode(battle_id, commands)
+        self.supervisor.get().write(data)
+        battle.stats.add_time_since('write', time_start)
+        battle.stats.bytes_written += len(data)
 
-    def _readChunk(self) -> List[str]:
-        line = self.proc.stdout.readline()
-        logger.debug("readChunk " + line)
-        rawstr = json.loads(line)
-        return rawstr.split('\n', 1)  # 最初の1要素(update, endなど)のみ分離
+    def _readChunk(self) -> Tuple[RawChunk, int, float]:
+        # rolloutなどの応答待ちの間はシミュレータが他のバトルを進めないため、応答時間の監視から除く
+        received = self.supervisor.get().read_received(self.supervisor.response_timeout,
+                                                       record_latency=self._pending_calls == 0)
+        logger.debug("readChunk %s", received[0])
+        return received
 
-    def run(self):
+    def _recycle_pending(self) -> bool:
+        # プロセス入れ替え待ちのため新しいバトルを開始すべきでない状態か
+        return len(self._battles) > 0 and self.supervisor.needs_recycle()
+
+    def _replay_battles(self):
+        """
+        シミュレータプロセスを入れ替え、進行中のバトルを最初からやり直す
         """
-        バトルを１回行う
+        while True:
+            self.supervisor.replace_dead()
+            try:
+                for battle in list(self._battles.values()):
+                    if battle.forked:
+                        # 複製元の状態が失われたためやり直せない。中断したものとして終了扱いにする。
+                        logger.warning(f"forked battle {battle.battle_id} is lost with the simulator process")
+                        battle.abort()
+                        del self._battles[battle.battle_id]
+                        self._finished.append((battle.battle_id, {'winner': '', 'aborted': True}))
+                        continue
+                    battle.replays += 1
+                    if battle.replays > Sim.MAX_REPLAYS:
+                        raise RuntimeError(f"battle {battle.battle_id} crashed the simulator {battle.replays} times")
+                    logger.warning(f"replaying battle {battle.battle_id} on a new simulator process")
+                    battle.abort()
+                    self.supervisor.get().n_battle += 1
+                    self._writeChunk(battle.battle_id, battle.start())
+                return
+            except SimProcessError:
+                continue
+
+    def run(self, seed: Union[int, str, BattleSeed, None] = None):
+        """
+        set_party, set_processorで設定したバトルを１回行う
+        :param seed: 乱数のシード。同じパーティ・方策・シードなら方策が決定的である限り同じ結果となる。
         :return: endメッセージの内容 {'winner': 'p1', 'turns': 34, ...}
         """
-        # シミュレータプログラムの実行。長く運用するとクラッシュすることがあるので定期的に再起動
-        if self.n_battle >= 1000:
-            self.proc.stdin.close()
-            self.proc.terminate()
-            self.proc = None
-            self.n_battle = 0
-        if self.proc is None:
-            self.proc = subprocess.Popen(['node', 'js/simpipe'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                                         encoding='utf-8', cwd=str(ROOT_DIR))
+        assert len(self._battles) == 0, "run() cannot be used while other battles are in flight"
+        battle_id = self.start_battle(self.parties, self.processors, seed)
+        while True:
+            finished = self.step()
+            if finished is not None:
+                finished_id, battle_result = finished
+                assert finished_id == battle_id
+                return battle_result
+
+    def run_many(self, jobs: Iterable[BattleJob], max_parallel: Optional[int] = None) -> Iterator[Tuple[int, dict]]:
+        """
+        複数のバトルを同時に進行させ、終了したものから結果を返す
+        同時に進行するバトルで同じActionPolicyインスタンスを共有する場合、そのpolicyはバトルごとの内部状態を持たないこと
+        (学習中のRLPolicyなどは共有不可)
+        :param jobs: (パーティ2つ, プロセッサ2つ[, シード])の列。プロセッサはバトルごとに別のインスタンスとすること。
+        :param max_parallel: 同時に進行させるバトル数の上限。Noneならself.max_parallel
+        :return: (jobsにおけるインデックス, endメッセージの内容)のイテレータ。終了順。
+        """
+        max_parallel = max_parallel or self.max_parallel
+        job_iter = enumerate(jobs)
+        battle_id_to_job_idx = {}
+        jobs_remaining = True
+        while True:
+            while jobs_remaining and len(self._battles) < max_parallel and not self._recycle_pending():
+                try:
+                    job_idx, job = next(job_iter)
+                except StopIteration:
+                    jobs_remaining = False
+                    break
+                battle_id_to_job_idx[self.start_battle(*job)] = job_idx
+            if len(battle_id_to_job_idx) == 0:
+                break
+            finished = self.step()
+            if finished is not None and finished[0] in battle_id_to_job_idx:
+                # 方策が複製したバトル(fork)の終了は返さない
+                finished_id, battle_result = finished
+                yield battle_id_to_job_idx.pop(finished_id), battle_result
+
+    def _new_battle(self, parties: List[Party], processors: List[BattleStreamProcessor],
+                    seed: Optional[BattleSeed]) -> BattleContext:
+        self.supervisor.get().n_battle += 1
         self.n_battle += 1
+        battle_id = self._next_battle_id
+        self._next_battle_id += 1
+        battle = BattleContext(battle_id, parties, processors, seed)
+        battle.battle_ref = BattleRef(self, battle_id)
+        if self.stats is not None:
+            battle.stats = SimStats()
+        self._battles[battle_id] = battle
+        return battle
 
-        for i in [0, 1]:
-            self.processors[i].start_battle(idx2side(i), self.parties[i])
+    def start_battle(self, parties: List[Party], processors: List[BattleStreamProcessor],
+                     seed: Union[int, str, BattleSeed, None] = None) -> int:
+        """
+        バトルを開始する。バトルの進行はstepで行う。
+        :param parties:
+        :param processors:
+        :param seed: 乱数のシード
+        :return: バトルID
+        """
+        if len(self._battles) == 0 and self.supervisor.needs_recycle():
+            # 進行中のバトルがないときに入れ替える
+            self.supervisor.recycle()
+        battle = self._new_battle(parties, processors, make_seed(seed))
+        if self.fast_path:
+            battle.simple_specs = simple_specs(processors)
+            if battle.simple_specs is not None:
+                self.n_simple_battle += 1
+        self._writeChunk(battle.battle_id, battle.start())
+        return battle.battle_id
 
-        self._writeStart()
-        sent_forcetie = False
-        while True:
-            chunk_type, chunk_data = self._readChunk()
-            battle_result = None
-            if chunk_data.find('|turn|100') >= 0 and not sent_forcetie:
-                # 長すぎるバトルをカット
-                logger.warning(f"battle reached to 100 turns, exiting as tie")
-                self._writeChunk([
-                    f'>forcetie'
-                ])
-                sent_forcetie = True
-                # この後はendメッセージを待つだけ。エージェントにchoiceを送らせてはいけない
-                # (|error|[Invalid choice] Can't do anything: The game is over)というエラーになる
-                continue
-            try:
-                battle_result = self._processChunk(chunk_type, chunk_data, sent_forcetie)
-            except Exception as ex:
-                raise ValueError(f"Exception on processing chunk {chunk_type},{chunk_data}", ex)
-            if battle_result is not None:
-                # FIXME: ここで呼ぶべきか、processorにメソッドを設けるべきか
-                winner = battle_result['winner']  # 'p1', 'p2', '' (forcetieで引き分けの時)
-                reward_p1 = {'p1': 1.0, 'p2': -1.0, '': 0.0}[winner]
-                for side, sign in [('p1', 1.0), ('p2', -1.0)]:
-                    self.processors[side2idx(side)].policy.game_end(reward=reward_p1 * sign)
+    def fork(self, battle_id: int, processors: List[BattleStreamProcessor],
+             seed: Union[int, str, BattleSeed, None] = None) -> int:
+        """
+        進行中のバトルをシミュレータ上で複製する。複製したバトルは元のバトルと独立に進行する。
+        行動選択の待ち状態で呼び出すこと(方策のchoice_turn_start内など)。
+        複製したバトルでは、両プレイヤーが現在のターンの行動を選びなおす。
+        :param battle_id: 複製元のバトルID
+        :param processors: 複製したバトルのプロセッサ2つ。状態はシミュレータから送られるログで再構築される。
+        :param seed: 指定した場合、複製したバトルの乱数をこのシードで初期化する。Noneなら複製元の乱数の状態を引き継ぐ。
+        :return: 複製したバトルのID
+        シミュレータプロセスが異常終了した場合、複製したバトルはやり直せないため{'winner': '', 'aborted': True}で終了する。
+        """
+        src = self._battles[battle_id]
+        battle = self._new_battle(src.parties, processors, make_seed(seed))
+        battle.forked = True
+        battle.resume()
+        self._writeChunk(battle_id, [f'>fork {json.dumps({"battleId": battle.battle_id, "seed": battle.seed})}'])
+        return battle.battle_id
 
-                return battle_result
+    def snapshot(self, battle_id: int) -> str:
+        """
+        進行中のバトルの状態をシリアライズする
+        行動選択の待ち状態で呼び出すこと。
+        :param battle_id:
+        :return: スナップショット(json文字列)。restoreで復元できる。
+        """
+        snapshot = self._call(battle_id, '>snapshot', 'snapshot')
+        if snapshot == 'null':
+            raise RuntimeError(f"battle {battle_id} does not exist in simulator")
+        return snapshot
 
-    def _extractUpdateForSide(self, side: str, chunk_data: str):
-        # Pokemon-Showdown/sim/battle.ts の移植
-        if side == 'omniscient':
-            # 全データ取得
-            return re.sub('\n\\|split\\|p[1234]\n([^\n]*)\n(?:[^\n]*)', '\n\\1', chunk_data)
-        # 各プレイヤーごとの秘密情報を、他のプレイヤー向けには削除する
-        # '|split|p1'の次の行は、p1にのみ送る（他のプレイヤーの場合削除）
-        if side.startswith('p'):
-            chunk_data = re.sub('\n\\|split\\|' + side + '\n([^\n]*)\n(?:[^\n]*)', '\n\\1', chunk_data)
-        return re.sub('\n\\|split\\|(?:[^\n]*)\n(?:[^\n]*)\n\n?', '\n', chunk_data)  # 対象でない秘密データ削除
+    def rollout(self, battle_id: int, side: str, actions: List[str], n_rollouts: int,
+                max_turns: Optional[int] = None, seed: Union[int, str, BattleSeed, None] = None) -> Dict[str, dict]:
+        """
+        進行中のバトルから、各行動についてプレイアウトを行い価値を推定する
+        プレイアウトはシミュレータ内でバトルを複製して行い、両プレイヤーとも最初の行動以外はランダムに選ぶ。
+        行動選択の待ち状態で呼び出すこと。
+        :param battle_id:
+        :param side: 行動するプレイヤー
+        :param actions: 評価する行動("move 1"など)
+        :param n_rollouts: 1行動あたりのプレイアウト回数
+        :param max_turns: プレイアウトで進めるターン数の上限。到達した場合は残りHPの割合の差を価値とする。
+        :param seed: プレイアウトの乱数のシード
+        :return: 行動 => {'value': 平均価値(勝ち:1 負け:-1), 'n': プレイアウト回数, 'wins': 勝ち数, 'losses': 負け数}
+        """
+        command = {'side': side, 'actions': actions, 'n': n_rollouts, 'maxTurns': max_turns, 'seed': make_seed(seed)}
+        return json.loads(self._call(battle_id, f'>rollout {json.dumps(command)}', 'rollout'))
 
-    def _processChunk(self, chunk_type: str, chunk_data: str, sent_forcetie: bool) -> Optional[object]:
+    def _call(self, battle_id: int, command: str, reply_type: str) -> str:
+        # シミュレータにコマンドを送り、応答を待つ。その間に進行した他のバトルの終了はstepで返す。
+        battle = self._battles[battle_id]
+        battle.replies.pop(reply_type, None)
+        self._writeChunk(battle_id, [command])
+        self._pending_calls += 1
+        try:
+            while reply_type not in battle.replies:
+                if battle_id not in self._battles:
+                    raise RuntimeError(f"battle {battle_id} ended before {reply_type} reply")
+                finished = self._step()
+                if finished is not None:
+                    self._finished.append(finished)
+        finally:
+            self._pending_calls -= 1
+        return battle.replies.pop(reply_type)
+
+    def restore(self, snapshot: str, parties: List[Party], processors: List[BattleStreamProcessor],
+                seed: Union[int, str, BattleSeed, None] = None) -> int:
         """
-        chunkの種類ごとに適切なプロセッサに振り分ける。バトル終了の場合はendメッセージの内容を返す
-        :param chunk_type:
-        :param chunk_data:
-        :return:
+        スナップショットからバトルを復元する。復元したバトルの進行はstepで行う。
+        :param snapshot: snapshotの返り値
+        :param parties: 復元するバトルのパーティ2つ
+        :param processors: プロセッサ2つ
+        :param seed: 指定した場合、復元したバトルの乱数をこのシードで初期化する
+        :return: 復元したバトルのID
         """
-        # 振り分けについては
-        # battle-stream.ts を参考にする
-        if chunk_type == 'end':
-            # バトル終了
-            return json.loads(chunk_data)  # バトルの結果を返す
-        if sent_forcetie:
-            # forcetieを送った後は、endメッセージ以外無視
-            return None
-        if chunk_type == 'sideupdate':
-            side, side_data = chunk_data.split('\n')
-            choice = self.processors[side2idx(side)].process_chunk(chunk_type, side_data)
-            if choice is not None:
-                self._writeChunk([f'>{side} {choice}'])
-        elif chunk_type == 'update':
-            for side in ['p1', 'p2']:
-                choice = self.processors[side2idx(side)].process_chunk(chunk_type,
-                                                                       self._extractUpdateForSide(side, chunk_data))
-                if choice is not None:
-                    self._writeChunk([f'>{side} {choice}'])
-        else:
-            raise NotImplementedError(f"Unknown chunk type {chunk_type}")
+        battle = self._new_battle(parties, processors, make_seed(seed))
+        battle.restore_command = f'>restore {json.dumps({"seed": battle.seed, "snapshot": json.loads(snapshot)})}'
+        self._writeChunk(battle.battle_id, battle.start())
+        return battle.battle_id
 
-    def _makePartySpec(self, name, party):
-        return {'name': name, 'team': sim_util.call('packTeam', {'party': party})}
+    def step(self) -> Optional[Tuple[int, dict]]:
+        """
+        シミュレータからのchunkを1つ読み、対応するバトルを進行させる
+        :return: バトルが終了した場合、(バトルID, endメッセージの内容)
+        """
+        if len(self._finished) > 0:
+            return self._finished.pop(0)
+        return self._step()
 
-    def _writeStart(self):
-        if self.parties is None:
-            raise Exception('parties not set')
-        spec = {'formatid': 'gen2customgame'}
-        self._writeChunk([
-            f'>start {json.dumps(spec)}',
-            f'>player p1 {json.dumps(self._makePartySpec("p1", self.parties[0]))}',
-            f'>player p2 {json.dumps(self._makePartySpec("p2", self.parties[1]))}',
-        ])
+    def _step(self) -> Optional[Tuple[int, dict]]:
+        try:
+            if self.stats is not None:
+                time_start = time.perf_counter()
+            (battle_id, chunk_type, side, chunk_data), n_bytes, decode_time = self._readChunk()
+            battle = self._battles.get(battle_id)
+            if battle is None:
+                # 終了済みのバトルへのsnapshotの応答など
+                logger.debug("chunk for finished battle %s", battle_id)
+                return None
+            if battle.stats is not None:
+                # パースは受信スレッドでこのchunkについて計測した値。受信待ちとは並行して行われるため別に計上する。
+                battle.stats.add_time('read', time.perf_counter() - time_start)
+                battle.stats.add_time('decode', decode_time)
+                battle.stats.bytes_read += n_bytes
+                battle.stats.chunks += 1
+            battle_result, choices = battle.process_chunk(chunk_type, side, chunk_data)
+            for side, choice in choices:
+                if inspect.isawaitable(choice):
+                    raise TypeError("ActionPolicy returned an awaitable; use AsyncSim for coroutine policies")
+                self._writeChunk(battle_id, [format_command(side, choice)])
+        except SimProcessError:
+            self._replay_battles()
+            return None
+        if battle_result is None:
+            return None
+        del self._battles[battle_id]
+        battle.end(battle_result)
+        if battle.stats is not None:
+            battle.stats.battles = 1
+            self.stats.merge(battle.stats)
+            battle_result['stats'] = battle.stats.to_dict()
+        return battle_id, battle_result
@@ -0,0 +1,221 @@
+"""
+複数のシミュレータプロセスによるバトルの並列実行
+"""
+import asyncio
+import multiprocessing
+from typing import List, Iterable, Iterator, Tuple, Optional, Union
+
+from pokeai.ai.action_policy import ActionPolicy
+from pokeai.sim.battle_result_cache import BattleResultCache, battle_cache_key
+from pokeai.sim.battle_stream_processor import BattleStreamProcessor
+from pokeai.sim.party_generator import Party
+from pokeai.sim.sim import Sim, BattleJob
+from pokeai.sim.sim_stats import SimStats
+
+# (パーティ2つ, 方策2つ) または (パーティ2つ, 方策2つ, シード)
+PolicyJob = Union[Tuple[List[Party], List[ActionPolicy]], Tuple[List[Party], List[ActionPolicy], object]]
+
+# ワーカープロセス内のシミュレータ
+_worker_sim: Optional[Sim] = None
+
+
+def _init_worker(max_parallel: int, transport: str, fast_path: bool, stats: bool):
+    global _worker_sim
+    _worker_sim = Sim(max_parallel=max_parallel, transport=transport, fast_path=fast_path, stats=stats)
+
+
+def _make_battle_job(job: PolicyJob) -> BattleJob:
+    parties, policies = job[:2]
+    processors = []
+    for policy in policies:
+        bsp = BattleStreamProcessor()
+        bsp.set_policy(policy)
+        processors.append(bsp)
+    return (parties, processors) + tuple(job[2:])
+
+
+def _run_jobs(sim: Sim, indexed_jobs: List[Tuple[int, PolicyJob]]) -> List[Tuple[int, dict]]:
+    battle_jobs = [_make_battle_job(job) for _, job in indexed_jobs]
+    return [(indexed_jobs[i][0], battle_result) for i, battle_result in sim.run_many(battle_jobs)]
+
+
+def _worker_run_jobs(indexed_jobs: List[Tuple[int, PolicyJob]]) -> List[Tuple[int, dict]]:
+    return _run_jobs(_worker_sim, indexed_jobs)
+
+
+class SimPool:
+    """
+    シミュレータワーカーのプール
+    各ワーカープロセスがシミュレータ(node)と方策の計算を受け持ち、プロセス内では複数のバトルを多重化して進行させる。
+    workers=1の場合はワーカープロセスを作らず、呼び出し元のプロセスで実行する。
+    ワーカープロセスで実行する場合、方策はpickleでコピーされるため、方策の内部状態の変化(学習など)は呼び出し元に反映されない。
+    result_cacheを指定した場合、シードを指定した決定的な方策同士のバトルは結果をキャッシュし、同じバトルを再度行わない。
+    fast_pathの場合、単純な方策(RandomPolicyなど)同士のバトルはシミュレータ内で行動選択まで行う。
+    statsの場合、各ワーカーでの計測結果をself.statsに集計する(キャッシュから返した結果は含まない)。
+    """
+    workers: int
+    max_parallel: int  # 1ワーカーあたりの同時進行バトル数
+    chunk_size: int  # ワーカーに一度に渡すバトル数
+    result_cache: Optional[BattleResultCache]
+    fast_path: bool
+    stats: Optional[SimStats]
+
+    def __init__(self, workers: int = 1, max_parallel: int = 16, chunk_size: Optional[int] = None,
+                 transport: str = 'json', result_cache: Optional[BattleResultCache] = None, fast_path: bool = True,
+                 stats: bool = False):
+        self.workers = workers
+        self.max_parallel = max_parallel
+        self.chunk_size = chunk_size or max_parallel
+        self.result_cache = result_cache
+        self.fast_path = fast_path
+        self.stats = SimStats() if stats else None
+        self._sim = None
+        self._pool = None
+        if workers <= 1:
+            self._sim = Sim(max_parallel=max_parallel, transport=transport, fast_path=fast_path, stats=stats)
+        else:
+            # forkだと親プロセスのsimutilのパイプを共有してしまうためspawnを用いる
+            ctx = multiprocessing.get_context('spawn')
+            self._pool = ctx.Pool(workers, initializer=_init_worker, initargs=(max_parallel, transport, fast_path, stats))
+
+    def imap_unordered(self, jobs: Iterable[PolicyJob]) -> Iterator[Tuple[int, dict]]:
+        """
+        バトルを実行し、終了したものから結果を返す
+        :param jobs: (パーティ2つ, 方策2つ[, シード])の列
+        :return: (jobsにおけるインデックス, endメッセージの内容)のイテレータ
+        """
+        if self.result_cache is None:
+            yield from self._imap_unordered(jobs)
+            return
+        jobs = list(jobs)
+        keys = [battle_cache_key(job[0], job[1], job[2] if len(job) > 2 else None, self.fast_path) for job in jobs]
+        uncached_idxs = []
+        for job_idx, key in enumerate(keys):
+            battle_result = self.result_cache.get(key)
+            if battle_result is not None:
+                yield job_idx, battle_result
+            else:
+                uncached_idxs.append(job_idx)
+        for i, battle_result in self._imap_unordered(jobs[job_idx] for job_idx in uncached_idxs):
+            job_idx = uncached_idxs[i]
+            self.result_cache.put(keys[job_idx], battle_result)
+            yield job_idx, battle_result
+
+    def _imap_unordered(self, jobs: Iterable[PolicyJob]) -> Iterator[Tuple[int, dict]]:
+        for job_idx, battle_result in self._imap_unordered_uncached(jobs):
+            if self.stats is not None and 'stats' in battle_result:
+                self.stats.merge(SimStats.from_dict(battle_result['stats']))
+            yield job_idx, battle_result
+
+    def _imap_unordered_uncached(self, jobs: Iterable[PolicyJob]) -> Iterator[Tuple[int, dict]]:
+        if self._pool is None:
+            yield from self._sim.run_many(_make_battle_job(job) for job in jobs)
+            return
+        for chunk_results in self._pool.imap_unordered(_worker_run_jobs, self._chunked(jobs)):
+            yield from chunk_results
+
+    def map_battles(self, jobs: Iterable[PolicyJob]) -> List[dict]:
+        """
+        バトルを実行し、jobsと同じ順序で結果を返す
+        :param jobs: (パーティ2つ, 方策2つ[, シード])の列
+        :return: endメッセージの内容のリスト
+        """
+        results = {}
+        for job_idx, battle_result in self.imap_unordered(jobs):
+            results[job_idx] = battle_result
+        return [results[i] for i in range(len(results))]
+
+    def _chunked(self, jobs: Iterable[PolicyJob]) -> Iterator[List[Tuple[int, PolicyJob]]]:
+        chunk = []
+        for indexed_job in enumerate(jobs):
+            chunk.append(indexed_job)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+    def close(self):
+        if self._sim is not None:
+            self._sim.close()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class AsyncSimPool:
+    """
+    SimPool.map_battlesと同じ形式で、1つのAsyncSim上で全バトルを同時に進行させる
+    方策がcoroutineの場合(BatchedRLPolicyなど)に用いる。呼び出し元のプロセスで実行するため、方策の内部状態は共有される。
+    result_cacheはSimPoolと同様。シミュレータ内での行動選択(fast_path)と計測(stats)には対応しない。
+    """
+    max_parallel: int
+    result_cache: Optional[BattleResultCache]
+    stats: Optional[SimStats]  # 計測は未対応(SimPoolとの互換のため常にNone)
+
+    def __init__(self, max_parallel: int = 256, transport: str = 'json',
+                 result_cache: Optional[BattleResultCache] = None):
+        """
+        :param max_parallel: 同時進行バトル数の上限
+        :param transport: シミュレータとの通信方式
+        :param result_cache: 指定した場合、シードを指定した決定的な方策同士のバトルは結果をキャッシュする
+        """
+        from pokeai.sim.async_sim import AsyncSim
+        self.max_parallel = max_parallel
+        self.result_cache = result_cache
+        self.stats = None
+        self._sim = AsyncSim(transport=transport)
+        self._loop = asyncio.new_event_loop()
+
+    def map_battles(self, jobs: Iterable[PolicyJob]) -> List[dict]:
+        """
+        バトルを実行し、jobsと同じ順序で結果を返す
+        :param jobs: (パーティ2つ, 方策2つ[, シード])の列
+        :return: endメッセージの内容のリスト
+        """
+        jobs = list(jobs)
+        keys = [None] * len(jobs)
+        results = [None] * len(jobs)
+        if self.result_cache is not None:
+            for job_idx, job in enumerate(jobs):
+                # fast_pathには対応しないため、常にpython側で行動選択したバトルとしてキャッシュする
+                keys[job_idx] = battle_cache_key(job[0], job[1], job[2] if len(job) > 2 else None, fast_path=False)
+                results[job_idx] = self.result_cache.get(keys[job_idx])
+        uncached_idxs = [job_idx for job_idx, battle_result in enumerate(results) if battle_result is None]
+        battle_jobs = [_make_battle_job(jobs[job_idx]) for job_idx in uncached_idxs]
+        battle_results = self._loop.run_until_complete(self._sim.run_many(battle_jobs, max_parallel=self.max_parallel))
+        for job_idx, battle_result in zip(uncached_idxs, battle_results):
+            if self.result_cache is not None:
+                self.result_cache.put(keys[job_idx], battle_result)
+            results[job_idx] = battle_result
+        return results
+
+    def close(self):
+        if self._loop is not None:
+            self._loop.run_until_complete(self._sim.close())
+            self._loop.close()
+            self._loop = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def map_battles(jobs: Iterable[PolicyJob], workers: int = 1) -> List[dict]:
+    """
+    バトルを並列実行し、jobsと同じ順序で結果を返す
+    :param jobs: (パーティ2つ, 方策2つ[, シード])の列
+    :param workers: ワーカープロセス数
+    :return: endメッセージの内容のリスト
+    """
+    with SimPool(workers) as pool:
+        return pool.map_battles(jobs)
@@ -0,0 +1,236 @@
+"""
+シミュレータプロセス(js/simpipe)の管理
+プロセスの健全性(メモリ使用量、応答時間)を監視し、必要に応じて予備プロセスと入れ替える
+"""
+import os
+import queue
+import subprocess
+import threading
+import time
+from typing import List, Optional, Tuple
+from logging import getLogger
+
+from pokeai.sim.transport import Transport, RawChunk
+from pokeai.util import ROOT_DIR
+
+logger = getLogger(__name__)
+
+
+class SimProcessError(Exception):
+    """
+    シミュレータプロセスが終了した、または応答しない
+    """
+    pass
+
+
+class SimProcess:
+    """
+    1つのシミュレータプロセス
+    受信とパースは別スレッドで行い、タイムアウト付きで読めるようにする
+    受信スレッドはtransportの集計(bytes_readなど)を変更せず、readを呼んだスレッドで集計する。
+    そのため入れ替え中の新旧プロセスが同じtransportを共有しても、集計が競合しない。
+    """
+    LATENCY_EMA_DECAY = 0.99
+    proc: subprocess.Popen
+    transport: Transport
+    n_battle: int  # このプロセスで開始したバトル数
+    latency_ema: float  # chunkの受信待ち時間の指数移動平均(秒)
+
+    def __init__(self, command: List[str], transport: Transport):
+        self.transport = transport
+        self.proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=str(ROOT_DIR))
+        self.n_battle = 0
+        self.latency_ema = 0.0
+        self._chunks = queue.Queue()
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+
+    def _read_loop(self):
+        try:
+            while True:
+                raw = self.transport.read_raw(self.proc.stdout)
+                if raw is None:
+                    self._chunks.put(None)
+                    break
+                raw_chunk, decode_time = self.transport.decode_timed(raw)
+                self._chunks.put((raw_chunk, raw, decode_time))
+        except (OSError, ValueError):
+            # closeによりパイプが閉じられた
+            self._chunks.put(None)
+
+    def write(self, data: bytes):
+        try:
+            self.proc.stdin.write(data)
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError) as ex:
+            raise SimProcessError(f"simulator process is not writable (returncode={self.proc.poll()})") from ex
+
+    def read(self, timeout: Optional[float], record_latency: bool = True) -> RawChunk:
+        """
+        chunkを1つ読む
+        :param timeout: 秒。この時間応答がなければSimProcessError
+        :param record_latency: 受信待ち時間をlatency_emaに反映する。
+            rolloutなど、シミュレータ側で時間のかかるコマンドの応答待ちの間はFalseとする。
+        :return:
+        """
+        return self.read_received(timeout, record_latency)[0]
+
+    def read_received(self, timeout: Optional[float], record_latency: bool = True) -> Tuple[RawChunk, int, float]:
+        """
+        chunkを1つ読み、そのchunkの生データのバイト数、パースにかかった時間(受信スレッドで計測)とともに返す
+        引数はreadと同じ
+        :return: (chunk, バイト数, パース時間(秒))
+        """
+        time_start = time.monotonic()
+        try:
+            received = self._chunks.get(timeout=timeout)
+        except queue.Empty:
+            raise SimProcessError(f"simulator process did not respond in {timeout} seconds")
+        if received is None:
+            raise SimProcessError(f"simulator process exited unexpectedly (returncode={self.proc.poll()})")
+        raw_chunk, raw, decode_time = received
+        self.transport.account(raw, decode_time)
+        if record_latency:
+            decay = SimProcess.LATENCY_EMA_DECAY
+            self.latency_ema = decay * self.latency_ema + (1.0 - decay) * (time.monotonic() - time_start)
+        return raw_chunk, len(raw), decode_time
+
+    def rss_bytes(self) -> Optional[int]:
+        """
+        プロセスの物理メモリ使用量
+        :return: 取得できない環境ではNone
+        """
+        try:
+            with open(f'/proc/{self.proc.pid}/statm') as f:
+                resident_pages = int(f.read().split()[1])
+            return resident_pages * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        self.proc.terminate()
+        try:
+            self.proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+
+class SimSupervisor:
+    """
+    シミュレータプロセスの監視
+    メモリ使用量や応答時間が閾値を超えたら入れ替えが必要と判定する。
+    use_standby=Trueで予備プロセスを起動しておくと、入れ替え時にnodeの起動時間を待たずに済む。
+    SimPoolのワーカーなどSimを多数生成する場合はnodeプロセス数が倍になるため、既定では起動しない。
+    """
+    command: List[str]
+    transport: Transport
+    max_rss: int  # バイト
+    max_latency: float  # 秒
+    response_timeout: Optional[float]  # 秒
+    max_battles: Optional[int]
+    check_interval: float  # 秒
+    current: Optional[SimProcess]
+    standby: Optional[SimProcess]
+
+    def __init__(self, command: List[str], transport: Transport, max_rss_mb: int = 1024, max_latency: float = 1.0,
+                 response_timeout: Optional[float] = 120.0, max_battles: Optional[int] = None,
+                 use_standby: bool = False, check_interval: float = 10.0):
+        """
+        :param command: シミュレータのコマンドライン
+        :param transport:
+        :param max_rss_mb: プロセスのメモリ使用量がこれを超えたら入れ替える
+        :param max_latency: chunkの受信待ち時間の移動平均がこれを超えたら入れ替える
+        :param response_timeout: この時間応答がなければプロセスが停止したとみなす
+        :param max_battles: 指定した場合、このバトル数で入れ替える
+        :param use_standby: 予備プロセスを起動しておく
+        :param check_interval: メモリ使用量を調べる間隔
+        """
+        self.command = command
+        self.transport = transport
+        self.max_rss = max_rss_mb * 1024 * 1024
+        self.max_latency = max_latency
+        self.response_timeout = response_timeout
+        self.max_battles = max_battles
+        self.use_standby = use_standby
+        self.check_interval = check_interval
+        self.current = None
+        self.standby = None
+        self._last_check = 0.0
+        self._recycle_requested = False
+
+    def get(self) -> SimProcess:
+        """
+        現在使用するプロセスを返す。なければ起動する。
+        """
+        if self.current is None:
+            self.current = self._take_standby() or SimProcess(self.command, self.transport)
+            self._recycle_requested = False
+            if self.use_standby and self.standby is None:
+                self.standby = SimProcess(self.command, self.transport)
+        return self.current
+
+    def _take_standby(self) -> Optional[SimProcess]:
+        standby = self.standby
+        self.standby = None
+        if standby is not None and standby.proc.poll() is not None:
+            # 予備プロセスが異常終了していた
+            standby = None
+        return standby
+
+    def needs_recycle(self) -> bool:
+        """
+        現在のプロセスを入れ替えるべきか
+        一度入れ替えが必要と判定されたら、recycleされるまでTrueを返す
+        """
+        if self.current is None or self._recycle_requested:
+            return self._recycle_requested
+        current = self.current
+        reason = None
+        if self.max_battles is not None and current.n_battle >= self.max_battles:
+            reason = f"battles {current.n_battle}"
+        elif current.latency_ema > self.max_latency:
+            reason = f"latency {current.latency_ema:.3f}s"
+        else:
+            now = time.monotonic()
+            if now - self._last_check >= self.check_interval:
+                self._last_check = now
+                rss = current.rss_bytes()
+                if rss is not None and rss > self.max_rss:
+                    reason = f"rss {rss // (1024 * 1024)}MB"
+        if reason is not None:
+            logger.info(f"simulator process will be recycled: {reason}")
+            self._recycle_requested = True
+        return self._recycle_requested
+
+    def recycle(self):
+        """
+        現在のプロセスを終了し、予備プロセスに切り替える
+        進行中のバトルがない状態で呼ぶこと
+        """
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+        self.get()
+
+    def replace_dead(self):
+        """
+        停止・応答なしとなったプロセスを破棄し、予備プロセスに切り替える
+        """
+        if self.current is not None:
+            logger.warning("simulator process died or stopped responding; replacing")
+            self.current.proc.kill()
+            self.current.close()
+            self.current = None
+        self.get()
+
+    def close(self):
+        for sim_process in [self.current, self.standby]:
+            if sim_process is not None:
+                sim_process.close()
+        self.current = None
+        self.standby = None
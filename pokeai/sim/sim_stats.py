@@ -0,0 +1,92 @@
+"""
+バトル処理の計測
+フェーズごとの経過時間、メッセージの種類ごとの件数、シミュレータとの通信バイト数を集計する。
+計測はSim(stats=True)の場合のみ行い、無効時は各所でNoneの判定のみとなる。
+
+フェーズ(秒):
+read: シミュレータからのchunkの受信待ち(シミュレータ内の処理時間を含む)
+decode: 受信データのパース(受信スレッドで行い、他のフェーズと並行するため合計には含めない)
+split: updateのトークン化と各プレイヤー向けへの振り分け(python側で行う場合)
+processor: BattleStreamProcessorのメッセージ処理(policyを除く)
+policy: 方策の行動選択(feature, modelを含む)
+feature: RLPolicyの特徴抽出
+model: RLPolicyのモデルの計算(chainer)
+write: シミュレータへの送信
+"""
+import time
+from collections import Counter
+from typing import Dict
+
+
+class SimStats:
+    phase_time: Dict[str, float]
+    message_counts: Counter  # メッセージの種類('switch', '-damage'など) => 件数
+    bytes_read: int
+    bytes_written: int
+    chunks: int  # 受信したchunk数
+    battles: int  # 終了したバトル数
+
+    def __init__(self):
+        self.phase_time = {}
+        self.message_counts = Counter()
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.chunks = 0
+        self.battles = 0
+
+    def add_time(self, phase: str, seconds: float):
+        self.phase_time[phase] = self.phase_time.get(phase, 0.0) + seconds
+
+    def add_time_since(self, phase: str, time_start: float) -> float:
+        """
+        time_start(time.perf_counter()の値)からの経過時間を加算する
+        :return: 現在時刻
+        """
+        now = time.perf_counter()
+        self.add_time(phase, now - time_start)
+        return now
+
+    def merge(self, other: "SimStats"):
+        for phase, seconds in other.phase_time.items():
+            self.add_time(phase, seconds)
+        self.message_counts.update(other.message_counts)
+        self.bytes_read += other.bytes_read
+        self.bytes_written += other.bytes_written
+        self.chunks += other.chunks
+        self.battles += other.battles
+
+    def to_dict(self) -> dict:
+        return {
+            'phase_time': dict(self.phase_time),
+            'message_counts': dict(self.message_counts),
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'chunks': self.chunks,
+            'battles': self.battles,
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "SimStats":
+        stats = cls()
+        stats.phase_time = dict(d['phase_time'])
+        stats.message_counts = Counter(d['message_counts'])
+        stats.bytes_read = d['bytes_read']
+        stats.bytes_written = d['bytes_written']
+        stats.chunks = d['chunks']
+        stats.battles = d['battles']
+        return stats
+
+    def summary(self) -> str:
+        """
+        ログ出力用の要約
+        """
+        # feature, modelはpolicyの内訳、decodeは受信スレッドで並行して行われる
+        total = sum(seconds for phase, seconds in self.phase_time.items()
+                    if phase not in ('feature', 'model', 'decode'))
+        lines = [f"battles: {self.battles}, chunks: {self.chunks}, "
+                 f"bytes read: {self.bytes_read}, bytes written: {self.bytes_written}"]
+        for phase, seconds in sorted(self.phase_time.items(), key=lambda item: -item[1]):
+            ratio = seconds / total if total > 0 else 0.0
+            lines.append(f"  {phase}: {seconds:.3f}s ({ratio:.1%})")
+        lines.append("  messages: " + ", ".join(f"{msg}={count}" for msg, count in self.message_counts.most_common()))
+        return "\n".join(lines)
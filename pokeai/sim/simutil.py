@@ -1,7 +1,13 @@
+import os
 import subprocess
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Any, Optional
 from pokeai.util import ROOT_DIR
 
+SimUtilRequest = Tuple[str, Any]  # (メソッド名, パラメータ)
+
 
 class SimUtilError(Exception):
     def __init__(self, obj):
@@ -12,19 +18,111 @@ class SimUtilError(Exception):
 class SimUtil:
     """
     シミュレータの付属機能呼び出し
+    リクエストにIDをつけて送るため、複数のリクエストをまとめて送り、応答を順不同で受け取れる(call_many)。
+    スレッド間で共有してよい。シミュレータは最初の呼び出し時に起動する。fork後の子プロセスで使用された場合は起動しなおす。
     """
 
     def __init__(self):
-        self.proc = subprocess.Popen(['node', 'js/simutil'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                                     encoding='utf-8', cwd=str(ROOT_DIR))
+        self.proc = None
+        self._pid = None
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def _ensure_proc(self):
+        if self.proc is None or self._pid != os.getpid():
+            # 親プロセスのパイプは使用しない
+            self.proc = subprocess.Popen(['node', 'js/simutil'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         encoding='utf-8', cwd=str(ROOT_DIR))
+            self._pid = os.getpid()
 
     def call(self, method: str, params):
-        self.proc.stdin.write(json.dumps({'method': method, 'params': params}) + '\n')
+        return self.call_many([(method, params)])[0]
+
+    def call_many(self, requests: List[SimUtilRequest], return_exceptions: bool = False) -> list:
+        """
+        複数のリクエストを1回の書き込みで送り、結果をまとめて受け取る
+        :param requests: (メソッド名, パラメータ)のリスト
+        :param return_exceptions: Trueの場合、エラーとなったリクエストの結果をSimUtilErrorとして返す。
+        Falseの場合、最初のエラーを送出する。
+        :return: requestsと同じ順序の結果のリスト
+        """
+        if len(requests) == 0:
+            return []
+        with self._lock:
+            self._ensure_proc()
+            first_id = self._next_id
+            self._next_id += len(requests)
+            data = ''.join(json.dumps({'id': first_id + i, 'method': method, 'params': params}) + '\n'
+                           for i, (method, params) in enumerate(requests))
+            if len(requests) == 1:
+                self._write(data)
+                responses = [json.loads(self.proc.stdout.readline())]
+            else:
+                # 応答を読まずに大量に書き込むと、パイプが詰まり互いに待ち状態となるため別スレッドで書き込む
+                writer = threading.Thread(target=self._write, args=(data,))
+                writer.start()
+                responses = [json.loads(self.proc.stdout.readline()) for _ in range(len(requests))]
+                writer.join()
+        results = [None] * len(requests)
+        for response in responses:
+            idx = response['id'] - first_id
+            if response['error'] is not None:
+                error = SimUtilError(response['error'])
+                if not return_exceptions:
+                    raise error
+                results[idx] = error
+            else:
+                results[idx] = response['result']
+        return results
+
+    def _write(self, data: str):
+        self.proc.stdin.write(data)
         self.proc.stdin.flush()
-        result = json.loads(self.proc.stdout.readline())
-        if result['error'] is not None:
-            raise SimUtilError(result['error'])
-        return result['result']
 
 
-sim_util = SimUtil()
+class SimUtilPool:
+    """
+    複数のシミュレータ付属機能プロセスにリクエストを分散する
+    call_manyのリクエストを各プロセスに分割して並行に処理する。
+    """
+    sim_utils: List[SimUtil]
+
+    def __init__(self, processes: int = 2):
+        self.sim_utils = [SimUtil() for _ in range(processes)]
+        self._executor = ThreadPoolExecutor(max_workers=processes)
+        self._next_idx = 0
+
+    def call(self, method: str, params):
+        return self.call_many([(method, params)])[0]
+
+    def call_many(self, requests: List[SimUtilRequest], return_exceptions: bool = False) -> list:
+        """
+        SimUtil.call_manyと同じ
+        """
+        if len(requests) <= 1:
+            # プロセスを順に使う
+            sim_util = self.sim_utils[self._next_idx % len(self.sim_utils)]
+            self._next_idx += 1
+            return sim_util.call_many(requests, return_exceptions)
+        n = len(self.sim_utils)
+        slice_size = (len(requests) + n - 1) // n
+        futures = [self._executor.submit(sim_util.call_many, requests[i * slice_size:(i + 1) * slice_size],
+                                         return_exceptions)
+                   for i, sim_util in enumerate(self.sim_utils)]
+        results = []
+        for future in futures:
+            results.extend(future.result())
+        return results
+
+
+_sim_util = None  # type: Optional[SimUtil]
+
+
+def get_sim_util() -> SimUtil:
+    """
+    共有のSimUtilインスタンスを返す
+    """
+    global _sim_util
+    if _sim_util is None:
+        _sim_util = SimUtil()
+    return _sim_util
@@ -1,10 +1,18 @@
 from typing import Optional, List
-from pokeai.sim.simutil import sim_util
+from pokeai.sim.simutil import get_sim_util
 
 
 class TeamValidator:
     def validate(self, party) -> Optional[List[str]]:
-        return sim_util.call('validateTeam', {'party': party})
+        return get_sim_util().call('validateTeam', {'party': party})
+
+    def validate_many(self, parties) -> List[Optional[List[str]]]:
+        """
+        複数のパーティをまとめて検証する
+        :param parties:
+        :return: 各パーティのvalidateの結果
+        """
+        return get_sim_util().call_many([('validateTeam', {'party': party}) for party in parties])
 
 
 def demo():
@@ -0,0 +1,180 @@
+"""
+pythonとシミュレータ(js/simpipe)の間の通信方式
+
+json: [バトルID, chunk]をjsonシリアライズして1行で送受信(既定)
+framed: 長さ付きのバイナリフレームで送受信。chunk本体はUTF-8テキストのまま送るため、エスケープや行の走査が不要。
+  フレーム = ヘッダ(10バイト) + 本体
+  ヘッダ = 本体のバイト数(uint32) + バトルID(uint32) + chunkの種類(uint8) + side(uint8)  (リトルエンディアン)
+  sideupdateの本体はside行を除いたもの、update, endの本体はchunkの種類の行を除いたもの
+"""
+import json
+import struct
+import time
+from typing import List, Tuple, Optional
+
+# 読んだchunk (バトルID, chunkの種類, side, 本体)
+# sideはsideupdateの場合と、simpipeでupdateを各プレイヤー向けに分割した場合(--split)は'p1'または'p2'、それ以外は''
+RawChunk = Tuple[int, str, str, str]
+
+FRAME_HEADER = struct.Struct('<IIBB')
+CHUNK_TYPES = ['input', 'update', 'sideupdate', 'end', 'snapshot', 'rollout']  # フレームにおけるchunkの種類の番号
+CHUNK_TYPE2NUM = {t: i for i, t in enumerate(CHUNK_TYPES)}
+SIDES = ['', 'p1', 'p2']  # フレームにおけるsideの番号
+
+
+class Transport:
+    """
+    通信方式の基底クラス
+    readは同期的なファイルオブジェクト、read_asyncはasyncio.StreamReaderから読む
+    """
+    name: str
+    bytes_written: int  # シミュレータへ送ったバイト数
+    bytes_read: int  # シミュレータから受け取ったバイト数
+    record: Optional[List[bytes]]  # Noneでなければ、受け取った生データを1chunkずつ追記する(ベンチマーク用)
+    timing: bool  # Trueならdecode_timeを計測する
+    decode_time: float  # 受信データのパースにかかった時間(秒)
+
+    def __init__(self, record: bool = False):
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.record = [] if record else None
+        self.timing = False
+        self.decode_time = 0.0
+
+    def simpipe_args(self) -> List[str]:
+        """
+        js/simpipeに与えるコマンドライン引数
+        """
+        raise NotImplementedError
+
+    def encode(self, battle_id: int, commands: List[str]) -> bytes:
+        raise NotImplementedError
+
+    def read(self, stream) -> Optional[RawChunk]:
+        """
+        chunkを1つ読む
+        :param stream: バイナリモードのファイルオブジェクト
+        :return: ストリームが閉じられた場合None
+        """
+        raw = self.read_raw(stream)
+        if raw is None:
+            return None
+        return self._received(raw)
+
+    def read_raw(self, stream) -> Optional[bytes]:
+        """
+        chunk1つ分の生データを読む。bytes_readなどの集計は行わないため、受信スレッドから呼んでもよい。
+        :param stream: バイナリモードのファイルオブジェクト
+        :return: ストリームが閉じられた場合None
+        """
+        raise NotImplementedError
+
+    async def read_async(self, stream) -> Optional[RawChunk]:
+        raise NotImplementedError
+
+    def decode(self, raw: bytes) -> RawChunk:
+        """
+        読んだ生データ(recordに記録されるもの)をchunkに変換する
+        """
+        raise NotImplementedError
+
+    def decode_timed(self, raw: bytes) -> Tuple[RawChunk, float]:
+        """
+        生データをchunkに変換し、パースにかかった時間とともに返す(timingでなければ時間は0)
+        集計は行わないため、受信スレッドから呼んでもよい。
+        """
+        if not self.timing:
+            return self.decode(raw), 0.0
+        time_start = time.perf_counter()
+        raw_chunk = self.decode(raw)
+        return raw_chunk, time.perf_counter() - time_start
+
+    def account(self, raw: bytes, decode_time: float):
+        """
+        受信した生データをbytes_read, decode_time, recordに集計する
+        複数のスレッドから呼ばないこと。
+        """
+        self.bytes_read += len(raw)
+        self.decode_time += decode_time
+        if self.record is not None:
+            self.record.append(raw)
+
+    def _received(self, raw: bytes) -> RawChunk:
+        # 受信した生データを記録してchunkに変換する
+        raw_chunk, decode_time = self.decode_timed(raw)
+        self.account(raw, decode_time)
+        return raw_chunk
+
+
+class JsonLineTransport(Transport):
+    name = 'json'
+
+    def simpipe_args(self) -> List[str]:
+        return []
+
+    def encode(self, battle_id: int, commands: List[str]) -> bytes:
+        data = (json.dumps([battle_id, '\n'.join(commands)]) + '\n').encode('utf-8')
+        self.bytes_written += len(data)
+        return data
+
+    def read_raw(self, stream) -> Optional[bytes]:
+        line = stream.readline()
+        if not line:
+            return None
+        return line
+
+    async def read_async(self, stream) -> Optional[RawChunk]:
+        line = await stream.readline()
+        if not line:
+            return None
+        return self._received(line)
+
+    def decode(self, raw: bytes) -> RawChunk:
+        decoded = json.loads(raw)  # [バトルID, chunk] or [バトルID, chunk, side]
+        battle_id, rawstr = decoded[0], decoded[1]
+        chunk_type, chunk_data = rawstr.split('\n', 1)  # 最初の1要素(update, endなど)のみ分離
+        side = decoded[2] if len(decoded) > 2 else ''
+        if chunk_type == 'sideupdate':
+            side, chunk_data = chunk_data.split('\n')
+        return battle_id, chunk_type, side, chunk_data
+
+
+class FramedTransport(Transport):
+    name = 'framed'
+
+    def simpipe_args(self) -> List[str]:
+        return ['--framed']
+
+    def encode(self, battle_id: int, commands: List[str]) -> bytes:
+        body = '\n'.join(commands).encode('utf-8')
+        data = FRAME_HEADER.pack(len(body), battle_id, CHUNK_TYPE2NUM['input'], 0) + body
+        self.bytes_written += len(data)
+        return data
+
+    def read_raw(self, stream) -> Optional[bytes]:
+        header = stream.read(FRAME_HEADER.size)
+        if len(header) < FRAME_HEADER.size:
+            return None
+        return header + stream.read(FRAME_HEADER.unpack(header)[0])
+
+    async def read_async(self, stream) -> Optional[RawChunk]:
+        try:
+            header = await stream.readexactly(FRAME_HEADER.size)
+            raw = header + await stream.readexactly(FRAME_HEADER.unpack(header)[0])
+        except EOFError:
+            return None
+        return self._received(raw)
+
+    def decode(self, raw: bytes) -> RawChunk:
+        length, battle_id, chunk_type_num, side_num = FRAME_HEADER.unpack_from(raw)
+        return battle_id, CHUNK_TYPES[chunk_type_num], SIDES[side_num], raw[FRAME_HEADER.size:].decode('utf-8')
+
+
+TRANSPORTS = {
+    JsonLineTransport.name: JsonLineTransport,
+    FramedTransport.name: FramedTransport,
+}
+
+
+def make_transport(name: str, record: bool = False) -> Transport:
+    return TRANSPORTS[name](record=record)